@@ -1,9 +1,20 @@
 """
 AIアシスタントとのチャットに関するAPIエンドポイントを定義します。
 """
-from fastapi import APIRouter, Depends
+import asyncio
+import json
+from typing import Callable
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from app.models.manga import MangaRead
 from app.services.chat import LLMService
+from app.graph.workflows import checkpointer
+from app.services.semantic_cache import semantic_cache
+from app.core.llm_gateway import llm_gateway
+from app.core.admission import AdmissionRejected, chat_admission, chat_coalescer
+from app.models.chroma import embedding
 
 router = APIRouter()
 
@@ -12,17 +23,150 @@ class ChatQuery(BaseModel):
     thread_id: str
     message: str
 
+class ChatFullResponse(BaseModel):
+    """回答と推薦された漫画の詳細をまとめたチャットのレスポンスモデル"""
+    answer: str
+    found_manga_ids: list[int]
+    manga: list[MangaRead]
+
 def get_llm_service() -> LLMService:
     """DI (Dependency Injection) を使用して、LLMServiceのインスタンスを生成します。"""
     return LLMService()
 
+# 拒否した理由ごとのステータスコードとメッセージ
+REJECTION_RESPONSES = {
+    "queue_full": (503, "Too many chat requests. Please retry later"),
+    "queue_timeout": (503, "Timed out waiting for a chat slot. Please retry later"),
+    "cancelled": (503, "The identical request in progress was cancelled. Please retry"),
+    "conflict": (409, "Another message is being processed in this thread"),
+}
+
+def rejection_to_http(e: AdmissionRejected) -> HTTPException:
+    """受け付けを拒否した理由を、Retry-After付きのHTTPエラーに変換します。"""
+    status_code, detail = REJECTION_RESPONSES[e.reason]
+    return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(e.retry_after_sec)})
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    送信が終わった時に、必ず`on_close`を呼び出すStreamingResponse。
+    クライアントが本文の送信前に切断した場合は本文の非同期ジェネレータが開始されず、そのfinallyも実行されないため、
+    ジェネレータの外で確保した資源はこちらで解放します。
+    """
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def format_sse(event: dict) -> str:
+    """イベントの辞書をSSEの形式にします。"""
+    # 漫画の詳細に含まれる日時もJSONにできるよう、FastAPIのレスポンスと同じ形式に変換する
+    data = json.dumps(jsonable_encoder({k: v for k, v in event.items() if k != "event"}), ensure_ascii=False)
+    return f"event: {event['event']}\ndata: {data}\n\n"
+
+async def run_admitted_chat(request: ChatQuery, service: LLMService) -> dict:
+    """
+    受け付け制御の枠の中でグラフを実行し、`chat_full`の結果を返します。
+    同じスレッドで同じメッセージを処理中の場合は、グラフを実行せずにその結果を待ちます。
+    """
+    async def admitted() -> dict:
+        async with chat_admission.slot():
+            return await service.chat_full(request.thread_id, request.message)
+
+    try:
+        return await chat_coalescer.run(request.thread_id, request.message, admitted)
+    except AdmissionRejected as e:
+        raise rejection_to_http(e)
+
 @router.post("/chat")
 async def chat(request: ChatQuery, service: LLMService = Depends(get_llm_service)) -> dict:
     """
     ユーザーからのメッセージを受け取り、AIアシスタントからの応答を返します。
+    混雑時は503（Retry-After付き）を、同じスレッドで別のメッセージを処理中の場合は409を返します。
     """
-    response = await service.chat(request.thread_id, request.message)
-    return {"response": response}
+    result = await run_admitted_chat(request, service)
+    return {"response": result["answer"]}
+
+@router.post("/chat/full", response_model=ChatFullResponse)
+async def chat_full(request: ChatQuery, service: LLMService = Depends(get_llm_service)) -> dict:
+    """
+    ユーザーからのメッセージを受け取り、AIアシスタントの応答と、推薦された漫画のIDリスト・詳細を1回のレスポンスで返します。
+    混雑時の応答は`/chat`と同じです。
+    """
+    return await run_admitted_chat(request, service)
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatQuery, service: LLMService = Depends(get_llm_service)) -> StreamingResponse:
+    """
+    ユーザーからのメッセージを受け取り、AIアシスタントの応答をServer-Sent Events(SSE)で返します。
+    `node`イベントで処理の進行を、`token`イベントで回答の差分を、
+    最後の`done`イベントで回答全体と見つかった漫画のIDリスト・詳細を送ります。
+    受け付けの可否はストリームを開始する前に判定し、混雑時の応答は`/chat`と同じです。
+    同じスレッドで同じメッセージを処理中の場合は、その完了を待ってから回答全体を1つのトークンとして送ります。
+    """
+    key, content = request.thread_id, request.message
+    try:
+        shared = chat_coalescer.join(key, content)
+        if shared is not None:
+            result = await asyncio.shield(shared)
+        else:
+            chat_coalescer.lead(key, content)
+            try:
+                await chat_admission.acquire()
+            except BaseException as e:
+                chat_coalescer.finish(key, error=e)
+                raise
+    except AdmissionRejected as e:
+        raise rejection_to_http(e)
+
+    if shared is not None:
+        async def replay_stream():
+            yield format_sse({"event": "token", "text": result["answer"]})
+            yield format_sse({"event": "done", **result, "cached": False})
+
+        return StreamingResponse(replay_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    released = False
+
+    def release(result=None, error=None) -> None:
+        """
+        処理の枠と処理中の登録を1回だけ返します。
+        ストリームの終了時と、レスポンスの送信終了時（送信前の切断を含む）の両方から呼ばれます。
+        """
+        nonlocal released
+        if released:
+            return
+        released = True
+        chat_admission.release()
+        # 結果が無いまま終わった場合、待ち合わせているリクエストには再試行を促す
+        chat_coalescer.finish(key, result, None if result else error or asyncio.CancelledError())
+
+    async def event_stream():
+        result, error = None, None
+        try:
+            async for event in service.chat_stream(key, content):
+                if event["event"] == "done":
+                    result = {k: event[k] for k in ("answer", "found_manga_ids", "manga")}
+                elif event["event"] == "error":
+                    error = RuntimeError(event["message"])
+                yield format_sse(event)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            release(result, error or RuntimeError("chat stream ended without a result"))
+
+    return ClosingStreamingResponse(
+        event_stream(),
+        on_close=release,
+        media_type="text/event-stream",
+        # プロキシによるバッファリングを無効にし、トークンを即座に届ける
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("/chat/{thread_id}/manga-ids")
 async def get_found_manga_ids(thread_id: str, service: LLMService = Depends(get_llm_service)) -> dict:
@@ -38,4 +182,39 @@ async def get_search_queries(thread_id: str, service: LLMService = Depends(get_l
     指定されたスレッドIDの会話内でAIが生成した検索クエリのリストを取得します。
     """
     response = await service.get_search_queries(thread_id)
-    return {"response": response}
\ No newline at end of file
+    return {"response": response}
+
+@router.get("/checkpointer")
+async def get_checkpointer_stats() -> dict:
+    """
+    会話状態（チェックポイント）の保存状況を取得します。
+    スレッド数・ファイルサイズに加え、グラフのステップごとのチェックポイントのサイズを確認できます。
+    """
+    if not hasattr(checkpointer, "stats"):
+        return {"response": {"backend": "memory"}}
+    return {"response": checkpointer.stats()}
+
+
+@router.get("/semantic-cache")
+async def get_semantic_cache_stats() -> dict:
+    """
+    セマンティックキャッシュ（会話の最初のメッセージに対する回答のキャッシュ）のヒット率とエントリ数を取得します。
+    """
+    return {"response": semantic_cache.stats()}
+
+
+@router.get("/llm-gateway")
+async def get_llm_gateway_stats() -> dict:
+    """
+    LLMゲートウェイのレーン（interactive・batch）ごとの待ち件数・実行中の件数・待ち時間と、
+    クエリの埋め込みをまとめた回数を取得します。
+    """
+    return {"response": {**llm_gateway.stats(), "embedding_batching": embedding.stats()}}
+
+
+@router.get("/admission")
+async def get_admission_stats() -> dict:
+    """
+    チャットAPIの受け付け制御の状況（処理中・待機中のリクエスト数、拒否した件数、まとめた重複リクエストの件数）を取得します。
+    """
+    return {"response": {**chat_admission.stats(), "coalescer": chat_coalescer.stats()}}
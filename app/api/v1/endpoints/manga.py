@@ -2,28 +2,39 @@
 漫画情報に関するAPIエンドポイントを定義します。
 CRUD (作成、読み取り、更新、削除) 操作や、様々な検索機能を提供します。
 """
-from fastapi import APIRouter, Depends, Query, BackgroundTasks
-from app.models.manga import MangaRead, Manga, MangaCreate, MangaUpdate, MangaSearchKeywordParams, MangaSearchQueryParams,MangaSearchVectorParams, get_session
+import json
+from fastapi import APIRouter, Depends, Query, BackgroundTasks, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from app.models.manga import MangaRead, Manga, MangaCreate, MangaUpdate, MangaPage, MangaSearchKeywordParams, MangaSearchQueryParams,MangaSearchVectorParams, engine, get_session
 from app.models.chroma import get_vectorDB
 from app.services.manga import MangaService
+from app.services.manga_stats import manga_stats
+from app.core.config import settings
+from app.services.vector_indexer import VectorIndexer, get_vector_indexer
 from sqlmodel import Session
-from typing import List
+from typing import List, Literal, Optional
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from sqlmodel import select
-from app.scripts.db_seed import run_full_seed_pipeline, run_full_seed_pipeline_review_sumarize
+from sqlalchemy.exc import IntegrityError
+from app.models.seed import SeedJobStatus
+from app.services.seed import SeedJobService
+from app.scripts.db_seed import run_seed_job
 
 router = APIRouter()
 
 def get_manga_service(
         session: Session = Depends(get_session), 
-        vectorDB: Chroma = Depends(get_vectorDB)
+        vectorDB: Chroma = Depends(get_vectorDB),
+        vector_indexer: VectorIndexer = Depends(get_vector_indexer)
     ) -> MangaService:
     """
     DI (Dependency Injection) を使用して、MangaServiceのインスタンスを生成します。
-    SQLModelのセッションとChromaDBのクライアントをサービスに渡します。
+    SQLModelのセッションとChromaDBのクライアント、ベクトルインデクサをサービスに渡します。
     """
-    return MangaService(session, vectorDB)
+    return MangaService(session, vectorDB, vector_indexer)
 
 @router.get("/manga/batch", response_model=List[MangaRead])
 def batch_get_manga(
@@ -43,14 +54,55 @@ def get_manga(manga_id: int, service: MangaService = Depends(get_manga_service))
 
 @router.post("/manga", response_model=MangaRead)
 def create_manga(params: MangaCreate, service: MangaService = Depends(get_manga_service)) -> MangaRead:
-    """新しい漫画情報を作成します。"""
-    manga = service.create_manga(params)
+    """新しい漫画情報を作成します。同じ`site_id`の漫画が既にある場合は409を返します。"""
+    try:
+        manga = service.create_manga(params)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Manga with the same site_id already exists")
     return manga
 
+# NDJSON（1行に1件のJSON）として扱うContent-Type
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines")
+
+def parse_bulk_manga(body: bytes, content_type: str) -> list[MangaCreate]:
+    """
+    一括登録のリクエストボディを、JSONの配列またはNDJSONとして読み取ります。
+    Content-TypeがNDJSONでない場合も、ボディがJSONの配列でなければNDJSONとして扱います。
+    """
+    text_body = body.decode("utf-8-sig")
+    try:
+        if content_type.split(";")[0].strip() not in NDJSON_CONTENT_TYPES and text_body.lstrip().startswith("["):
+            records = json.loads(text_body)
+        else:
+            records = [json.loads(line) for line in text_body.splitlines() if line.strip()]
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid JSON: {e}")
+    items = []
+    for i, record in enumerate(records):
+        try:
+            items.append(MangaCreate.model_validate(record))
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid manga at index {i}: {e.errors(include_url=False)}")
+    return items
+
+@router.post("/manga/bulk")
+async def bulk_upsert_manga(request: Request, service: MangaService = Depends(get_manga_service)) -> dict:
+    """
+    漫画情報をまとめて登録します。ボディはJSONの配列、またはNDJSON（1行に1件）で送ります。
+    同じ`site_id`の漫画が既にある場合は、その漫画を更新します（値がnullの項目は上書きしません）。
+    全件を1つのトランザクションで保存し、ベクトルDBへの反映はバックグラウンドでまとめて行います。
+    """
+    items = parse_bulk_manga(await request.body(), request.headers.get("content-type", ""))
+    result = await run_in_threadpool(service.bulk_upsert, items)
+    return {"count": len(items), **result}
+
 @router.patch("/manga/{manga_id}", response_model=MangaRead)
 def update_manga(manga_id: int, params: MangaUpdate, service: MangaService = Depends(get_manga_service)) -> MangaRead:
-    """既存の漫画情報を更新します。"""
-    manga = service.update_manga(manga_id, params)
+    """既存の漫画情報を更新します。他の漫画と同じ`site_id`に変更しようとした場合は409を返します。"""
+    try:
+        manga = service.update_manga(manga_id, params)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Manga with the same site_id already exists")
     return manga
 
 @router.delete("/manga/{manga_id}", response_model=MangaRead)
@@ -59,48 +111,136 @@ def delete_manga(manga_id: int, service: MangaService = Depends(get_manga_servic
     manga = service.delete_manga(manga_id)
     return manga
 
-@router.get("/search_manga_by_keyword", response_model=List[MangaRead])
-def get_manga_list_by_keyword(params: MangaSearchKeywordParams = Depends(), service: MangaService = Depends(get_manga_service)) -> List[MangaRead]:
-    """キーワードに基づいて漫画を検索します。"""
-    manga_list = service.get_manga_list_by_keyword(params)
-    return manga_list
+@router.get("/search_manga_by_keyword", response_model=MangaPage)
+def get_manga_list_by_keyword(params: MangaSearchKeywordParams = Depends(), service: MangaService = Depends(get_manga_service)) -> MangaPage:
+    """
+    キーワードに基づいて漫画を検索します。
+    次のページは、レスポンスの`next_cursor`を`cursor`に指定して取得します。
+    """
+    try:
+        manga_list, next_cursor = service.get_manga_list_by_keyword(params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+    return {"items": manga_list, "next_cursor": next_cursor}
 
-@router.get("/search_manga_by_query", response_model=List[MangaRead])
-def get_manga_list_by_query(params: MangaSearchQueryParams = Depends(),service: MangaService = Depends(get_manga_service)) -> List[MangaRead]:
-    """より複雑なクエリ条件に基づいて漫画を検索します。"""
-    manga_list = service.get_manga_list_by_query(params)
-    return manga_list
+@router.get("/search_manga_by_query", response_model=MangaPage)
+def get_manga_list_by_query(params: MangaSearchQueryParams = Depends(),service: MangaService = Depends(get_manga_service)) -> MangaPage:
+    """
+    より複雑なクエリ条件に基づいて漫画を検索します。
+    次のページは、レスポンスの`next_cursor`を`cursor`に指定して取得します。
+    """
+    try:
+        manga_list, next_cursor = service.get_manga_list_by_query(params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+    return {"items": manga_list, "next_cursor": next_cursor}
 
-@router.get("/search_manga_by_vector", response_model=List[MangaRead])
-def get_manga_list_by_vector(params: MangaSearchVectorParams = Depends(),service: MangaService = Depends(get_manga_service)) -> List[MangaRead]:
-    """ベクトル検索（セマンティック検索）を使用して、クエリの意味に近い漫画を検索します。"""
-    manga_list = service.get_manga_list_by_vector(params)
-    return manga_list
+@router.get("/search_manga_by_vector", response_model=MangaPage)
+def get_manga_list_by_vector(params: MangaSearchVectorParams = Depends(),service: MangaService = Depends(get_manga_service)) -> MangaPage:
+    """
+    ベクトル検索（セマンティック検索）を使用して、クエリの意味に近い漫画を検索します。
+    次のページは、レスポンスの`next_cursor`を`cursor`に指定して取得します。
+    """
+    try:
+        manga_list, next_cursor = service.get_manga_list_by_vector(params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+    return {"items": manga_list, "next_cursor": next_cursor}
+
+def export_manga_ndjson():
+    """全ての漫画をNDJSON（1行に1件）で少しずつ返すジェネレータ。"""
+    # レスポンスの送信中もセッションを使うため、DIのセッションではなく専用のセッションを開く
+    with Session(engine) as session:
+        for partition in MangaService(session).iter_manga():
+            yield "".join(MangaRead.model_validate(manga).model_dump_json() + "\n" for manga in partition)
+
+@router.get("/export")
+def export_manga():
+    """
+    全ての漫画をNDJSON（1行に1件、IDの順）でストリーミングして返します。
+    一定件数ずつ読み込んで送るため、件数が多くてもサーバーのメモリ使用量は一定です。
+    """
+    return StreamingResponse(export_manga_ndjson(), media_type="application/x-ndjson")
 
 @router.get("/get_manga_count", response_model=int)
 def get_manga_count(service: MangaService = Depends(get_manga_service)):
     return service.get_manga_count()
 
+@router.get("/facets")
+def get_manga_facets(
+    kind: Literal["tag", "author", "serialization"] = Query(default="tag", description="語彙の種類, 「tag」「author」「serialization」"),
+    prefix: Optional[str] = Query(default=None, description="この文字列で始まる値だけを返す"),
+    limit: int = Query(default=50, ge=1, le=1000, description="最大件数"),
+    service: MangaService = Depends(get_manga_service)
+) -> List[dict]:
+    """タグ・著者・連載誌の語彙と、それぞれの漫画の件数を、件数の多い順に取得します（タグでの絞り込みの候補に使います）。"""
+    counts = service.get_facet_counts(kind, prefix, limit)
+    return [{"value": value, "count": count} for value, count in counts.items()]
+
+@router.get("/stats")
+def get_manga_stats(
+    top: int = Query(default=settings.MANGA_STATS_TOP_N, ge=1, le=200, description="よく使われるタグ・著者を返す件数"),
+    session: Session = Depends(get_session)
+) -> dict:
+    """
+    ライブラリの統計（ステータス・ユーザー管理のステータス・ユーザー評価ごとの件数、評価のヒストグラム、よく使われるタグ・著者）を取得します。
+    メモリ上の集計結果を返し、漫画の作成・更新・削除は差分で反映されるため、頻繁に取得しても全件の読み込みは発生しません。
+    """
+    return manga_stats.get(top, session)
+
+@router.get("/vector-indexer")
+def get_vector_indexer_status(vector_indexer: VectorIndexer = Depends(get_vector_indexer)) -> dict:
+    """ベクトルインデクサのキューの長さ（queue_depth）と反映の遅れ（lag_sec）などの状態を取得します。"""
+    return vector_indexer.status()
+
 @router.post("/seed")
-async def seed_database(background_tasks: BackgroundTasks, limit: int = 1000):
+async def seed_database(background_tasks: BackgroundTasks, limit: int = 1000, session: Session = Depends(get_session)):
     """
     Jikan APIからデータを取得し、LLM加工・DB格納をバックグラウンドで開始します。既にあるデータはスキップされます。
+    進捗は返却される`job_id`を使って GET /manga/seed/{job_id} で確認できます。
     """
+    job = SeedJobService(session).create_job(limit, summarize_reviews=False)
     # 非同期でパイプラインを実行
-    background_tasks.add_task(run_full_seed_pipeline, limit)
+    background_tasks.add_task(run_seed_job, job.id)
     
-    return {"message": f"Started seeding process for {limit} mangas in background."}
+    return {"message": f"Started seeding process for {limit} mangas in background.", "job_id": job.id}
 
 @router.post("/seed_review_sumarize")
-async def seed_database(background_tasks: BackgroundTasks, limit: int = 1000):
+async def seed_database_review_sumarize(background_tasks: BackgroundTasks, limit: int = 1000, session: Session = Depends(get_session)):
     """
     Jikan APIからデータを取得し、LLM加工・DB格納をバックグラウンドで開始します。既にあるデータはスキップされます。
     reviewを一度要約することで、処理時間と情報密度の向上を図ります。
     """
+    job = SeedJobService(session).create_job(limit, summarize_reviews=True)
     # 非同期でパイプラインを実行
-    background_tasks.add_task(run_full_seed_pipeline_review_sumarize, limit)
+    background_tasks.add_task(run_seed_job, job.id)
     
-    return {"message": f"Started seeding process for {limit} mangas in background."}
+    return {"message": f"Started seeding process for {limit} mangas in background.", "job_id": job.id}
+
+@router.get("/seed/{job_id}", response_model=SeedJobStatus)
+def get_seed_job_status(job_id: int, session: Session = Depends(get_session)) -> SeedJobStatus:
+    """シードジョブのステージごとの処理件数・スループット・完了までの推定時間を取得します。"""
+    service = SeedJobService(session)
+    job = service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Seed job not found")
+    return service.get_job_status(job)
+
+@router.post("/seed/{job_id}/resume")
+async def resume_seed_job(job_id: int, background_tasks: BackgroundTasks, session: Session = Depends(get_session)):
+    """
+    中断・失敗したシードジョブを再開します。実行待ち・実行中・完了済みのジョブは409を返します。
+    取得済みのレビューやLLMの加工結果はステージングから再利用され、残りの作業だけが実行されます。
+    """
+    service = SeedJobService(session)
+    job = service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Seed job not found")
+    # 中断・失敗したジョブだけを、1回のUPDATEで実行待ちに戻す（同時に再開されても一方だけが成功する）
+    if not service.queue_resume(job_id):
+        raise HTTPException(status_code=409, detail=f"Seed job is not resumable (status: {job.status})")
+    background_tasks.add_task(run_seed_job, job.id)
+    return {"message": f"Resumed seeding job {job_id} in background.", "job_id": job.id}
 
 @router.delete("/delete_all_manga")
 async def delete_all_manga(service: MangaService = Depends(get_manga_service)):
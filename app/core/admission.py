@@ -0,0 +1,174 @@
+"""
+APIの受け付け制御（アドミッション制御）です。
+同時に処理するリクエスト数に上限を設け、上限を超えた分は長さに上限のある待ち行列で待たせます。
+待ち行列があふれた場合や、待ち時間が上限を超えた場合は、処理せずにすぐに拒否します（呼び出し元で503とRetry-Afterを返す）。
+また、同じキー（会話のスレッドIDなど）で処理中のリクエストがある場合に、同じ内容のリクエストを1回の処理にまとめます。
+
+どちらもAPIサーバーのイベントループの中だけで使用する前提のため、スレッドのロックは使いません。
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable, TypeVar
+from app.core.config import settings
+
+ResultT = TypeVar("ResultT")
+
+class AdmissionRejected(Exception):
+    """
+    リクエストを受け付けられなかったことを表す例外。
+
+    Args:
+        reason (str): 拒否した理由（"queue_full" | "queue_timeout" | "conflict" | "cancelled"）。
+        retry_after_sec (int): 再試行までに待つべき秒数（Retry-Afterヘッダーの値）。
+    """
+    def __init__(self, reason: str, retry_after_sec: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after_sec = retry_after_sec
+
+class AdmissionController:
+    """
+    同時実行数の上限と、長さ・待ち時間に上限のある待ち行列で、リクエストの受け付けを制御します。
+
+    Args:
+        max_concurrency (int): 同時に処理するリクエスト数の上限。
+        max_queue (int): 処理を待つリクエスト数の上限（超えた分はすぐに拒否）。
+        queue_timeout_sec (float): 処理を待つ時間の上限（超えると拒否）。
+        retry_after_sec (int): 拒否したリクエストに返す、再試行までの秒数。
+    """
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout_sec: float, retry_after_sec: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout_sec = queue_timeout_sec
+        self.retry_after_sec = retry_after_sec
+        self._active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    async def acquire(self) -> None:
+        """処理の枠を確保します。確保できない場合は`AdmissionRejected`を送出します。"""
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            self._stats["admitted"] += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._stats["rejected_queue_full"] += 1
+            raise AdmissionRejected("queue_full", self.retry_after_sec)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._stats["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout_sec)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # 枠を譲られた直後にタイムアウト・キャンセルされた場合は、枠を次に回す
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats["rejected_timeout"] += 1
+                raise AdmissionRejected("queue_timeout", self.retry_after_sec) from None
+            raise
+        self._stats["admitted"] += 1
+
+    def release(self) -> None:
+        """処理の枠を返します。待っているリクエストがあれば、先着順に枠を譲ります。"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """async with文の間、処理の枠を確保します。"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        """処理中・待機中のリクエスト数と、受け付け・拒否した件数を返します。"""
+        return {
+            "active": self._active,
+            "queue_depth": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            **self._stats,
+        }
+
+class RequestCoalescer:
+    """
+    同じキーで処理中のリクエストがある場合に、同じ内容のリクエストを処理中の結果の待ち合わせにまとめます。
+    同じキーで内容の異なるリクエストが処理中の場合は、`AdmissionRejected`（"conflict"）を送出します。
+
+    Args:
+        retry_after_sec (int): 内容の異なるリクエストを拒否した場合に返す、再試行までの秒数。
+    """
+    def __init__(self, retry_after_sec: int):
+        self.retry_after_sec = retry_after_sec
+        # キー -> (リクエストの内容, 結果を受け取るFuture)
+        self._inflight: dict[Hashable, tuple[Hashable, asyncio.Future]] = {}
+        self._stats = {"coalesced": 0, "conflicts": 0}
+
+    def join(self, key: Hashable, content: Hashable) -> "asyncio.Future | None":
+        """同じキー・内容のリクエストが処理中ならその結果のFutureを、無ければNoneを返します。"""
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            return None
+        if inflight[0] != content:
+            self._stats["conflicts"] += 1
+            raise AdmissionRejected("conflict", self.retry_after_sec)
+        self._stats["coalesced"] += 1
+        return inflight[1]
+
+    def lead(self, key: Hashable, content: Hashable) -> asyncio.Future:
+        """このリクエストを処理中として登録し、結果を渡すFutureを返します。終わったら`finish`を呼ぶこと。"""
+        future = asyncio.get_running_loop().create_future()
+        # 待ち合わせるリクエストがいない場合に「例外が取り出されなかった」警告を出さないようにする
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = (content, future)
+        return future
+
+    def finish(self, key: Hashable, result=None, error: "BaseException | None" = None) -> None:
+        """処理中の登録を外し、待ち合わせているリクエストに結果（または例外）を渡します。"""
+        _, future = self._inflight.pop(key)
+        if future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            # 処理していたリクエストが切断された場合、待ち合わせていたリクエストには再試行を促す
+            future.set_exception(AdmissionRejected("cancelled", self.retry_after_sec))
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def run(self, key: Hashable, content: Hashable, func: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        """
+        同じキー・内容のリクエストが処理中ならその結果を待ち、無ければfuncを実行してその結果を返します。
+        """
+        shared = self.join(key, content)
+        if shared is not None:
+            return await asyncio.shield(shared)
+        self.lead(key, content)
+        try:
+            result = await func()
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    def stats(self) -> dict:
+        """処理中のキーの数と、まとめた件数・拒否した件数を返します。"""
+        return {"inflight": len(self._inflight), **self._stats}
+
+# チャットのエンドポイントで共有するインスタンス
+chat_admission = AdmissionController(
+    settings.CHAT_MAX_CONCURRENCY, settings.CHAT_MAX_QUEUE,
+    settings.CHAT_QUEUE_TIMEOUT_SEC, settings.CHAT_RETRY_AFTER_SEC
+)
+chat_coalescer = RequestCoalescer(settings.CHAT_RETRY_AFTER_SEC)
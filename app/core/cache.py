@@ -0,0 +1,173 @@
+"""
+アプリケーション全体で使用するキャッシュを定義します。
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class DiskLRUCache:
+    """
+    SQLiteファイルに保存する、件数上限付きのLRUキャッシュ。
+    プロセスを再起動しても内容が残り、上限を超えると最も長く使われていないエントリから削除します。
+    1つのファイルを`namespace`で区切って、複数の用途で共有できます。
+
+    Args:
+        path (str): キャッシュを保存するSQLiteファイルのパス。
+        namespace (str): キャッシュの用途を区別する名前。
+        max_entries (int): 保持するエントリ数の上限。
+    """
+    def __init__(self, path: str, namespace: str, max_entries: int):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_lru ON cache_entry (namespace, accessed_at)")
+
+    def get(self, key: str) -> Optional[str]:
+        """キーに対応する値を返します。無い場合はNoneを返します。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache_entry WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE cache_entry SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (time.time(), self.namespace, key)
+            )
+            return row[0]
+
+    def get_many(self, keys: list[str]) -> dict[str, str]:
+        """複数のキーをまとめて引き、見つかったものだけを辞書で返します。"""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key: str, value: str) -> None:
+        """値を保存し、上限を超えた分を古い順に削除します。"""
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, str]) -> None:
+        """複数の値をまとめて保存し、上限を超えた分を古い順に削除します。"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache_entry (namespace, key, value, accessed_at) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, value, now) for key, value in items.items()]
+            )
+            self._evict()
+            self._conn.execute("COMMIT")
+
+    def _evict(self) -> None:
+        (count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM cache_entry WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM cache_entry WHERE namespace = ? AND key IN ("
+                "SELECT key FROM cache_entry WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                (self.namespace, self.namespace, overflow)
+            )
+
+    def clear(self) -> None:
+        """このnamespaceのエントリを全て削除します。"""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache_entry WHERE namespace = ?", (self.namespace,))
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・ヒット率・エントリ数を返します。"""
+        with self._lock:
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM cache_entry WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
+
+class LRUCache:
+    """
+    プロセス内のメモリに保持する、件数上限と有効期限（任意）付きのLRUキャッシュ。
+    複数のスレッドから安全に使用できます。
+
+    Args:
+        max_entries (int): 保持するエントリ数の上限。
+        ttl_sec (Optional[float]): エントリの有効期限（秒）。Noneの場合は期限切れになりません。
+    """
+    def __init__(self, max_entries: int, ttl_sec: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # キー -> (保存時刻, 値)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """キーに対応する値を返します。無い場合や期限切れの場合はNoneを返します。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl_sec is not None and time.monotonic() - entry[0] > self.ttl_sec):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """値を保存し、上限を超えた分を古い順に削除します。"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """キーに対応するエントリを削除します。"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """全てのエントリを削除します。"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・ヒット率・エントリ数を返します。"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
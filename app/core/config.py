@@ -3,7 +3,7 @@
 PydanticのBaseSettingsを使用して、環境変数や.envファイルから設定を読み込みます。
 """
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import Optional
+from typing import Optional, Literal
 
 class Settings(BaseSettings):
     """
@@ -16,6 +16,8 @@ class Settings(BaseSettings):
     OLLAMA_BASE_URL: str = "http://localhost:11434"
     # 使用するOllamaのチャットモデル名
     OLLAMA_MODEL: str = "gemma3:12b"
+    # Ollamaのコンテキスト長（num_ctx）。プロンプトが小さいほど小さくでき、KVキャッシュのメモリを節約できる
+    OLLAMA_NUM_CTX: int = 16384
     # 使用するOllamaの埋め込みモデル名
     OLLAMA_EMBEDDING_MODEL: str = "embeddinggemma"
     # OpenAI APIのキー
@@ -29,6 +31,166 @@ class Settings(BaseSettings):
     # ChromaDBのデータ保存先ディレクトリ
     CHROMA_URL: str = "./data/chroma"
 
+    # --- SQLite（漫画データベース）の接続の設定 ---
+    # ジャーナルモード。"WAL"は書き込み中も読み取りをブロックしない
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    # 同期モード。WALでは"NORMAL"でも電源断以外でデータを失わず、書き込みが速い
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    # メモリマップで読み取るデータベースファイルの最大バイト数（0で無効）
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # 1接続あたりのページキャッシュのサイズ（KiB）
+    SQLITE_CACHE_SIZE_KIB: int = 64 * 1024
+    # ロック中のデータベースへの書き込みを待つミリ秒
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    # コネクションプールに保持する接続数
+    SQLITE_POOL_SIZE: int = 5
+    # プールの接続数を超えて一時的に作成できる接続数
+    SQLITE_MAX_OVERFLOW: int = 10
+    # プールから接続を取得するまで待つ秒数
+    SQLITE_POOL_TIMEOUT_SEC: float = 30.0
+    # プールの接続を作り直すまでの秒数（-1で作り直さない）
+    SQLITE_POOL_RECYCLE_SEC: int = 3600
+    # 一括登録（bulk_upsert）で1回のINSERT文にまとめる件数。SQLiteのバインド変数の上限（32766）を超えないようにする
+    BULK_UPSERT_BATCH_SIZE: int = 500
+    # エクスポート（GET /manga/export）で1回に読み込んで送る件数
+    MANGA_EXPORT_BATCH_SIZE: int = 1000
+    # ライブラリの統計（GET /manga/stats）を全件から集計し直す間隔（秒）。間の変更は書き込みのたびに差分で反映する
+    MANGA_STATS_REFRESH_SEC: float = 600.0
+    # ライブラリの統計で返す、よく使われるタグ・著者の件数
+    MANGA_STATS_TOP_N: int = 20
+
+    # --- チャット（LangGraph）の設定 ---
+    # 検索方式。"hybrid"はキーワード検索とベクトル検索を並列に実行し、"vector"はベクトル検索のみを行う
+    RETRIEVAL_MODE: Literal["hybrid", "vector"] = "hybrid"
+    # 検索結果の並び替え方式
+    # "llm": 全候補をLLMで並び替える / "rrf": RRFのみで並び替える / "rrf_llm": RRFの上位だけをLLMで並び替える
+    RANKER_MODE: Literal["llm", "rrf", "rrf_llm"] = "rrf_llm"
+    # "rrf_llm"でLLMに渡すRRF上位の件数
+    RANKER_LLM_TOP_N: int = 10
+    # ベクトル検索（Chroma）の問い合わせを実行する専用スレッドの数（イベントループと既定のスレッドプールを塞がない）
+    VECTOR_QUERY_WORKERS: int = 4
+    # RRFの定数k（大きいほど下位の順位も効く）
+    RRF_K: int = 60
+    # RRFの重み: キーワード検索(BM25)の順位
+    RRF_WEIGHT_KEYWORD: float = 1.0
+    # RRFの重み: ベクトル検索(距離)の順位
+    RRF_WEIGHT_VECTOR: float = 1.0
+    # RRFの重み: 作品の評価(score)の順位
+    RRF_WEIGHT_SCORE: float = 0.3
+    # RRFの重み: ユーザー評価(my_score)の順位
+    RRF_WEIGHT_MY_SCORE: float = 0.3
+    # 検索クエリ生成の結果をメモリに保持する件数の上限（正規化した入力をキーにする）
+    QUERY_EXPANSION_CACHE_SIZE: int = 1000
+    # 検索クエリ生成の結果の有効期限（秒）
+    QUERY_EXPANSION_CACHE_TTL_SEC: float = 60 * 60
+    # 短いキーワードの入力の扱い
+    # "llm": 常にLLMで展開する / "raw": 入力をそのまま検索する / "tags": 入力に一致するタグの語彙を加えて検索する
+    QUERY_EXPANSION_SHORT_MODE: Literal["llm", "raw", "tags"] = "tags"
+    # 短いキーワードとみなす入力の最大文字数
+    QUERY_EXPANSION_SHORT_MAX_CHARS: int = 8
+    # "tags"で加えるタグの最大数
+    QUERY_EXPANSION_MAX_TAGS: int = 4
+    # タグの語彙（ai_tagsの集計）を作り直す間隔（秒）
+    TAG_VOCABULARY_TTL_SEC: float = 300.0
+    # LLMに渡す検索結果（漫画情報）のトークン数の上限。順位の高い作品から詰める
+    CONTEXT_TOKEN_BUDGET: int = 4000
+    # LLMに渡す漫画情報1件あたりの、あらすじの最大文字数
+    CONTEXT_SYNOPSIS_MAX_CHARS: int = 200
+    # LLMに渡す漫画情報1件あたりの、AIによるおすすめポイントの最大文字数
+    CONTEXT_COMMENT_MAX_CHARS: int = 150
+    # LLMに渡す漫画情報1件あたりの、ユーザーの感想の最大文字数
+    CONTEXT_REVIEW_MAX_CHARS: int = 150
+    # 整形済みの漫画情報をメモリに保持する件数の上限
+    CONTEXT_SNIPPET_CACHE_SIZE: int = 5000
+    # 会話の履歴（要約済みの部分を除く）のトークン数がこれを超えたら、古いターンを要約する
+    HISTORY_TOKEN_THRESHOLD: int = 1500
+    # 要約せずにそのままLLMに渡す直近のメッセージ数（ユーザーとAIの2メッセージで1ターン）
+    HISTORY_KEEP_MESSAGES: int = 4
+    # 会話の履歴の要約の最大文字数の目安
+    HISTORY_SUMMARY_MAX_CHARS: int = 600
+    # グラフのノードが参照する漫画情報をメモリに保持する件数の上限
+    MANGA_CACHE_MAX_ENTRIES: int = 5000
+    # 会話の最初のメッセージに対する回答を、似た質問に再利用するかどうか（セマンティックキャッシュ）
+    SEMANTIC_CACHE_ENABLED: bool = True
+    # セマンティックキャッシュを使うコサイン類似度の下限（高いほど厳密）
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
+    # セマンティックキャッシュに保持する回答数の上限
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 1000
+    # セマンティックキャッシュの回答の有効期限（秒）
+    SEMANTIC_CACHE_TTL_SEC: float = 24 * 60 * 60
+
+    # --- 会話状態（チェックポイント）の保存の設定 ---
+    # 保存先。"sqlite"はファイルに保存し再起動後も引き継ぐ、"memory"はプロセス内のメモリに保存する（開発用）
+    CHECKPOINTER_BACKEND: Literal["sqlite", "memory"] = "sqlite"
+    # チェックポイントを保存するSQLiteファイルのパス
+    CHECKPOINT_DB_PATH: str = "./data/checkpoints.db"
+    # 最後に書き込まれてから会話を保持する秒数（超えたスレッドは削除）
+    CHECKPOINT_THREAD_TTL_SEC: float = 3 * 24 * 60 * 60
+    # 保持するスレッド数の上限（超えた分は最も長く使われていないものから削除）
+    CHECKPOINT_MAX_THREADS: int = 1000
+    # スレッドごとに保持するチェックポイント数の上限（1ターンで数件作成される）
+    CHECKPOINT_MAX_PER_THREAD: int = 20
+    # スレッドの削除と空き領域の解放を行う間隔（秒）
+    CHECKPOINT_MAINTENANCE_INTERVAL_SEC: float = 300.0
+
+    # --- ベクトルインデクサ（CRUDの変更をベクトルDBへ非同期に反映）の設定 ---
+    # 変更が落ち着くまで待つ秒数（連続した変更を1回の埋め込みにまとめる）
+    VECTOR_INDEXER_DEBOUNCE_SEC: float = 1.0
+    # 変更を溜めておく最大の秒数
+    VECTOR_INDEXER_MAX_DELAY_SEC: float = 5.0
+    # 1回に埋め込む件数の上限
+    VECTOR_INDEXER_BATCH_SIZE: int = 30
+
+    # --- シード処理（Jikan API取得・LLM加工）の設定 ---
+    # Jikan APIのベースURL（ベンチマーク時はローカルのスタブに差し替え可能）
+    JIKAN_BASE_URL: str = "https://api.jikan.moe/v4"
+    # Jikan APIへの1秒あたりのリクエスト数（トークンバケットの補充レート）
+    JIKAN_RATE_PER_SEC: float = 1.0
+    # Jikan APIへの瞬間的なリクエストの上限（トークンバケットの容量）
+    JIKAN_RATE_BURST: int = 3
+    # Jikan APIへの同時接続数の上限
+    JIKAN_MAX_CONNECTIONS: int = 5
+    # レビュー取得ステージの並列数
+    SEED_REVIEW_CONCURRENCY: int = 3
+    # LLM加工ステージでのLLM呼び出しの同時実行数
+    SEED_LLM_CONCURRENCY: int = 2
+    # ステージ間をつなぐキューの最大長
+    SEED_QUEUE_SIZE: int = 50
+
+    # --- チャットAPIの受け付け制御の設定 ---
+    # 同時に処理するチャットのリクエスト数の上限
+    CHAT_MAX_CONCURRENCY: int = 4
+    # 処理を待つチャットのリクエスト数の上限（超えた分は503ですぐに拒否）
+    CHAT_MAX_QUEUE: int = 16
+    # チャットのリクエストが処理を待つ時間の上限（秒）
+    CHAT_QUEUE_TIMEOUT_SEC: float = 15.0
+    # 拒否したリクエストに返すRetry-Afterの秒数
+    CHAT_RETRY_AFTER_SEC: int = 5
+
+    # --- LLMゲートウェイ（LLM・埋め込みの呼び出しの順番待ち）の設定 ---
+    # 全レーン合計の同時実行数の上限（Ollamaが同時に処理できる数に合わせる）
+    LLM_GATEWAY_MAX_CONCURRENCY: int = 2
+    # チャット（interactive）の同時実行数の上限
+    LLM_GATEWAY_INTERACTIVE_CONCURRENCY: int = 2
+    # シード・ベクトル同期など（batch）の同時実行数の上限。全体の上限より小さくし、チャット用の枠を残す
+    LLM_GATEWAY_BATCH_CONCURRENCY: int = 1
+    # クエリの埋め込みをまとめるために待つミリ秒（0でまとめない）
+    EMBEDDING_BATCH_WINDOW_MS: float = 10.0
+    # 1回にまとめて埋め込むクエリ数の上限
+    EMBEDDING_BATCH_MAX_SIZE: int = 32
+
+    # --- LLM応答・埋め込みキャッシュの設定 ---
+    # LLMの応答キャッシュを使うかどうか
+    LLM_CACHE_ENABLED: bool = True
+    # LLMの応答キャッシュを保存するSQLiteファイルのパス
+    LLM_CACHE_PATH: str = "./data/llm_cache.db"
+    # LLMの応答キャッシュに保持するエントリ数の上限（超えると最も古く使われたものから削除）
+    LLM_CACHE_MAX_ENTRIES: int = 20000
+    # 埋め込みキャッシュを保存するSQLiteファイルのパス
+    EMBEDDING_CACHE_PATH: str = "./data/embedding_cache.db"
+    # 埋め込みキャッシュに保持するエントリ数の上限
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 200000
+
     # .envファイルから環境変数を読み込むための設定
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
@@ -0,0 +1,72 @@
+"""
+LLMの応答を、モデル名・プロンプトテンプレート・入力のハッシュをキーにディスクへキャッシュします。
+同じ内容に対するLLM呼び出し（シードの再実行など）を省略するために使用します。
+"""
+import asyncio
+import hashlib
+import json
+from typing import Any, Type, TypeVar
+from pydantic import BaseModel
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate
+from app.core.cache import DiskLRUCache
+from app.core.config import settings
+
+OutputT = TypeVar("OutputT", bound=BaseModel)
+
+# LLMの応答キャッシュのインスタンス
+llm_cache = DiskLRUCache(settings.LLM_CACHE_PATH, "llm", settings.LLM_CACHE_MAX_ENTRIES)
+
+def _to_jsonable(obj: Any) -> Any:
+    """キャッシュキー作成時に、JSONにできない入力（メッセージなど）を変換します。"""
+    if isinstance(obj, BaseMessage):
+        return {"type": obj.type, "content": obj.content}
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    return str(obj)
+
+def get_model_name(llm) -> str:
+    """LLMのインスタンスからモデル名を取得します。"""
+    return getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+
+def make_cache_key(prompt: ChatPromptTemplate, llm, output_model: Type[BaseModel], inputs: dict) -> str:
+    """モデル名・プロンプトテンプレート・出力スキーマ・入力からキャッシュキーを作成します。"""
+    material = json.dumps(
+        {
+            "model": get_model_name(llm),
+            "prompt": prompt.pretty_repr(),
+            "output": output_model.model_json_schema(),
+            "inputs": inputs,
+        },
+        sort_keys=True, ensure_ascii=False, default=_to_jsonable
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def cached_structured_invoke(prompt: ChatPromptTemplate, llm, output_model: Type[OutputT], inputs: dict) -> OutputT:
+    """
+    `prompt | llm.with_structured_output(output_model)`を実行します。
+    同じ入力の結果がキャッシュにあれば、LLMを呼ばずにそれを返します。
+    """
+    chain = prompt | llm.with_structured_output(output_model)
+    if not settings.LLM_CACHE_ENABLED:
+        return chain.invoke(inputs)
+    key = make_cache_key(prompt, llm, output_model, inputs)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return output_model.model_validate_json(cached)
+    result = chain.invoke(inputs)
+    llm_cache.set(key, result.model_dump_json())
+    return result
+
+async def acached_structured_invoke(prompt: ChatPromptTemplate, llm, output_model: Type[OutputT], inputs: dict) -> OutputT:
+    """`cached_structured_invoke`の非同期版です。"""
+    chain = prompt | llm.with_structured_output(output_model)
+    if not settings.LLM_CACHE_ENABLED:
+        return await chain.ainvoke(inputs)
+    key = make_cache_key(prompt, llm, output_model, inputs)
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return output_model.model_validate_json(cached)
+    result = await chain.ainvoke(inputs)
+    await asyncio.to_thread(llm_cache.set, key, result.model_dump_json())
+    return result
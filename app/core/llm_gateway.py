@@ -0,0 +1,362 @@
+"""
+LLM・埋め込みモデルの呼び出しを、優先度付きのレーンで順番待ちさせてから実行するゲートウェイです。
+チャット（interactive）とシードやベクトル同期などのバックグラウンド処理（batch）が同じOllamaを共有しても、
+チャットの呼び出しを先に実行し、batchの同時実行数を抑えることでチャットの応答時間を守ります。
+
+呼び出しのレーンは`use_lane`で指定します（コンテキスト変数のため、asyncioのタスクや`asyncio.to_thread`にも引き継がれます）。
+ゲートウェイはスレッドのロックで管理するため、スレッドや別のイベントループ（シードのパイプラインなど）からも共有できます。
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableLambda
+from app.core.config import settings
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+# 優先度の高い順
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
+# 現在の呼び出しのレーン（既定はチャット用のinteractive）
+current_lane: ContextVar[str] = ContextVar("llm_lane", default=LANE_INTERACTIVE)
+
+@contextmanager
+def use_lane(lane: str):
+    """with文の中のLLM・埋め込みの呼び出しを、指定したレーンで実行します。"""
+    if lane not in LANES:
+        raise ValueError(f"不明なレーンです: {lane}")
+    token = current_lane.set(lane)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+class _Waiter:
+    """順番待ちしている1件の呼び出し。実行枠が割り当てられると`wake`が呼ばれます。"""
+    def __init__(self, lane: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+class LLMGateway:
+    """
+    優先度付きレーンでLLMの呼び出しの同時実行数を制御するゲートウェイ。
+    実行枠が空くと、interactiveの待ちを先に、batchの待ちを後に割り当てます（各レーンの中では先着順）。
+
+    Args:
+        max_concurrency (int): 全レーン合計の同時実行数の上限。
+        lane_limits (dict[str, int]): レーンごとの同時実行数の上限。
+    """
+    # 待ち時間の分位点の計算に使う、直近の待ち時間の件数
+    WAIT_SAMPLES = 500
+
+    def __init__(self, max_concurrency: int = settings.LLM_GATEWAY_MAX_CONCURRENCY,
+                 lane_limits: Optional[dict[str, int]] = None):
+        self.max_concurrency = max_concurrency
+        self.lane_limits = lane_limits or {
+            LANE_INTERACTIVE: settings.LLM_GATEWAY_INTERACTIVE_CONCURRENCY,
+            LANE_BATCH: settings.LLM_GATEWAY_BATCH_CONCURRENCY,
+        }
+        self._lock = threading.Lock()
+        self._queues: dict[str, deque[_Waiter]] = {lane: deque() for lane in LANES}
+        self._active = {lane: 0 for lane in LANES}
+        self._waits = {lane: deque(maxlen=self.WAIT_SAMPLES) for lane in LANES}
+        self._counts = {lane: {"completed": 0, "cancelled": 0} for lane in LANES}
+
+    def _dispatch(self) -> None:
+        """空いている実行枠を、優先度の高いレーンの待ちから順に割り当てます（ロックを取得して呼ぶこと）。"""
+        while sum(self._active.values()) < self.max_concurrency:
+            lane = next((l for l in LANES if self._queues[l] and self._active[l] < self.lane_limits[l]), None)
+            if lane is None:
+                return
+            waiter = self._queues[lane].popleft()
+            waiter.granted = True
+            self._active[lane] += 1
+            self._waits[lane].append(time.monotonic() - waiter.enqueued_at)
+            if waiter.loop is None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(self._wake_async, waiter)
+
+    def _wake_async(self, waiter: _Waiter) -> None:
+        # 割り当て前に待ちがキャンセルされていた場合は、実行枠をすぐに返す
+        if waiter.future.cancelled():
+            self.release(waiter.lane)
+        else:
+            waiter.future.set_result(None)
+
+    def acquire(self, lane: Optional[str] = None) -> str:
+        """実行枠が割り当てられるまでスレッドをブロックして待ちます。割り当てられたレーンを返します。"""
+        waiter = _Waiter(lane or current_lane.get())
+        with self._lock:
+            self._queues[waiter.lane].append(waiter)
+            self._dispatch()
+        waiter.event.wait()
+        return waiter.lane
+
+    async def aacquire(self, lane: Optional[str] = None) -> str:
+        """`acquire`の非同期版です。待っている間はイベントループをブロックしません。"""
+        waiter = _Waiter(lane or current_lane.get(), asyncio.get_running_loop())
+        with self._lock:
+            self._queues[waiter.lane].append(waiter)
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    self._queues[waiter.lane].remove(waiter)
+                    self._counts[waiter.lane]["cancelled"] += 1
+                elif not waiter.future.cancelled():
+                    # 割り当て後にキャンセルされた（キャンセル済みのfutureは_wake_asyncが返す）
+                    self._active[waiter.lane] -= 1
+                    self._counts[waiter.lane]["cancelled"] += 1
+                    self._dispatch()
+            raise
+        return waiter.lane
+
+    def release(self, lane: str) -> None:
+        """実行枠を返し、次の待ちに割り当てます。"""
+        with self._lock:
+            self._active[lane] -= 1
+            self._counts[lane]["completed"] += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane: Optional[str] = None):
+        """with文の間、実行枠を確保します。"""
+        acquired = self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+    @asynccontextmanager
+    async def aslot(self, lane: Optional[str] = None):
+        """`slot`の非同期版です。"""
+        acquired = await self.aacquire(lane)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+    def wrap(self, runnable: Runnable, name: str = "llm_gateway") -> Runnable:
+        """Runnableの呼び出しを、実行時のレーンの実行枠を確保してから行うようにラップします。"""
+        def call(inputs, config):
+            with self.slot():
+                return runnable.invoke(inputs, config)
+
+        async def acall(inputs, config):
+            async with self.aslot():
+                return await runnable.ainvoke(inputs, config)
+
+        return RunnableLambda(call, afunc=acall, name=name)
+
+    def stats(self) -> dict:
+        """レーンごとの待ち件数（キューの深さ）・実行中の件数・上限・待ち時間（平均・p95・最大）を返します。"""
+        with self._lock:
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self._waits[lane])
+                lanes[lane] = {
+                    "queue_depth": len(self._queues[lane]),
+                    "active": self._active[lane],
+                    "limit": self.lane_limits[lane],
+                    "wait_avg_sec": sum(waits) / len(waits) if waits else None,
+                    "wait_p95_sec": waits[int(len(waits) * 0.95) if len(waits) > 1 else 0] if waits else None,
+                    "wait_max_sec": waits[-1] if waits else None,
+                    **self._counts[lane],
+                }
+            return {"max_concurrency": self.max_concurrency, "lanes": lanes}
+
+class GatewayChatModel:
+    """
+    チャットモデルの呼び出しをゲートウェイ経由にするラッパー。
+    `invoke`・`ainvoke`・`with_structured_output`以外の属性（モデル名など）は元のモデルのものを返します。
+    """
+    def __init__(self, base, gateway: LLMGateway):
+        self.base = base
+        self.gateway = gateway
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def with_structured_output(self, schema, **kwargs) -> Runnable:
+        return self.gateway.wrap(self.base.with_structured_output(schema, **kwargs))
+
+    def invoke(self, inputs, config=None, **kwargs):
+        with self.gateway.slot():
+            return self.base.invoke(inputs, config, **kwargs)
+
+    async def ainvoke(self, inputs, config=None, **kwargs):
+        async with self.gateway.aslot():
+            return await self.base.ainvoke(inputs, config, **kwargs)
+
+class GatewayEmbeddings(Embeddings):
+    """
+    埋め込みモデルの呼び出しをゲートウェイ経由にするラッパー。
+    `batch_window_sec`が正の場合、短い間隔で届いたクエリの埋め込み（`embed_query`と`embed_queries`）を1回の`embed_documents`にまとめます。
+    非同期版（`aembed_query`と`aembed_queries`）はスレッドを使わず、イベントループごとに別にまとめます
+    （待ち時間の間、スレッドプールのスレッドを占有しないため）。
+    ドキュメントの埋め込み（`embed_documents`）はまとめません。
+
+    Args:
+        base (Embeddings): 元の埋め込みモデル。
+        gateway (LLMGateway): 呼び出しの順番待ちに使うゲートウェイ。
+        batch_window_sec (float): クエリをまとめるために待つ秒数（0でまとめない）。
+        max_batch_size (int): 1回にまとめるクエリ数の上限。
+    """
+    def __init__(self, base: Embeddings, gateway: LLMGateway,
+                 batch_window_sec: float = settings.EMBEDDING_BATCH_WINDOW_MS / 1000,
+                 max_batch_size: int = settings.EMBEDDING_BATCH_MAX_SIZE):
+        self.base = base
+        self.gateway = gateway
+        self.batch_window_sec = batch_window_sec
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        # まとめる前のクエリ [(テキスト, 結果を入れる辞書, 完了を知らせるEvent)]
+        self._pending: list[tuple[str, dict, threading.Event]] = []
+        # 非同期版のまとめる前のクエリ {イベントループ: [(テキスト, 結果を受け取るFuture)]}
+        self._apending: dict[asyncio.AbstractEventLoop, list[tuple[str, asyncio.Future]]] = {}
+        self._aflush_tasks: set[asyncio.Task] = set()
+        self._batches = 0
+        self._batched_queries = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self.gateway.slot():
+            return self.base.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        async with self.gateway.aslot():
+            return await self.base.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        if self.batch_window_sec <= 0:
+            with self.gateway.slot():
+                return self.base.embed_query(text)
+        return self.embed_queries([text])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        if self.batch_window_sec <= 0:
+            async with self.gateway.aslot():
+                return await self.base.aembed_query(text)
+        return (await self.aembed_queries([text]))[0]
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        複数のクエリを埋め込みます。
+        `batch_window_sec`が正の場合は、同じ時間帯に届いた他の呼び出し元のクエリと一緒に1回の`embed_documents`にまとめます。
+        """
+        if not texts:
+            return []
+        if self.batch_window_sec <= 0:
+            return self.embed_documents(texts)
+        entries = [(text, {}, threading.Event()) for text in texts]
+        with self._lock:
+            # 最初に届いた呼び出し元が、待ち時間の後にまとめて埋め込む
+            is_leader = not self._pending
+            self._pending.extend(entries)
+        if is_leader:
+            time.sleep(self.batch_window_sec)
+            self._flush()
+        vectors = []
+        for _, result, done in entries:
+            done.wait()
+            if "error" in result:
+                raise result["error"]
+            vectors.append(result["vector"])
+        return vectors
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        `embed_queries`の非同期版です。
+        同じイベントループで同じ時間帯に届いたクエリを、待ち時間の後に1つのタスクでまとめて埋め込みます。
+        """
+        if not texts:
+            return []
+        if self.batch_window_sec <= 0:
+            return await self.aembed_documents(texts)
+        loop = asyncio.get_running_loop()
+        entries = [(text, loop.create_future()) for text in texts]
+        # 最初に届いた呼び出し元が、まとめて埋め込むタスクを開始する（呼び出し元がキャンセルされても他の呼び出し元の分は続ける）
+        is_leader = loop not in self._apending
+        self._apending.setdefault(loop, []).extend(entries)
+        if is_leader:
+            task = loop.create_task(self._aflush(loop))
+            self._aflush_tasks.add(task)
+            task.add_done_callback(self._aflush_tasks.discard)
+        return list(await asyncio.gather(*(future for _, future in entries)))
+
+    async def _aflush(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            await asyncio.sleep(self.batch_window_sec)
+            while pending := self._apending.get(loop):
+                batch = pending[:self.max_batch_size]
+                del pending[:self.max_batch_size]
+                try:
+                    async with self.gateway.aslot():
+                        vectors = await self.base.aembed_documents([text for text, _ in batch])
+                    for (_, future), vector in zip(batch, vectors):
+                        if not future.done():
+                            future.set_result(vector)
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                except BaseException:
+                    for _, future in batch:
+                        future.cancel()
+                    raise
+                with self._lock:
+                    self._batches += 1
+                    self._batched_queries += len(batch)
+        finally:
+            # 中断された場合も、結果を待ったままの呼び出し元を残さない
+            for _, future in self._apending.pop(loop, []):
+                future.cancel()
+
+    def _flush(self) -> None:
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            if not batch:
+                return
+            try:
+                with self.gateway.slot():
+                    vectors = self.base.embed_documents([text for text, _, _ in batch])
+                for (_, result, _), vector in zip(batch, vectors):
+                    result["vector"] = vector
+            except Exception as e:
+                for _, result, _ in batch:
+                    result["error"] = e
+            with self._lock:
+                self._batches += 1
+                self._batched_queries += len(batch)
+            for _, _, done in batch:
+                done.set()
+
+    def stats(self) -> dict:
+        """まとめて埋め込んだ回数とクエリ数を返します。"""
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "batched_queries": self._batched_queries,
+                "avg_batch_size": self._batched_queries / self._batches if self._batches else None,
+            }
+
+# アプリ全体で共有するゲートウェイのインスタンス
+llm_gateway = LLMGateway()
+
+def get_llm_gateway() -> LLMGateway:
+    """FastAPIのDI(依存性注入)で、LLMゲートウェイを取得するための関数。"""
+    return llm_gateway
@@ -0,0 +1,29 @@
+"""
+一覧・検索APIのカーソル（次のページの開始位置）を定義します。
+カーソルは最後に返した行の並び替えのキー（値とID）をJSONにして、URLセーフなBase64で符号化した文字列です。
+OFFSETを使わずに「そのキーより後ろ」の行を取得する（キーセットページネーション）ため、深いページでも速度が落ちません。
+"""
+import base64
+import binascii
+import json
+
+def encode_cursor(position: dict) -> str:
+    """並び替えのキーなどの位置情報を、カーソル文字列に符号化します。"""
+    raw = json.dumps(position, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    カーソル文字列を位置情報に復号します。
+
+    Raises:
+        ValueError: カーソルの形式が正しくない場合。
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"カーソルの形式が正しくありません: {cursor}") from e
+    if not isinstance(position, dict):
+        raise ValueError(f"カーソルの形式が正しくありません: {cursor}")
+    return position
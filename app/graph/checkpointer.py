@@ -0,0 +1,405 @@
+"""
+LangGraphの会話状態（チェックポイント）を保存するチェックポインタを定義します。
+デフォルトはSQLiteファイルに保存し、プロセスの再起動後やuvicornの複数ワーカー間でも会話を引き継げます。
+使われなくなったスレッドの削除（TTL・LRU）、スレッドごとのチェックポイント数の上限、
+削除後の領域の解放（コンパクション）を行い、保存サイズが際限なく増えないようにします。
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any, List, Optional
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.memory import InMemorySaver
+from app.core.config import settings
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver[str]):
+    """
+    SQLiteファイルにチェックポイントを保存するチェックポインタ。
+
+    - 最後に書き込まれてから`thread_ttl_sec`秒経ったスレッドと、`max_threads`を超えた分の古いスレッドを削除します。
+    - スレッドごとに新しい方から`max_checkpoints_per_thread`件のチェックポイントだけを残します。
+    - 削除の後は空き領域をファイルから解放します。
+    これらの保守処理は、保存時に`maintenance_interval_sec`秒に1回まとめて行います。
+
+    Args:
+        path (str): 保存先のSQLiteファイルのパス。
+        thread_ttl_sec (float): スレッドを保持する秒数（最後に書き込まれてから）。
+        max_threads (int): 保持するスレッド数の上限。
+        max_checkpoints_per_thread (int): スレッドごとに保持するチェックポイント数の上限。
+        maintenance_interval_sec (float): 保守処理を行う間隔（秒）。
+    """
+    def __init__(self, path: str,
+                 thread_ttl_sec: float = settings.CHECKPOINT_THREAD_TTL_SEC,
+                 max_threads: int = settings.CHECKPOINT_MAX_THREADS,
+                 max_checkpoints_per_thread: int = settings.CHECKPOINT_MAX_PER_THREAD,
+                 maintenance_interval_sec: float = settings.CHECKPOINT_MAINTENANCE_INTERVAL_SEC):
+        super().__init__()
+        self.path = path
+        self.thread_ttl_sec = thread_ttl_sec
+        self.max_threads = max_threads
+        self.max_checkpoints_per_thread = max_checkpoints_per_thread
+        self.maintenance_interval_sec = maintenance_interval_sec
+        self._last_maintenance_at = time.monotonic()
+        self._stats = {"evicted_threads": 0, "pruned_checkpoints": 0, "compactions": 0}
+        self._pruned_since_compaction = 0
+        # ターン内のステップごとのチェックポイントのサイズ（バイト数）の集計 {(source, ターン内のステップ): {"count", "total_bytes", "max_bytes"}}
+        # metadataのstepはスレッドの会話が続く限り増え続けるため、ターン（入力のチェックポイント）からの差をキーにする
+        self._size_by_turn_step: dict[tuple[str, int], dict] = {}
+        # スレッドごとの、現在のターンの入力のチェックポイントのstep
+        self._turn_start_step: dict[str, int] = {}
+        self._last_checkpoint_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # 削除した領域をVACUUMせずに少しずつ解放できるよう、テーブル作成前にauto_vacuumを設定する
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # 複数のワーカーから同時に書き込まれた場合はロックの解放を待つ
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoint_thread (
+                thread_id TEXT PRIMARY KEY,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_checkpoint_thread_accessed_at ON checkpoint_thread (accessed_at);
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_write (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+        """)
+
+    # --- 読み込み ---
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row: tuple) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM checkpoint_write "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id)
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """指定されたチェックポイント（IDが無い場合はスレッドの最新のもの）を取得します。"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        columns = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+        with self._lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoint WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id)
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoint WHERE thread_id = ? AND checkpoint_ns = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns)
+                ).fetchone()
+            if row is None:
+                return None
+            return self._to_tuple(thread_id, checkpoint_ns, row)
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        """条件に合うチェックポイントを新しい順に返します。"""
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+                f"FROM checkpoint {where} ORDER BY checkpoint_id DESC",
+                params
+            ).fetchall()
+            tuples = []
+            for thread_id, checkpoint_ns, *row in rows:
+                if limit is not None and len(tuples) >= limit:
+                    break
+                checkpoint_tuple = self._to_tuple(thread_id, checkpoint_ns, tuple(row))
+                # メタデータでの絞り込み
+                if filter and not all(checkpoint_tuple.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                tuples.append(checkpoint_tuple)
+        yield from tuples
+
+    # --- 書き込み ---
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        """チェックポイントを保存し、スレッドごとの上限を超えた古いチェックポイントを削除します。"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, serialized = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO checkpoint (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+                    "type, checkpoint, metadata_type, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                     type_, serialized, metadata_type, serialized_metadata)
+                )
+                self._touch(thread_id)
+                self._prune_thread(thread_id, checkpoint_ns)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._record_size(thread_id, metadata, len(serialized) + len(serialized_metadata))
+            self._maybe_run_maintenance()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        """ノードの途中の書き込み（pending writes）を保存します。"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 特殊なチャネル（エラー・割り込みなど）は上書きし、通常の書き込みは最初のものを残す
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, type_, serialized, task_path))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    f"{verb} INTO checkpoint_write (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, "
+                    "channel, type, value, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._touch(thread_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_thread(self, thread_id: str) -> None:
+        """スレッドのチェックポイントと書き込みを全て削除します。"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete_threads([thread_id])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # InMemorySaverと同じ形式（連番 + 乱数）のバージョン文字列
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # --- 非同期版（ブロッキングなSQLiteアクセスはスレッドで実行） ---
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        tuples = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    # --- 保守処理（ロックを取得した状態で呼び出す） ---
+
+    def _touch(self, thread_id: str) -> None:
+        """
+        スレッドの最終使用時刻を更新します。書き込み（put / put_writes）のトランザクションの中で呼び出します。
+        読み込みでは更新しないため、会話の取得だけではディスクへの書き込みが発生しません（ターンごとに必ず書き込みがあるため十分です）。
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO checkpoint_thread (thread_id, accessed_at) VALUES (?, ?)",
+            (thread_id, time.time())
+        )
+
+    def _prune_thread(self, thread_id: str, checkpoint_ns: str) -> None:
+        """スレッドのチェックポイントを新しい方から上限件数だけ残し、古いものとその書き込みを削除します。"""
+        stale_ids = [row[0] for row in self._conn.execute(
+            "SELECT checkpoint_id FROM checkpoint WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.max_checkpoints_per_thread)
+        )]
+        if not stale_ids:
+            return
+        placeholders = ",".join("?" * len(stale_ids))
+        for table in ("checkpoint", "checkpoint_write"):
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id IN ({placeholders})",
+                (thread_id, checkpoint_ns, *stale_ids)
+            )
+        self._stats["pruned_checkpoints"] += len(stale_ids)
+        self._pruned_since_compaction += len(stale_ids)
+
+    def _record_size(self, thread_id: str, metadata: CheckpointMetadata, size: int) -> None:
+        """
+        保存したチェックポイントのサイズを、source（input / loop / update）とターン内のステップごとに集計します。
+        ターン内のステップはグラフのノード数で決まるため、会話が続いても集計のキーは増えません。
+        """
+        source = metadata.get("source", "unknown")
+        step = metadata.get("step", -1)
+        if source == "input":
+            self._turn_start_step[thread_id] = step
+        # プロセスの再起動直後などでターンの開始が分からない場合は、ステップを区別せずに集計する
+        start = self._turn_start_step.get(thread_id)
+        key = (source, step - start if start is not None else -1)
+        entry = self._size_by_turn_step.setdefault(key, {"count": 0, "total_bytes": 0, "max_bytes": 0})
+        entry["count"] += 1
+        entry["total_bytes"] += size
+        entry["max_bytes"] = max(entry["max_bytes"], size)
+        self._last_checkpoint_bytes = size
+
+    def _delete_threads(self, thread_ids: List[str]) -> None:
+        for thread_id in thread_ids:
+            self._turn_start_step.pop(thread_id, None)
+            for table in ("checkpoint", "checkpoint_write", "checkpoint_thread"):
+                self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def _maybe_run_maintenance(self) -> None:
+        if time.monotonic() - self._last_maintenance_at >= self.maintenance_interval_sec:
+            self._run_maintenance()
+
+    def _run_maintenance(self) -> int:
+        """期限切れ・上限超過のスレッドを削除し、削除した場合は空き領域を解放します。削除したスレッド数を返します。"""
+        self._last_maintenance_at = time.monotonic()
+        expired = [row[0] for row in self._conn.execute(
+            "SELECT thread_id FROM checkpoint_thread WHERE accessed_at < ?", (time.time() - self.thread_ttl_sec,)
+        )]
+        overflow = [row[0] for row in self._conn.execute(
+            "SELECT thread_id FROM checkpoint_thread WHERE accessed_at >= ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?",
+            (time.time() - self.thread_ttl_sec, self.max_threads)
+        )]
+        evicted = expired + overflow
+        if evicted:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete_threads(evicted)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._stats["evicted_threads"] += len(evicted)
+        if evicted or self._pruned_since_compaction:
+            self._compact()
+        return len(evicted)
+
+    def _compact(self) -> None:
+        """削除で空いたページを解放し、WALをデータベースファイルに書き戻してファイルを縮めます。"""
+        # incremental_vacuumは1ステップで1ページしか解放しないため、最後まで実行されるexecutescriptで呼ぶ
+        self._conn.executescript("PRAGMA incremental_vacuum;")
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._pruned_since_compaction = 0
+        self._stats["compactions"] += 1
+
+    def run_maintenance(self) -> int:
+        """保守処理（スレッドの削除とコンパクション）を今すぐ実行します。削除したスレッド数を返します。"""
+        with self._lock:
+            return self._run_maintenance()
+
+    def stats(self) -> dict:
+        """スレッド数・チェックポイント数・ファイルサイズ、ターン内のステップごとのチェックポイントのサイズと、保守処理の実行回数を返します。"""
+        with self._lock:
+            (threads,) = self._conn.execute("SELECT COUNT(*) FROM checkpoint_thread").fetchone()
+            (checkpoints,) = self._conn.execute("SELECT COUNT(*) FROM checkpoint").fetchone()
+            (page_count,) = self._conn.execute("PRAGMA page_count").fetchone()
+            (page_size,) = self._conn.execute("PRAGMA page_size").fetchone()
+            size_by_turn_step = {
+                f"{source}:{step}": {"count": e["count"], "avg_bytes": e["total_bytes"] / e["count"], "max_bytes": e["max_bytes"]}
+                for (source, step), e in sorted(self._size_by_turn_step.items())
+            }
+        return {
+            "backend": "sqlite",
+            "threads": threads,
+            "checkpoints": checkpoints,
+            "db_bytes": page_count * page_size,
+            "last_checkpoint_bytes": self._last_checkpoint_bytes,
+            "checkpoint_bytes_by_turn_step": size_by_turn_step,
+            **self._stats,
+        }
+
+def create_checkpointer(backend: str = settings.CHECKPOINTER_BACKEND) -> BaseCheckpointSaver:
+    """
+    設定に応じたチェックポインタを作成します。
+
+    Args:
+        backend (str): "sqlite"（ファイルに保存）または "memory"（プロセス内のメモリに保存。開発用）
+    """
+    if backend == "memory":
+        return InMemorySaver()
+    return SQLiteCheckpointSaver(settings.CHECKPOINT_DB_PATH)
@@ -0,0 +1,124 @@
+"""
+検索結果の漫画情報を、LLMに渡すためのコンパクトなテキストに整形します。
+1件ごとに長い項目を切り詰め、順位の高い作品からトークン数の上限まで詰めることで、
+プロンプトを小さくし、応答開始までの時間とLLMのコンテキスト長（num_ctx）を抑えます。
+"""
+from typing import Optional
+from langchain_core.messages import BaseMessage
+from app.core.cache import LRUCache
+from app.core.config import settings
+
+# 整形済みの漫画情報のキャッシュ。(ID, 更新日時)をキーにするため、漫画が更新されると自動的に作り直される
+snippet_cache = LRUCache(settings.CONTEXT_SNIPPET_CACHE_SIZE)
+
+# build_llm_contextで作成したテキストの見方（プロンプトの【結果の見方】に渡す）
+CONTEXT_DESCRIPTION = "\n".join([
+    "- 1作品ごとに空行で区切られています",
+    "- [ID:数字] の後にタイトル、以降の行は「項目名: 値」の形式です",
+    "- 著者 / 連載誌 / 状態: 漫画の著者・連載誌・ステータス（「Finished」など）",
+    "- 評価: 漫画の評価",
+    "- ユーザー: ユーザー管理のステータス（「読みたい」「読んでいる」「読み終えた」）、ユーザーの評価、ユーザーの感想",
+    "- タグ: AIによるタグ",
+    "- あらすじ: 漫画のあらすじ（長い場合は途中で省略し「…」で終わります）",
+    "- おすすめ: AIによるおすすめポイント",
+])
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算します。
+    日本語などの非ASCII文字は1文字1トークン、ASCII文字は4文字で1トークンとして数えます。
+    """
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def truncate(text: Optional[str], max_chars: int) -> Optional[str]:
+    """テキストを最大文字数で切り詰めます。改行は空白にまとめます。"""
+    if not text:
+        return None
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + "…"
+
+def render_manga_snippet(manga: dict) -> str:
+    """漫画1件分の情報を、値のある項目だけのコンパクトなテキストにします。"""
+    lines = [f"[ID:{manga['id']}] {manga.get('title') or '（タイトル不明）'}"]
+    info = [
+        f"{label}: {manga[key]}" for key, label in (("author", "著者"), ("serialization", "連載誌"), ("status", "状態"), ("score", "評価"))
+        if manga.get(key) not in (None, "")
+    ]
+    if info:
+        lines.append(" / ".join(info))
+    user = [v for v in (
+        manga.get("my_status"),
+        f"評価{manga['my_score']}" if manga.get("my_score") is not None else None,
+        truncate(manga.get("my_review"), settings.CONTEXT_REVIEW_MAX_CHARS),
+    ) if v]
+    if user:
+        lines.append("ユーザー: " + " / ".join(user))
+    for key, label, max_chars in (
+        ("ai_tags", "タグ", None),
+        ("synopsis", "あらすじ", settings.CONTEXT_SYNOPSIS_MAX_CHARS),
+        ("ai_comment", "おすすめ", settings.CONTEXT_COMMENT_MAX_CHARS),
+    ):
+        value = manga.get(key) if max_chars is None else truncate(manga.get(key), max_chars)
+        if value:
+            lines.append(f"{label}: {value}")
+    return "\n".join(lines)
+
+def get_manga_snippet(manga: dict) -> str:
+    """漫画1件分の整形済みテキストを、キャッシュを使って取得します。"""
+    key = (manga["id"], manga.get("updated_at"))
+    snippet = snippet_cache.get(key)
+    if snippet is None:
+        snippet = render_manga_snippet(manga)
+        snippet_cache.set(key, snippet)
+    return snippet
+
+def build_llm_context(manga_list: list[dict], token_budget: int = settings.CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    検索結果を、渡された順（順位の高い順）にトークン数の上限まで詰めたテキストにします。
+    上限を超える作品は含めません。ただし1件目は上限を超えていても必ず含めます。
+
+    Args:
+        manga_list (list[dict]): 漫画情報の辞書のリスト（順位の高い順）
+        token_budget (int): トークン数の上限
+
+    Returns:
+        str: LLMに渡すテキスト。検索結果が無い場合は「該当する漫画はありません」
+    """
+    snippets = []
+    used_tokens = 0
+    for manga in manga_list:
+        snippet = get_manga_snippet(manga)
+        tokens = estimate_tokens(snippet)
+        if snippets and used_tokens + tokens > token_budget:
+            break
+        snippets.append(snippet)
+        used_tokens += tokens
+    return "\n\n".join(snippets) if snippets else "該当する漫画はありません"
+
+def estimate_messages_tokens(messages: list[BaseMessage]) -> int:
+    """メッセージのリストのトークン数を概算します。"""
+    return sum(estimate_tokens(str(m.content)) for m in messages)
+
+def split_history(messages: list[BaseMessage], summarized_count: int,
+                  keep_messages: int = settings.HISTORY_KEEP_MESSAGES) -> tuple[list[BaseMessage], list[BaseMessage]]:
+    """
+    今回のメッセージを除いた会話の履歴のうち、要約されていない部分を、
+    要約する古いメッセージと、そのまま渡す直近のメッセージに分けます。
+
+    Args:
+        messages (list[BaseMessage]): 今回のユーザーのメッセージを末尾に含む、会話の全メッセージ
+        summarized_count (int): 先頭から数えて要約済みのメッセージ数
+        keep_messages (int): そのまま渡す直近のメッセージ数
+
+    Returns:
+        tuple[list[BaseMessage], list[BaseMessage]]: (要約する古いメッセージ, そのまま渡す直近のメッセージ)
+    """
+    history = messages[summarized_count:-1]
+    if keep_messages <= 0:
+        return history, []
+    if len(history) <= keep_messages:
+        return [], history
+    return history[:-keep_messages], history[-keep_messages:]
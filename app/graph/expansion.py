@@ -0,0 +1,123 @@
+"""
+検索クエリ生成（query_expansion_node）のキャッシュと、LLMを使わない高速な展開を定義します。
+同じ入力に対する展開結果は正規化した入力をキーにメモリへキャッシュし、
+短いキーワードの入力はLLMを呼ばずに、そのまま、またはタグの語彙から展開します。
+"""
+import threading
+import time
+import unicodedata
+from typing import Optional
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.core.cache import LRUCache
+from app.core.config import settings
+from app.models.manga import engine, async_engine
+from app.services.manga import MangaService, AsyncMangaService
+
+# 正規化した入力 -> 検索クエリのリスト
+expansion_cache = LRUCache(settings.QUERY_EXPANSION_CACHE_SIZE, settings.QUERY_EXPANSION_CACHE_TTL_SEC)
+
+# 短いキーワードの末尾から取り除く語（「泣ける漫画」->「泣ける」）。検索ではノイズになるため
+KEYWORD_SUFFIXES = ("の漫画", "のマンガ", "の作品", "漫画", "マンガ", "まんが", "作品")
+
+def normalize_query(text: str) -> str:
+    """入力をNFKCで正規化し（全角英数字・半角カナなどを統一）、空白をまとめます。"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def cache_key(text: str) -> str:
+    """展開結果のキャッシュキー。正規化した入力の大文字・小文字の違いも無視します。"""
+    return normalize_query(text).casefold()
+
+def strip_keyword_suffix(keyword: str) -> str:
+    """キーワードの末尾の「漫画」などを取り除きます。取り除くと空になる場合はそのまま返します。"""
+    for suffix in KEYWORD_SUFFIXES:
+        if keyword.endswith(suffix) and len(keyword) > len(suffix):
+            return keyword[:-len(suffix)]
+    return keyword
+
+def is_short_keyword(normalized: str) -> bool:
+    """LLMで展開せずに済む短いキーワードかどうかを判定します（文章や質問は対象外）。"""
+    if len(normalized) > settings.QUERY_EXPANSION_SHORT_MAX_CHARS:
+        return False
+    return not any(mark in normalized for mark in ("?", "。", "!", "、"))
+
+class TagVocabulary:
+    """
+    漫画の`ai_tags`から作るタグの語彙。作成に全件の走査が必要なため、一定時間ごとに作り直します。
+
+    Args:
+        ttl_sec (float): 語彙を作り直すまでの秒数。
+    """
+    def __init__(self, ttl_sec: float = settings.TAG_VOCABULARY_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._tags: list[str] = []  # 漫画の件数の多い順
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get_tags(self) -> list[str]:
+        """タグを漫画の件数の多い順に返します。"""
+        with self._lock:
+            if self._is_stale():
+                with Session(engine) as session:
+                    self._set_counts(MangaService(session).get_ai_tag_counts())
+            return self._tags
+
+    async def aget_tags(self) -> list[str]:
+        """`get_tags`の非同期版です。語彙の作り直しは非同期エンジンで読み込みます。"""
+        if self._is_stale():
+            async with AsyncSession(async_engine) as session:
+                counts = await AsyncMangaService(session).get_ai_tag_counts()
+            with self._lock:
+                self._set_counts(counts)
+        return self._tags
+
+    def _is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl_sec
+
+    def _set_counts(self, counts: dict[str, int]) -> None:
+        self._tags = sorted(counts, key=counts.get, reverse=True)
+        self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _match(tags: list[str], keyword: str, limit: int) -> list[str]:
+        folded = keyword.casefold()
+        return [tag for tag in tags if folded in tag.casefold() or tag.casefold() in folded][:limit]
+
+    def match(self, keyword: str, limit: int) -> list[str]:
+        """キーワードを含む、またはキーワードに含まれるタグを、件数の多い順に最大limit件返します。"""
+        return self._match(self.get_tags(), keyword, limit)
+
+    async def amatch(self, keyword: str, limit: int) -> list[str]:
+        """`match`の非同期版です。"""
+        return self._match(await self.aget_tags(), keyword, limit)
+
+# アプリ全体で共有するタグの語彙のインスタンス
+tag_vocabulary = TagVocabulary()
+
+def _local_keyword(user_input: str, mode: str) -> Optional[str]:
+    """LLMを使わずに展開できる入力であれば、末尾の「漫画」などを取り除いたキーワードを返します。"""
+    normalized = normalize_query(user_input)
+    if mode == "llm" or not normalized or not is_short_keyword(normalized):
+        return None
+    return strip_keyword_suffix(normalized)
+
+def expand_locally(user_input: str, mode: str = settings.QUERY_EXPANSION_SHORT_MODE) -> Optional[list[str]]:
+    """
+    短いキーワードの入力を、LLMを使わずに検索クエリへ展開します。
+    対象外の入力（長い文章など）や、modeが"llm"の場合はNoneを返します。
+
+    Args:
+        user_input (str): ユーザーの入力。
+        mode (str): "raw"は入力をそのまま使い、"tags"は入力に一致するタグを加えます。
+    """
+    keyword = _local_keyword(user_input, mode)
+    if keyword is None or mode == "raw":
+        return None if keyword is None else [keyword]
+    return list(dict.fromkeys([keyword] + tag_vocabulary.match(keyword, settings.QUERY_EXPANSION_MAX_TAGS)))
+
+async def aexpand_locally(user_input: str, mode: str = settings.QUERY_EXPANSION_SHORT_MODE) -> Optional[list[str]]:
+    """`expand_locally`の非同期版です。"""
+    keyword = _local_keyword(user_input, mode)
+    if keyword is None or mode == "raw":
+        return None if keyword is None else [keyword]
+    return list(dict.fromkeys([keyword] + await tag_vocabulary.amatch(keyword, settings.QUERY_EXPANSION_MAX_TAGS)))
@@ -1,35 +1,55 @@
+import operator
 from langchain_ollama import ChatOllama
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
-from langchain_core.messages import BaseMessage, AIMessage
+from langchain_core.messages import BaseMessage, AIMessage, SystemMessage
 from langgraph.graph import START, END
 from langgraph.graph.message import add_messages
+from langgraph.types import Overwrite
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
 from typing import TypedDict, Annotated, List, Optional
 from pydantic import BaseModel, Field
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from app.core.config import settings
-from app.models.manga import engine, MangaSearchKeywordParams, MangaSearchVectorParams, MangaForLLM, to_llm_data, get_llm_description
-from app.services.manga import MangaService
+from app.core.llm_cache import cached_structured_invoke, acached_structured_invoke
+from app.core.llm_gateway import llm_gateway, GatewayChatModel
+from app.models.manga import engine, async_engine
+from app.services.manga import MangaService, AsyncMangaService
+from app.services.manga_cache import manga_cache
+from app.graph.ranking import fuse_candidates
+from app.graph.context import build_llm_context, CONTEXT_DESCRIPTION, estimate_messages_tokens, split_history
+from app.graph.expansion import expansion_cache, cache_key, expand_locally, aexpand_locally
 from app.models.chroma import vectorDB
 
 def merge_ids(old_lists: list[int], new_lists: Optional[list[int]] = None) -> list:
-    return list(set((old_lists or []) + (new_lists or [])))
+    # 順序を保ったまま重複を排除（並列に実行された検索ノードの結果を統合するReducerとしても使用）
+    return list(dict.fromkeys((old_lists or []) + (new_lists or [])))
 
 def add_ids(old_lists: list[int], new_lists: Optional[list[int]] = None) -> list:
     return list(((old_lists or []) + (new_lists or [])))
 
 def merge_dicts(old_lists: list[dict], new_lists: Optional[list[dict]] = None) -> list[dict]:
     # IDをキーにして辞書にまとめることで重複を排除
-    merged = {m["id"]: m for m in (old_lists or []+ new_lists or [])}
+    merged = {m["id"]: m for m in (old_lists or []) + (new_lists or [])}
     return list(merged.values())
 
 class State(TypedDict):
     messages: Annotated[list[BaseMessage], add_messages]
-    found_manga_ids: List[int]
+    # 検索ノードが並列に書き込むため、Reducerで統合する
+    # 値を置き換えたい場合（ターンの開始時・ランキング後）はOverwriteで渡す
+    found_manga_ids: Annotated[List[int], merge_ids]
     search_queries: List[str]
-    llm_contexts: List[dict]
+    # 検索ノードが記録するクエリごとの順位 {"source": "keyword" | "vector", "ids": [...]}（RRFで使用）
+    ranked_lists: Annotated[List[dict], operator.add]
+    # ランキング後の候補 {"id": 漫画ID, "score": ランキングのスコア} の順位順のリスト
+    # チェックポイントを小さく保つため、状態にはIDとスコアだけを持たせ、本文はmanga_cacheから取り出す
+    candidates: List[dict]
+    # 古い会話の要約と、メッセージの先頭から数えて要約済みの数（history_compaction_nodeが更新する）
+    # chatbot_nodeには要約と、要約されていない直近のメッセージだけを渡す
+    history_summary: str
+    summarized_count: int
     next_step: str
     retry_count: int
 
@@ -44,113 +64,280 @@ def get_llm(model_type="ollama"):
         return ChatOllama(
             model=settings.OLLAMA_MODEL, 
             base_url=settings.OLLAMA_BASE_URL, 
-            num_ctx=40960, 
+            num_ctx=settings.OLLAMA_NUM_CTX, 
             temperature=0
         )
 
-llm = get_llm(settings.LLM_TYPE)
+# 呼び出しはLLMゲートウェイ経由で行う（レーンは呼び出し元のuse_lane、既定はチャット用のinteractive）
+llm = GatewayChatModel(get_llm(settings.LLM_TYPE), llm_gateway)
 
 class SearchQueryExpansionOutput(BaseModel):
     search_queries: List[str] = Field(description="SQL検索用の単語")
 
+EXPANSION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+     あなたは漫画データベースの検索クエリ生成の専門家です。ユーザーの要望を分析し、関連するキーワードを3〜5個生成してください。
+     検索はキーワード検索とベクトル検索をどちらも行います。単語のみのキーワードと短文のキーワードの双方を織り交ぜてください。
+     ユーザーの要望から漫画の持つ微妙なニュアンスを表現する多様なキーワードを生成してください。
+     注意: 「〇〇の漫画」「〇〇漫画」というキーワードは絶対に作らないでください。
+     """),
+    ("human", "要望: {user_input}")
+])
+
+def expand_query_by_llm(user_input: str) -> list[str]:
+    """ユーザーの要望から、LLMで検索クエリを3〜5個生成します。"""
+    chain = EXPANSION_PROMPT | llm.with_structured_output(SearchQueryExpansionOutput)
+    return chain.invoke({"user_input": user_input}).search_queries
+
+async def aexpand_query_by_llm(user_input: str) -> list[str]:
+    """`expand_query_by_llm`の非同期版です。"""
+    chain = EXPANSION_PROMPT | llm.with_structured_output(SearchQueryExpansionOutput)
+    return (await chain.ainvoke({"user_input": user_input})).search_queries
+
+def _expansion_update(search_queries: list[str]) -> dict:
+    # 前のターンの検索結果を引き継がないよう、検索結果をリセットする
+    return {
+        "search_queries": search_queries,
+        "found_manga_ids": Overwrite([]),
+        "ranked_lists": Overwrite([]),
+        "candidates": []
+    }
+
 def query_expansion_node(state: State):
     user_input = state["messages"][-1].content
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """
-         あなたは漫画データベースの検索クエリ生成の専門家です。ユーザーの要望を分析し、関連するキーワードを3〜5個生成してください。
-         検索はキーワード検索とベクトル検索をどちらも行います。単語のみのキーワードと短文のキーワードの双方を織り交ぜてください。
-         ユーザーの要望から漫画の持つ微妙なニュアンスを表現する多様なキーワードを生成してください。
-         注意: 「〇〇の漫画」「〇〇漫画」というキーワードは絶対に作らないでください。
-         """),
-        ("human", "要望: {user_input}")
-    ])
-
-    chain = prompt | llm.with_structured_output(SearchQueryExpansionOutput)
-    response_text = chain.invoke({"user_input": user_input})
-    
-    return {"search_queries": response_text.search_queries}
+    # 同じ入力（正規化後）の展開結果はキャッシュを使い、短いキーワードはLLMを呼ばずに展開する
+    key = cache_key(user_input)
+    search_queries = expansion_cache.get(key)
+    if search_queries is None:
+        search_queries = expand_locally(user_input) or expand_query_by_llm(user_input)
+        expansion_cache.set(key, search_queries)
+    return _expansion_update(search_queries)
+
+async def aquery_expansion_node(state: State):
+    user_input = state["messages"][-1].content
+    key = cache_key(user_input)
+    search_queries = expansion_cache.get(key)
+    if search_queries is None:
+        search_queries = await aexpand_locally(user_input) or await aexpand_query_by_llm(user_input)
+        expansion_cache.set(key, search_queries)
+    return _expansion_update(search_queries)
 
 
 class RankingResultsOutput(BaseModel):
     ranking_ids: List[int] = Field(description="関連順に並んだ漫画のIDのリスト")
-    
+
+RANKING_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "あなたは漫画の目利きです。提示された漫画リストをユーザーの要望に合致している順に並び替えてください。"),
+    ("human", "要望: \n{user_input}\n\n【検索結果】\n{contexts}\n\n【結果の見方】\n{contexts_description}")
+])
+
+def _ranking_inputs(user_input: str, manga_list: list[dict]) -> dict:
+    return {"user_input": user_input, "contexts": build_llm_context(manga_list), "contexts_description": CONTEXT_DESCRIPTION}
+
+def _valid_ranked_ids(response: RankingResultsOutput, manga_list: list[dict]) -> list[int]:
+    # LLMが候補に無いIDを返す場合があるため、候補に含まれるIDだけを残す
+    candidate_ids = {m["id"] for m in manga_list}
+    return [m_id for m_id in dict.fromkeys(response.ranking_ids) if m_id in candidate_ids]
+
+def rank_by_llm(user_input: str, manga_list: list[dict]) -> list[int]:
+    """候補をユーザーの要望に合致している順にLLMで並び替え、候補に含まれるIDだけを返します。"""
+    response = cached_structured_invoke(RANKING_PROMPT, llm, RankingResultsOutput, _ranking_inputs(user_input, manga_list))
+    return _valid_ranked_ids(response, manga_list)
+
+async def arank_by_llm(user_input: str, manga_list: list[dict]) -> list[int]:
+    """`rank_by_llm`の非同期版です。"""
+    response = await acached_structured_invoke(RANKING_PROMPT, llm, RankingResultsOutput, _ranking_inputs(user_input, manga_list))
+    return _valid_ranked_ids(response, manga_list)
+
+def _candidate_ids(state: State) -> list[int]:
+    # 検索ノードが見つけた候補のIDを、検索順のまま重複を除いて返す
+    return merge_ids([m_id for entry in state.get("ranked_lists", []) for m_id in entry["ids"]])
+
+def _prepare_ranking(manga_list: list[dict], ranked_lists: list[dict]) -> tuple[list[dict], Optional[dict[int, float]]]:
+    """
+    RANKER_MODEに応じて、LLMで並び替える候補と、RRFのスコア（順位順）を返します。
+    "llm"はスコアが無く全候補を、"rrf"はLLMを使わず、"rrf_llm"はRRFの上位だけをLLMで並び替えます。
+    """
+    if settings.RANKER_MODE == "llm":
+        return manga_list, None
+    # RRFで全候補を並び替える（LLMを使わないため候補数が増えても速い）
+    fused = fuse_candidates(manga_list, ranked_lists)
+    if settings.RANKER_MODE == "rrf":
+        return [], dict(fused)
+    # "rrf_llm": RRFの上位だけをLLMで並び替え、以降の候補もその上位に絞る
+    top_scores = dict(fused[:settings.RANKER_LLM_TOP_N])
+    manga_map = {m["id"]: m for m in manga_list}
+    return [manga_map[m_id] for m_id in top_scores], top_scores
+
+def _ranking_update(manga_list: list[dict], llm_ranked_ids: list[int], scores: Optional[dict[int, float]]) -> dict:
+    # LLMが並び替えた候補を先頭に、残りをRRF（スコアが無い場合は検索）の順で続ける
+    base_ids = list(scores) if scores is not None else [m["id"] for m in manga_list]
+    ranked_ids = merge_ids(llm_ranked_ids, base_ids)
+    return {
+        "found_manga_ids": Overwrite(ranked_ids[:5]),
+        "candidates": [{"id": m_id, "score": scores[m_id] if scores is not None else None} for m_id in ranked_ids]
+    }
+
 def ranking_results_node(state: State):
     user_input = state["messages"][-1].content
-    llm_contexts = state.get("llm_contexts", [])
-    contexts_description = get_llm_description(MangaForLLM)
-    if not llm_contexts:
-        return {"found_manga_ids": []}
+    # 検索ノードが見つけた候補の本文を、共有の漫画キャッシュから取り出す（削除済みの漫画は除かれる）
+    manga_list = manga_cache.get_in_order(_candidate_ids(state))
+    if not manga_list:
+        return {"found_manga_ids": Overwrite([]), "candidates": []}
+    targets, scores = _prepare_ranking(manga_list, state.get("ranked_lists", []))
+    llm_ranked_ids = rank_by_llm(user_input, targets) if targets else []
+    return _ranking_update(manga_list, llm_ranked_ids, scores)
+
+async def aranking_results_node(state: State):
+    user_input = state["messages"][-1].content
+    manga_list = await manga_cache.aget_in_order(_candidate_ids(state))
+    if not manga_list:
+        return {"found_manga_ids": Overwrite([]), "candidates": []}
+    targets, scores = _prepare_ranking(manga_list, state.get("ranked_lists", []))
+    llm_ranked_ids = await arank_by_llm(user_input, targets) if targets else []
+    return _ranking_update(manga_list, llm_ranked_ids, scores)
+
+
+class HistorySummaryOutput(BaseModel):
+    summary: str = Field(description="これまでの会話の要約")
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "あなたは会話の要約の専門家です。漫画の推薦に関するユーザーとAIの会話を、以降の推薦に必要な情報が残るよう{max_chars}文字以内で要約してください。"),
+    ("system", "ユーザーの好み・避けたい要素・既に推薦された作品のタイトルは必ず残してください。"),
+    ("human", "これまでの要約:\n{summary}\n\n追加の会話:\n{conversation}")
+])
+
+def _summary_inputs(summary: str, messages: list[BaseMessage]) -> dict:
+    conversation = "\n".join(f"{'ユーザー' if m.type == 'human' else 'AI'}: {m.content}" for m in messages)
+    return {"max_chars": settings.HISTORY_SUMMARY_MAX_CHARS, "summary": summary or "（なし）", "conversation": conversation}
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "あなたは漫画の目利きです。提示された漫画リストをユーザーの要望に合致している順に並び替えてください。"),
-        ("human", "要望: \n{user_input}\n\n【検索結果】\n{contexts}\n\n【結果の見方】\n{contexts_description}")
-    ])
+def summarize_history_by_llm(summary: str, messages: list[BaseMessage]) -> str:
+    """これまでの要約に古い会話を畳み込んだ、新しい要約をLLMで作成します。"""
+    chain = SUMMARY_PROMPT | llm.with_structured_output(HistorySummaryOutput)
+    return chain.invoke(_summary_inputs(summary, messages)).summary
 
-    chain = prompt | llm.with_structured_output(RankingResultsOutput)
-    response = chain.invoke({"user_input": user_input, "contexts": str(llm_contexts),"contexts_description": contexts_description})
-    
-    return {"found_manga_ids":response.ranking_ids[:5]}
+async def asummarize_history_by_llm(summary: str, messages: list[BaseMessage]) -> str:
+    """`summarize_history_by_llm`の非同期版です。"""
+    chain = SUMMARY_PROMPT | llm.with_structured_output(HistorySummaryOutput)
+    return (await chain.ainvoke(_summary_inputs(summary, messages))).summary
+
+def _messages_to_summarize(state: State) -> list[BaseMessage]:
+    # 要約されていない履歴がトークン数の上限を超えた場合だけ、直近以外のメッセージを要約の対象にする
+    older, recent = split_history(state["messages"], state.get("summarized_count", 0))
+    if not older or estimate_messages_tokens(older + recent) <= settings.HISTORY_TOKEN_THRESHOLD:
+        return []
+    return older
+
+def history_compaction_node(state: State):
+    # 古いメッセージを要約に畳み込む。要約は状態に保存され、以降のターンでは作り直さない
+    # （検索・ランキングと並列に実行する）
+    older = _messages_to_summarize(state)
+    if not older:
+        return {}
+    summary = summarize_history_by_llm(state.get("history_summary", ""), older)
+    return {"history_summary": summary, "summarized_count": state.get("summarized_count", 0) + len(older)}
+
+async def ahistory_compaction_node(state: State):
+    older = _messages_to_summarize(state)
+    if not older:
+        return {}
+    summary = await asummarize_history_by_llm(state.get("history_summary", ""), older)
+    return {"history_summary": summary, "summarized_count": state.get("summarized_count", 0) + len(older)}
 
 
 class ChatbotOutput(BaseModel):
     answer: str = Field(description="ユーザーに答えるメッセージ")
     found_manga_ids: List[int] = Field(description="提示された漫画のIDのリスト、最大5つ")
 
-def chatbot_node(state: State):
-    contexts = str(state.get("llm_contexts", []))
-    contexts_description = get_llm_description(MangaForLLM)
-    user_input = state["messages"][-1].content
-    history = state["messages"][-11:-1]
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "あなたは情熱的な漫画コンシェルジュです。提供された漫画情報を参照し、ユーザーの要望に最適な作品を推薦してください。"),
-        ("system", "おすすめする漫画は5つまでとし、メッセージと合わせてその5つのIDリストを出力してください。"),
-        ("system", "メッセージにはおすすめする漫画のタイトルと推薦理由を含めてください。"),
-        ("system", "ユーザーへの質疑は行わず回答のみ行ってください。提供された漫画の情報が不足している場合はそれを伝えてください"),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "要望: \n{user_input}\n\n【検索結果】\n{contexts}\n\n【結果の見方】\n{contexts_description}")
-    ])
-
-    chain = prompt | llm.with_structured_output(ChatbotOutput)
-    
-    response = chain.invoke({
-        "user_input": user_input,
-        "contexts": contexts,
-        "contexts_description": contexts_description,
+CHATBOT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "あなたは情熱的な漫画コンシェルジュです。提供された漫画情報を参照し、ユーザーの要望に最適な作品を推薦してください。"),
+    ("system", "おすすめする漫画は5つまでとし、メッセージと合わせてその5つのIDリストを出力してください。"),
+    ("system", "メッセージにはおすすめする漫画のタイトルと推薦理由を含めてください。"),
+    ("system", "ユーザーへの質疑は行わず回答のみ行ってください。提供された漫画の情報が不足している場合はそれを伝えてください"),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "要望: \n{user_input}\n\n【検索結果】\n{contexts}\n\n【結果の見方】\n{contexts_description}")
+])
+
+def _chatbot_inputs(state: State, manga_list: list[dict]) -> dict:
+    messages = state["messages"]
+    # 履歴は、古い会話の要約と、要約されていない直近のメッセージ（最大10件）だけを渡す
+    history = messages[max(state.get("summarized_count", 0), len(messages) - 11):-1]
+    if state.get("history_summary"):
+        history = [SystemMessage(content=f"これまでの会話の要約:\n{state['history_summary']}")] + history
+    return {
+        "user_input": messages[-1].content,
+        # 順位の高い作品から、トークン数の上限までをコンパクトな形式で渡す
+        "contexts": build_llm_context(manga_list),
+        "contexts_description": CONTEXT_DESCRIPTION,
         "history": history
-    })
+    }
+
+def _chatbot_update(response: ChatbotOutput) -> dict:
+    return {"messages": [AIMessage(content=response.answer)], "found_manga_ids": Overwrite(response.found_manga_ids)}
+
+def chatbot_node(state: State):
+    manga_list = manga_cache.get_in_order([c["id"] for c in state.get("candidates", [])])
+    chain = CHATBOT_PROMPT | llm.with_structured_output(ChatbotOutput)
+    return _chatbot_update(chain.invoke(_chatbot_inputs(state, manga_list)))
+
+async def achatbot_node(state: State):
+    manga_list = await manga_cache.aget_in_order([c["id"] for c in state.get("candidates", [])])
+    chain = CHATBOT_PROMPT | llm.with_structured_output(ChatbotOutput)
+    return _chatbot_update(await chain.ainvoke(_chatbot_inputs(state, manga_list)))
 
-    answer = AIMessage(content = response.answer)
-    found_manga_ids = response.found_manga_ids
-    
-    return {"messages": [answer], "found_manga_ids": found_manga_ids}
+
+def _keyword_search_update(ranked_lists: list[dict]) -> dict:
+    return {
+        "found_manga_ids": merge_ids([m_id for entry in ranked_lists for m_id in entry["ids"]]),
+        "ranked_lists": ranked_lists
+    }
 
 def keyword_search_node(state: State):
+    # 検索ではIDと順位だけを記録し、本文はランキング時に漫画キャッシュから取り出す
     queries = state.get("search_queries", [])
-    all_found_ids = []
-    llm_contexts = []
+    ranked_lists = []
     with Session(engine) as session:
         manga_service = MangaService(session)
         for query in queries:
-            manga_list = manga_service.get_manga_list_by_keyword(MangaSearchKeywordParams(keyword=query, limit=10))
-            all_found_ids.extend([m.id for m in manga_list])
-            llm_contexts.extend(to_llm_data(manga_list))
+            ids = manga_service.search_keyword_ids(query, limit=10)
+            ranked_lists.append({"source": "keyword", "ids": ids})
+    return _keyword_search_update(ranked_lists)
+
+async def akeyword_search_node(state: State):
+    # 非同期エンジン（aiosqlite）で検索し、イベントループも既定のスレッドプールも塞がない
+    queries = state.get("search_queries", [])
+    ranked_lists = []
+    async with AsyncSession(async_engine) as session:
+        manga_service = AsyncMangaService(session)
+        for query in queries:
+            ids = await manga_service.search_keyword_ids(query, limit=10)
+            ranked_lists.append({"source": "keyword", "ids": ids})
+    return _keyword_search_update(ranked_lists)
+
+def _vector_search_update(hits_per_query: list[list[tuple[int, float]]]) -> dict:
+    # クエリごとの順位はRRF用に残し、見つかったIDは最も近い距離の順に統合する
+    merged_hits = MangaService.merge_vector_hits(hits_per_query)
     return {
-        "found_manga_ids": merge_ids(all_found_ids),
-        "llm_contexts": merge_dicts(llm_contexts)
+        "found_manga_ids": merge_ids([m_id for m_id, _ in merged_hits]),
+        "ranked_lists": [{"source": "vector", "ids": [m_id for m_id, _ in hits]} for hits in hits_per_query]
     }
 
 def vector_search_node(state: State):
     queries = state.get("search_queries", [])
-    all_found_ids = []
-    llm_contexts = []
+    if not queries:
+        return _vector_search_update([])
+    # 全クエリを1回の埋め込み・1回のベクトル検索でまとめて処理
+    query_embeddings = vectorDB.embeddings.embed_queries(queries)
     with Session(engine) as session:
-        manga_service = MangaService(session, vectorDB)
-        for query in queries:
-            manga_list = manga_service.get_manga_list_by_vector(MangaSearchVectorParams(keyword=query, limit=10))
-            all_found_ids.extend([m.id for m in manga_list])
-            llm_contexts.extend(to_llm_data(manga_list))
-    return {
-        "found_manga_ids": merge_ids(all_found_ids),
-        "llm_contexts": merge_dicts(llm_contexts)
-    }
+        hits_per_query = MangaService(session, vectorDB).search_vector_ids_by_embeddings(query_embeddings, k=10)
+    return _vector_search_update(hits_per_query)
+
+async def avector_search_node(state: State):
+    queries = state.get("search_queries", [])
+    if not queries:
+        return _vector_search_update([])
+    # 埋め込みは非同期に待ち、ブロッキングなChroma検索は専用のスレッドプールで実行
+    query_embeddings = await vectorDB.embeddings.aembed_queries(queries)
+    async with AsyncSession(async_engine) as session:
+        hits_per_query = await AsyncMangaService(session, vectorDB).search_vector_ids_by_embeddings(query_embeddings, k=10)
+    return _vector_search_update(hits_per_query)
@@ -0,0 +1,54 @@
+"""
+LLMを使わずに検索結果を並び替える、Reciprocal Rank Fusion (RRF) によるランキングを定義します。
+キーワード検索(BM25)・ベクトル検索(距離)の各クエリの順位と、作品の評価・ユーザー評価の順位を
+重み付きで統合します。
+"""
+from collections import defaultdict
+from app.core.config import settings
+
+def reciprocal_rank_fusion(ranked_lists: list[tuple[list[int], float]], k: int = settings.RRF_K) -> list[tuple[int, float]]:
+    """
+    複数の順位付きIDリストをRRFで統合します。
+
+    Args:
+        ranked_lists (list[tuple[list[int], float]]): (上位から並んだIDのリスト, 重み) のリスト。
+        k (int): 順位の差をなだらかにする定数。大きいほど下位の順位も効くようになります。
+
+    Returns:
+        list[tuple[int, float]]: (ID, RRFスコア) のリスト。スコアの高い順です。
+    """
+    scores: dict[int, float] = defaultdict(float)
+    for ids, weight in ranked_lists:
+        if weight <= 0:
+            continue
+        for rank, manga_id in enumerate(ids, start=1):
+            scores[manga_id] += weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _rank_by_field(manga_list: list[dict], field: str) -> list[int]:
+    """候補を指定フィールドの値の高い順に並べたIDのリストを返します。値の無い候補は含めません。"""
+    rated = [m for m in manga_list if m.get(field) is not None]
+    return [m["id"] for m in sorted(rated, key=lambda m: m[field], reverse=True)]
+
+def fuse_candidates(manga_list: list[dict], ranked_lists: list[dict]) -> list[tuple[int, float]]:
+    """
+    検索ノードが記録したクエリごとの順位と、候補の`score`・`my_score`をRRFで統合し、候補を並べて返します。
+
+    Args:
+        manga_list (list[dict]): 候補の漫画情報。
+        ranked_lists (list[dict]): {"source": "keyword" | "vector", "ids": [...]} のリスト。
+
+    Returns:
+        list[tuple[int, float]]: (漫画ID, RRFスコア) のリスト。スコアの高い順です。
+    """
+    source_weights = {"keyword": settings.RRF_WEIGHT_KEYWORD, "vector": settings.RRF_WEIGHT_VECTOR}
+    lists = [(entry["ids"], source_weights.get(entry["source"], 1.0)) for entry in ranked_lists]
+    lists.append((_rank_by_field(manga_list, "score"), settings.RRF_WEIGHT_SCORE))
+    lists.append((_rank_by_field(manga_list, "my_score"), settings.RRF_WEIGHT_MY_SCORE))
+
+    candidate_ids = [m["id"] for m in manga_list]
+    candidate_set = set(candidate_ids)
+    fused = [(m_id, score) for m_id, score in reciprocal_rank_fusion(lists) if m_id in candidate_set]
+    # どのリストにも現れなかった候補は末尾に残す
+    fused_set = {m_id for m_id, _ in fused}
+    return fused + [(m_id, 0.0) for m_id in candidate_ids if m_id not in fused_set]
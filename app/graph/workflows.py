@@ -1,23 +1,46 @@
 from langgraph.graph import StateGraph, START, END
-from app.graph.nodes import State, chatbot_node, ranking_results_node, keyword_search_node, query_expansion_node, vector_search_node
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableLambda
+from app.core.config import settings
+from app.graph.nodes import (
+    State,
+    query_expansion_node, aquery_expansion_node,
+    keyword_search_node, akeyword_search_node,
+    vector_search_node, avector_search_node,
+    ranking_results_node, aranking_results_node,
+    history_compaction_node, ahistory_compaction_node,
+    chatbot_node, achatbot_node,
+)
+from app.graph.checkpointer import create_checkpointer
 
 workflow = StateGraph(State)
 
 # ノードの登録
-workflow.add_node("expander", query_expansion_node)
-workflow.add_node("keyword_search", keyword_search_node)
-workflow.add_node("vector_search", vector_search_node)
-workflow.add_node("ranker", ranking_results_node)
-workflow.add_node("chatbot", chatbot_node)
+# 各ノードは同期版と非同期版を持ち、ainvoke時は非同期版がイベントループ上で実行される
+# （LLMの応答待ちでスレッドを占有しないため、多数の会話を同時に待てる）
+def add_node(name: str, func, afunc) -> None:
+    workflow.add_node(name, RunnableLambda(func, afunc=afunc, name=name))
+
+add_node("expander", query_expansion_node, aquery_expansion_node)
+add_node("keyword_search", keyword_search_node, akeyword_search_node)
+add_node("vector_search", vector_search_node, avector_search_node)
+add_node("ranker", ranking_results_node, aranking_results_node)
+add_node("compactor", history_compaction_node, ahistory_compaction_node)
+add_node("chatbot", chatbot_node, achatbot_node)
 
 # # 流れの定義
 workflow.set_entry_point("expander")
-workflow.add_edge("expander", "vector_search")
-workflow.add_edge("vector_search", "ranker")
-workflow.add_edge("ranker", "chatbot")
+if settings.RETRIEVAL_MODE == "hybrid":
+    # キーワード検索とベクトル検索を並列に実行し、両方の結果がStateのReducerで統合されてからrankerへ進む
+    workflow.add_edge("expander", "keyword_search")
+    workflow.add_edge("expander", "vector_search")
+    workflow.add_edge(["keyword_search", "vector_search"], "ranker")
+else:
+    workflow.add_edge("expander", "vector_search")
+    workflow.add_edge("vector_search", "ranker")
+# 会話の履歴の要約は検索・ランキングと並列に実行し、両方が終わってからchatbotへ進む
+workflow.add_edge(START, "compactor")
+workflow.add_edge(["ranker", "compactor"], "chatbot")
 workflow.add_edge("chatbot", END)
-memory = MemorySaver()
-tool_llm_graph = workflow.compile(checkpointer=memory)
-
-
+# 会話状態の保存先（デフォルトはSQLite）
+checkpointer = create_checkpointer()
+tool_llm_graph = workflow.compile(checkpointer=checkpointer)
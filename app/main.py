@@ -5,7 +5,16 @@ FastAPIアプリケーションのエントリーポイントです。
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from app.core.config import settings
-from app.models.manga import create_db_and_tables
+from app.core.llm_cache import llm_cache
+from app.core.llm_gateway import llm_gateway
+from app.core.admission import chat_admission
+from app.models.manga import create_db_and_tables, engine, async_engine
+from app.services.seed import SeedJobService
+from app.services.vector_indexer import vector_indexer
+from app.graph.workflows import checkpointer
+from app.graph.expansion import expansion_cache
+from app.services.semantic_cache import semantic_cache
+from sqlmodel import Session
 
 from app.api.v1.api import api_router
 from fastapi.middleware.cors import CORSMiddleware
@@ -14,10 +23,18 @@ from fastapi.middleware.cors import CORSMiddleware
 async def lifespan(app: FastAPI):
     """
     アプリケーションの起動時と終了時に実行される処理を定義します。
-    起動時にデータベースとテーブルを作成します。
+    起動時にデータベースとテーブルを作成し、前回のプロセスで実行中のまま終わったシードジョブを中断扱いにします。
+    また、CRUDの変更をベクトルDBへ反映するインデクサを起動し、終了時にキューを反映してから停止します。
+    終了時には、チャットのグラフが使う非同期DBエンジンの接続も閉じます。
     """
     create_db_and_tables()
+    with Session(engine) as session:
+        SeedJobService(session).mark_interrupted_jobs()
+    vector_indexer.start()
     yield
+    vector_indexer.stop()
+    # 非同期エンジンの接続（aiosqliteのスレッド）を閉じる
+    await async_engine.dispose()
 
 # FastAPIアプリケーションのインスタンスを作成
 app = FastAPI(
@@ -46,7 +63,7 @@ app.include_router(api_router, prefix="/api/v1")
 async def health():
     """
     アプリケーションのヘルスチェック用エンドポイント。
-    アプリケーションが正常に動作しているか、またOllamaの設定を確認できます。
+    アプリケーションが正常に動作しているか、またOllamaの設定とLLM応答キャッシュ・会話の保存状況・LLMゲートウェイの待ち状況を確認できます。
     """
     return {
         "status": "ok",
@@ -54,5 +71,11 @@ async def health():
         "ollama_model": settings.OLLAMA_MODEL,
         "ollama_embedding_model": settings.OLLAMA_EMBEDDING_MODEL,
         "openai_model": settings.OPENAI_MODEL,
-        "openai_embedding_model": settings.OPENAI_EMBEDDING_MODEL
+        "openai_embedding_model": settings.OPENAI_EMBEDDING_MODEL,
+        "llm_cache": llm_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "query_expansion_cache": expansion_cache.stats(),
+        "checkpointer": checkpointer.stats() if hasattr(checkpointer, "stats") else {"backend": "memory"},
+        "llm_gateway": llm_gateway.stats(),
+        "chat_admission": chat_admission.stats()
     }
\ No newline at end of file
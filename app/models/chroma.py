@@ -1,10 +1,16 @@
 """
 ベクトルデータベース (ChromaDB) に関する設定とクライアントのインスタンスを定義します。
 """
+import asyncio
+import hashlib
+import json
+from langchain_core.embeddings import Embeddings
 from langchain_ollama import OllamaEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain_chroma import Chroma
+from app.core.cache import DiskLRUCache
 from app.core.config import settings
+from app.core.llm_gateway import llm_gateway, GatewayEmbeddings
 
 def get_embedding(model_type="ollama"):
     if model_type == "openai":
@@ -17,14 +23,79 @@ def get_embedding(model_type="ollama"):
             base_url=settings.OLLAMA_BASE_URL, 
             model=settings.OLLAMA_EMBEDDING_MODEL
         )
-# 埋め込みモデルのインスタンスを生成
-embedding = get_embedding(settings.LLM_TYPE)
+class CachedEmbeddings(Embeddings):
+    """
+    ドキュメントの埋め込みを、モデル名と本文のハッシュをキーにディスクへキャッシュする埋め込みモデルのラッパー。
+    ChromaDBを作り直した場合も、本文が変わっていなければ埋め込みモデルを呼び出しません。
+    クエリの埋め込みはキャッシュせずにそのまま元のモデルを呼び出します。
+    複数のクエリをまとめて埋め込む場合は、`embed_documents`ではなく`embed_queries`を使います。
+    """
+    def __init__(self, base: Embeddings, model_name: str, cache: DiskLRUCache):
+        self.base = base
+        self.model_name = model_name
+        self.cache = cache
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(t) for t in texts]
+        cached = self.cache.get_many(keys)
+        # キャッシュに無い本文だけを1回の呼び出しでまとめて埋め込む
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if missing:
+            vectors = self.base.embed_documents(list(missing.values()))
+            new_entries = {key: json.dumps(vector) for key, vector in zip(missing, vectors)}
+            self.cache.set_many(new_entries)
+            cached.update(new_entries)
+        return [json.loads(cached[key]) for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(t) for t in texts]
+        cached = await asyncio.to_thread(self.cache.get_many, keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if missing:
+            vectors = await self.base.aembed_documents(list(missing.values()))
+            new_entries = {key: json.dumps(vector) for key, vector in zip(missing, vectors)}
+            await asyncio.to_thread(self.cache.set_many, new_entries)
+            cached.update(new_entries)
+        return [json.loads(cached[key]) for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.base.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.base.aembed_query(text)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        複数のクエリをまとめて埋め込みます。ドキュメントのキャッシュには書き込みません。
+        元のモデルが`GatewayEmbeddings`の場合は、同じ時間帯に届いた他のリクエストのクエリと一緒にまとめて埋め込みます。
+        """
+        if isinstance(self.base, GatewayEmbeddings):
+            return self.base.embed_queries(texts)
+        return self.base.embed_documents(texts)
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """`embed_queries`の非同期版です。"""
+        if isinstance(self.base, GatewayEmbeddings):
+            return await self.base.aembed_queries(texts)
+        return await self.base.aembed_documents(texts)
+
+# 埋め込みモデルのインスタンスを生成（呼び出しはLLMゲートウェイ経由で行い、クエリの埋め込みはまとめて実行する）
+embedding = GatewayEmbeddings(get_embedding(settings.LLM_TYPE), llm_gateway)
+# ドキュメントの埋め込みをキャッシュするラッパー（ChromaDBへの登録に使用）
+cached_embedding = CachedEmbeddings(
+    embedding,
+    settings.OPENAI_EMBEDDING_MODEL if settings.LLM_TYPE == "openai" else settings.OLLAMA_EMBEDDING_MODEL,
+    DiskLRUCache(settings.EMBEDDING_CACHE_PATH, "embedding", settings.EMBEDDING_CACHE_MAX_ENTRIES)
+)
 
 # 漫画の「あらすじ」を格納するChromaDBのコレクション
 vectorDB = Chroma(
     collection_name="manga_vector",
     persist_directory=settings.CHROMA_URL,  # データの永続化先ディレクトリ
-    embedding_function=embedding,
+    embedding_function=cached_embedding,
     collection_metadata={"hnsw:space": "cosine"}  # 類似度計算にコサイン類似度を使用
 )
 
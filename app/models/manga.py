@@ -3,10 +3,14 @@
 SQLModelを使用して、データベースのテーブルとPydanticの検証モデルを同時に定義します。
 """
 from sqlmodel import Field, SQLModel, Session, create_engine, Enum
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Index, event
+from sqlalchemy.ext.asyncio import create_async_engine
 from pydantic import BaseModel, Field as PyField
 from datetime import datetime
 from typing import Optional, List, Literal
 from app.core.config import settings
+from app.models.migrations import run_migrations
 
 # --- 基本となる漫画データモデル ---
 """
@@ -52,8 +56,51 @@ class MangaUpdate(MangaBase):
 
 class Manga(MangaBase, table=True):
     """データベースの`manga`テーブルに対応するモデル。"""
+    # 既存のデータベースには、同じインデックスをマイグレーション（app/models/migrations.py）で作成する
+    __table_args__ = (
+        Index("ix_manga_site_id", "site_id", unique=True),         # シード時の登録済み判定
+        Index("ix_manga_score", "score"),                          # 評価での絞り込み・並び替え
+        Index("ix_manga_status_score", "status", "score"),         # ステータスで絞り込み、評価順に並べる
+        Index("ix_manga_my_status_score", "my_status", "score"),   # ユーザー管理のステータスで絞り込み、評価順に並べる
+        Index("ix_manga_updated_at", "updated_at"),                # 更新日時順の一覧（キーセットページネーション）
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
 
+# --- タグ・著者・連載誌の転置インデックス ---
+
+# 転置インデックスの種類 -> 元になる`manga`テーブルのフィールド（カンマ区切りの文字列）
+FACET_FIELDS = {"tag": "ai_tags", "author": "author", "serialization": "serialization"}
+
+def split_tags(ai_tags: Optional[str]) -> list[str]:
+    """カンマ（全角・読点を含む）区切りのタグ文字列を、重複の無いタグのリストに分割します。著者・連載誌にも使います。"""
+    if not ai_tags:
+        return []
+    tags = (t.strip() for t in ai_tags.replace("，", ",").replace("、", ",").split(","))
+    return list(dict.fromkeys(t for t in tags if t))
+
+def build_facet_rows(manga_id: int, fields: dict) -> list[dict]:
+    """漫画のカンマ区切りのフィールド（{フィールド名: 値}）から、転置インデックス`manga_facet`の行を作ります。"""
+    return [
+        {"kind": kind, "value": value, "manga_id": manga_id}
+        for kind, field in FACET_FIELDS.items()
+        for value in split_tags(fields.get(field))
+    ]
+
+class MangaFacet(SQLModel, table=True):
+    """
+    タグ・著者・連載誌の転置インデックス（`manga_facet`テーブル）。
+    (種類, 値) の順に並ぶ主キーが、値ごとの漫画IDのリスト（ポスティングリスト）になります。
+    `MangaService`が漫画の書き込み時に更新し、既存のデータベースにはマイグレーションで作成します。
+    """
+    __tablename__ = "manga_facet"
+    __table_args__ = (
+        Index("ix_manga_facet_manga_id", "manga_id"),              # 漫画の更新・削除時に、その漫画の行を削除する
+        {"sqlite_with_rowid": False},
+    )
+    kind: str = Field(primary_key=True)                            # "tag" | "author" | "serialization"
+    value: str = Field(primary_key=True)                           # タグ名・著者名・連載誌名
+    manga_id: int = Field(primary_key=True)
+
 # --- LLM連携用のデータモデル ---
 
 class MangaForLLM(SQLModel):
@@ -70,6 +117,7 @@ class MangaForLLM(SQLModel):
     my_status: Optional[Literal["読みたい", "読んでいる", "読み終えた"]] = Field(default=None, description="ユーザー管理のステータス, 「読みたい」「読んでいる」「読み終えた」")
     ai_tags: Optional[str] = Field(default=None, description="AIによるタグ")
     ai_comment: Optional[str] = Field(default=None, description="AIによるおすすめポイント")
+    updated_at: Optional[datetime] = Field(default=None, description="更新日時")
 
 def to_llm_data(manga_list: List[Manga]) -> List[dict]:
     """Mangaオブジェクトのリストを、LLM向けの辞書のリストに変換します。"""
@@ -89,13 +137,15 @@ class MangaSearchKeywordParams(BaseModel):
     """キーワード検索APIのクエリパラメータモデル。"""
     keyword: str = PyField(default="", description="検索キーワード")  
     limit: int = PyField(default=10, description="最大件数")  
+    sort: Literal["relevance", "score", "updated_at"] = PyField(default="relevance", description="並び順, 「relevance」（関連度順）「score」（評価の高い順）「updated_at」（更新の新しい順）")
+    cursor: Optional[str] = PyField(default=None, description="次のページを取得する場合に、前のレスポンスの`next_cursor`を指定")
 
 class MangaSearchQueryParams(BaseModel):
     """複合条件検索APIのクエリパラメータモデル。"""
     id: Optional[int] = Field(default=None, description="データ管理用ID")
     title: Optional[str] = Field(default=None, description="漫画のタイトル")
-    author: Optional[str] = Field(default=None, description="漫画の著者")
-    serialization: Optional[str] = Field(default=None, description="漫画の連載誌")
+    author: Optional[str] = Field(default=None, description="漫画の著者（完全一致）。カンマ区切りで複数指定した場合は、いずれかに一致する漫画")
+    serialization: Optional[str] = Field(default=None, description="漫画の連載誌（完全一致）。カンマ区切りで複数指定した場合は、いずれかに一致する漫画")
     status: Optional[Literal["Finished", "Publishing", "On Hiatus","Discontinued","Not yet published"]] = Field(default=None, description="漫画のステータス, 「Finished」, 「Publishing」, 「On Hiatus」, 「Discontinued」, 「Not yet published」")
     synopsis: Optional[str] = Field(default=None, description="漫画のあらすじ")
     score: Optional[float] = Field(default=None, description="漫画の評価", ge=0, le=10)
@@ -104,24 +154,73 @@ class MangaSearchQueryParams(BaseModel):
     my_score: Optional[int] = Field(default=None, description="ユーザーの評価", ge=0, le=5)
     my_score_filter_method: Literal["min", "max", "equal"] = Field(default="equal", description="漫画のユーザー評価のフィルター方法, 「min」「max」「equal」")
     my_status: Optional[Literal["読みたい", "読んでいる", "読み終えた"]] = Field(default=None, description="ユーザー管理のステータス, 「読みたい」「読んでいる」「読み終えた」")
-    ai_tags: Optional[str] = Field(default=None, description="AIによるタグ")
+    ai_tags: Optional[str] = Field(default=None, description="AIによるタグ（完全一致）。カンマ区切りで複数指定可能")
+    tag_match: Literal["all", "any"] = PyField(default="all", description="複数のタグの条件, 「all」（全てのタグを持つ）「any」（いずれかのタグを持つ）")
     limit: int = PyField(default=10, description="最大件数")
+    sort: Literal["score", "updated_at"] = PyField(default="score", description="並び順, 「score」（評価の高い順）「updated_at」（更新の新しい順）")
+    cursor: Optional[str] = PyField(default=None, description="次のページを取得する場合に、前のレスポンスの`next_cursor`を指定")
 
 class MangaSearchVectorParams(BaseModel):
     """ベクトル検索APIのクエリパラメータモデル。"""
     keyword: str
     limit: int = PyField(default=10)
+    cursor: Optional[str] = PyField(default=None, description="次のページを取得する場合に、前のレスポンスの`next_cursor`を指定")
+
+class MangaPage(BaseModel):
+    """一覧・検索APIの1ページ分のレスポンスモデル。"""
+    items: List[MangaRead] = PyField(description="このページの漫画")
+    next_cursor: Optional[str] = PyField(default=None, description="次のページのカーソル。最後のページの場合はnull")
 
 # --- データベースエンジンとセッションのセットアップ ---
 
 sqlite_url = settings.SQLITE_URL
-engine = create_engine(sqlite_url)
+engine = create_engine(
+    sqlite_url,
+    pool_size=settings.SQLITE_POOL_SIZE,
+    max_overflow=settings.SQLITE_MAX_OVERFLOW,
+    pool_timeout=settings.SQLITE_POOL_TIMEOUT_SEC,
+    pool_recycle=settings.SQLITE_POOL_RECYCLE_SEC,
+)
+# チャットのグラフなど、イベントループ上での読み取りに使う非同期エンジン（aiosqlite）
+async_engine = create_async_engine(
+    sqlite_url.replace("sqlite://", "sqlite+aiosqlite://", 1),
+    pool_size=settings.SQLITE_POOL_SIZE,
+    max_overflow=settings.SQLITE_MAX_OVERFLOW,
+    pool_timeout=settings.SQLITE_POOL_TIMEOUT_SEC,
+    pool_recycle=settings.SQLITE_POOL_RECYCLE_SEC,
+)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    接続ごとにSQLiteのPRAGMAを設定します。
+    WALで書き込み中も読み取りを止めず、メモリマップとページキャッシュで読み取りを速くします。
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        # 負の値はKiB単位の指定
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KIB)}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+event.listen(engine, "connect", apply_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
 
 def create_db_and_tables():
-    """データベースとテーブルを（存在しない場合）作成します。"""
+    """データベースとテーブルを（存在しない場合）作成し、未適用のマイグレーションを適用します。"""
     SQLModel.metadata.create_all(engine)
+    run_migrations(engine)
 
 def get_session():
     """FastAPIのDI(依存性注入)で使用するためのDBセッション生成関数。"""
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    """FastAPIのDI(依存性注入)で使用するための非同期DBセッション生成関数。"""
+    async with AsyncSession(async_engine) as session:
+        yield session
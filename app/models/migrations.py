@@ -0,0 +1,174 @@
+"""
+データベースのスキーマのマイグレーションを定義します。
+`SQLModel.metadata.create_all`は既存のテーブルに後から追加したインデックスなどを反映しないため、
+スキーマの変更はここに番号付きで追加し、適用済みの番号を`schema_migrations`テーブルに記録します。
+起動時（`create_db_and_tables`）に未適用のものだけを番号順に、1件ずつトランザクションの中で適用します。
+
+マイグレーションを追加する場合は、`MIGRATIONS`の末尾に次の番号で追加してください（適用済みの内容は変更しないこと）。
+"""
+from datetime import datetime
+from typing import Callable
+from sqlalchemy import Connection, Engine
+
+def _table_exists(conn: Connection, name: str) -> bool:
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).first() is not None
+
+def _create_fts_index(conn: Connection) -> None:
+    """
+    キーワード検索用のFTS5仮想テーブル`manga_fts`を作成し、既存の`manga`テーブルの内容を取り込みます。
+    日本語は単語区切りが無いため、trigramトークナイザで3文字単位に索引します。
+    """
+    if _table_exists(conn, "manga_fts"):
+        return
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE manga_fts USING fts5(title, synopsis, ai_tags, tokenize = 'trigram')"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO manga_fts(rowid, title, synopsis, ai_tags) SELECT id, title, synopsis, ai_tags FROM manga"
+    )
+
+# ユーザーが入力した列。重複した漫画を1件にまとめる際に、削除する行から残す行へ引き継ぐ
+USER_OWNED_FIELDS = ("my_review", "my_score", "my_status")
+
+def _merge_duplicate_site_ids(conn: Connection) -> None:
+    """
+    `site_id`が重複している漫画を1件にまとめます。
+    残すのは最後に更新された漫画（`updated_at`が最も新しいもの。同じ場合や無い場合はIDが最も大きいもの）です。
+    ユーザーが入力した列（`USER_OWNED_FIELDS`）は、残す行が空の場合に他の行の値を引き継いでから、
+    残さない行を全文検索インデックス`manga_fts`・転置インデックス`manga_facet`の行と一緒に削除します。
+    ベクトルDBに残った埋め込みは、次回のベクトル同期で削除されます。
+
+    Raises:
+        RuntimeError: 同じ`site_id`の漫画に、ユーザーが入力した異なる値がある場合（どれを残すかは自動で決めない）。
+            データは変更せず、マイグレーションは未適用のまま残ります。
+    """
+    rows = conn.exec_driver_sql(
+        f"SELECT id, site_id, {', '.join(USER_OWNED_FIELDS)} FROM ("
+        " SELECT *, COUNT(*) OVER (PARTITION BY site_id) AS duplicates, ROW_NUMBER() OVER ("
+        "  PARTITION BY site_id ORDER BY updated_at IS NULL, updated_at DESC, id DESC"
+        " ) AS rank FROM manga WHERE site_id IS NOT NULL"
+        ") WHERE duplicates > 1 ORDER BY site_id, rank"
+    ).all()
+    if not rows:
+        return
+    groups: dict[int, list] = {}
+    for row in rows:
+        groups.setdefault(row[1], []).append(row)
+
+    conflicts = []
+    merges = []
+    for site_id, group in groups.items():
+        merged = {}
+        for i, field in enumerate(USER_OWNED_FIELDS, start=2):
+            values = {row[i] for row in group if row[i] is not None}
+            if len(values) > 1:
+                conflicts.append(f"site_id={site_id} {field}: " + ", ".join(f"id={row[0]}" for row in group if row[i] is not None))
+            elif values and group[0][i] is None:
+                merged[field] = values.pop()
+        merges.append((group[0][0], merged, [row[0] for row in group[1:]]))
+    if conflicts:
+        raise RuntimeError(
+            "site_idが重複している漫画に、ユーザーが入力した異なる値があるため、一意のインデックスを作成できません。"
+            f"どちらかの値を削除してから再起動してください: {'; '.join(conflicts[:10])}"
+            + (f" ほか{len(conflicts) - 10}件" if len(conflicts) > 10 else "")
+        )
+
+    for kept_id, merged, _ in merges:
+        if merged:
+            assignments = ", ".join(f"{field} = ?" for field in merged)
+            conn.exec_driver_sql(f"UPDATE manga SET {assignments} WHERE id = ?", (*merged.values(), kept_id))
+    ids = [(manga_id,) for _, _, removed_ids in merges for manga_id in removed_ids]
+    conn.exec_driver_sql("DELETE FROM manga WHERE id = ?", ids)
+    if _table_exists(conn, "manga_fts"):
+        conn.exec_driver_sql("DELETE FROM manga_fts WHERE rowid = ?", ids)
+    if _table_exists(conn, "manga_facet"):
+        conn.exec_driver_sql("DELETE FROM manga_facet WHERE manga_id = ?", ids)
+    listed = ", ".join(f"id={kept_id} <- {removed_ids}" for kept_id, _, removed_ids in merges[:10])
+    more = f" ほか{len(merges) - 10}件" if len(merges) > 10 else ""
+    print(f"site_idが重複していた漫画を{len(ids)}件、残す漫画にまとめました（残す漫画 <- 削除した漫画）: {listed}{more}")
+
+def _create_manga_indexes(conn: Connection) -> None:
+    """
+    `manga`テーブルに、シード時の`site_id`の照合と、検索の絞り込み・並び替え用のインデックスを作成します。
+    `site_id`は一意にするため、重複がある場合は先に`_merge_duplicate_site_ids`で1件にまとめます。
+    """
+    _merge_duplicate_site_ids(conn)
+    conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_manga_site_id ON manga (site_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_manga_score ON manga (score)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_manga_status_score ON manga (status, score)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_manga_my_status_score ON manga (my_status, score)")
+    # 新しいインデックスを使った実行計画を選べるよう、統計情報を更新する
+    conn.exec_driver_sql("ANALYZE manga")
+
+def _create_updated_at_index(conn: Connection) -> None:
+    """更新日時順の一覧（キーセットページネーション）用のインデックスを作成します。"""
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_manga_updated_at ON manga (updated_at)")
+
+def _create_manga_facets(conn: Connection) -> None:
+    """
+    タグ・著者・連載誌の転置インデックス`manga_facet`を作成し、既存の漫画のカンマ区切りのフィールドから作ります。
+    """
+    # app.models.mangaはこのモジュールを読み込むため、循環importを避けてここで読み込む
+    from app.models.manga import FACET_FIELDS, build_facet_rows
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS manga_facet ("
+        "kind VARCHAR NOT NULL, value VARCHAR NOT NULL, manga_id INTEGER NOT NULL, "
+        "PRIMARY KEY (kind, value, manga_id)) WITHOUT ROWID"
+    )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_manga_facet_manga_id ON manga_facet (manga_id)")
+    conn.exec_driver_sql("DELETE FROM manga_facet")
+    fields = list(FACET_FIELDS.values())
+    rows = conn.exec_driver_sql(f"SELECT id, {', '.join(fields)} FROM manga").all()
+    facet_rows = [
+        (facet["kind"], facet["value"], facet["manga_id"])
+        for row in rows
+        for facet in build_facet_rows(row[0], dict(zip(fields, row[1:])))
+    ]
+    if facet_rows:
+        conn.exec_driver_sql("INSERT INTO manga_facet (kind, value, manga_id) VALUES (?, ?, ?)", facet_rows)
+    conn.exec_driver_sql("ANALYZE manga_facet")
+
+# (番号, 名前, 適用する関数) のリスト。番号順に適用される
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create_manga_fts", _create_fts_index),
+    (2, "create_manga_indexes", _create_manga_indexes),
+    (3, "create_manga_updated_at_index", _create_updated_at_index),
+    (4, "create_manga_facets", _create_manga_facets),
+]
+
+def get_applied_versions(engine: Engine) -> set[int]:
+    """適用済みのマイグレーションの番号を返します。"""
+    with engine.begin() as conn:
+        _ensure_migrations_table(conn)
+        return {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+def _ensure_migrations_table(conn: Connection) -> None:
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT NOT NULL)"
+    )
+
+def run_migrations(engine: Engine) -> list[int]:
+    """
+    未適用のマイグレーションを番号順に適用します。
+
+    Returns:
+        list[int]: 今回適用したマイグレーションの番号
+    """
+    applied = get_applied_versions(engine)
+    newly_applied = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        # 1件ごとにトランザクションを分け、失敗した場合はそのマイグレーションだけを取り消す
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.exec_driver_sql(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.now().isoformat())
+            )
+        newly_applied.append(version)
+        print(f"マイグレーションを適用しました: {version} {name}")
+    return newly_applied
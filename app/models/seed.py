@@ -0,0 +1,66 @@
+"""
+シード処理のジョブと、途中結果を保存するステージングテーブルのデータモデルを定義します。
+プロセスが再起動しても、保存済みのステージは再実行せずに再利用できます。
+"""
+from sqlmodel import Field, SQLModel
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional
+
+# --- ステージングのステージ名 ---
+STAGE_REVIEWS = "reviews"               # レビュー原文のリスト
+STAGE_REVIEW_SUMMARIES = "review_summaries"  # LLMで要約したレビューのリスト
+STAGE_ENRICH_RAW = "enrich_raw"         # 原文レビューを使ったLLM加工結果
+STAGE_ENRICH_SUMMARY = "enrich_summary" # 要約レビューを使ったLLM加工結果
+
+# 再開できるジョブの状態
+RESUMABLE_STATUSES = ("interrupted", "failed")
+
+# ジョブのカウンタ項目
+SEED_JOB_COUNTERS = ("fetched", "skipped", "reviewed", "enriched", "saved", "failed", "reused")
+
+class SeedJob(SQLModel, table=True):
+    """データベースの`seed_job`テーブルに対応するモデル。シード処理1回分の進捗を保持します。"""
+    __tablename__ = "seed_job"
+    id: Optional[int] = Field(default=None, primary_key=True)
+    limit: int                                  # 取得対象の件数
+    summarize_reviews: bool = False             # レビューを要約してから使うかどうか
+    status: str = "pending"                     # pending / running / completed / failed / interrupted
+    fetched: int = 0                            # ページ取得ステージで受け取った件数
+    skipped: int = 0                            # 登録済みのためスキップした件数
+    reviewed: int = 0                           # レビューを用意できた件数
+    enriched: int = 0                           # LLM加工が済んだ件数
+    saved: int = 0                              # SQLiteに保存した件数
+    failed: int = 0                             # 失敗した件数
+    reused: int = 0                             # ステージングの結果を再利用した回数
+    error: Optional[str] = None                 # 失敗時のエラー内容
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class SeedStaging(SQLModel, table=True):
+    """データベースの`seed_staging`テーブルに対応するモデル。`mal_id`とステージごとの途中結果をJSONで保持します。"""
+    __tablename__ = "seed_staging"
+    mal_id: int = Field(primary_key=True)
+    stage: str = Field(primary_key=True)
+    payload: str                                # JSON文字列
+    job_id: Optional[int] = None                # 結果を作成したジョブのID
+    created_at: Optional[datetime] = None
+
+# --- APIのレスポンス用モデル ---
+
+class SeedJobStatus(BaseModel):
+    """シードジョブの進捗を返すAPIレスポンスモデル。"""
+    job_id: int
+    status: str
+    limit: int
+    summarize_reviews: bool
+    counts: dict[str, int]                      # ステージごとの処理件数
+    elapsed_sec: Optional[float] = None         # 開始からの経過秒数
+    throughput_per_min: Optional[float] = None  # 1分あたりの処理件数
+    eta_sec: Optional[float] = None             # 完了までの推定残り秒数
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
@@ -0,0 +1,149 @@
+"""
+チャットのグラフの同時実行性能のベンチマーク用スクリプトです。
+一定時間待つだけの偽LLM・偽の埋め込みモデルと、一時ディレクトリのSQLite・ChromaDBを使い、
+同時に実行する会話の数を増やしたときのスループットと応答時間を計測します。
+
+`--mode async`は`ainvoke`（非同期ノード）で、`--mode threads`は従来どおり同期ノードをスレッドプールで実行します。
+LLMの応答を待つ間にスレッドを占有しない非同期ノードでは、同時実行数を増やしても応答時間がほぼ一定になります。
+
+実行例:
+    python -m app.scripts.bench_chat_concurrency --concurrency 1,10,50,200 --llm-latency 0.5
+    python -m app.scripts.bench_chat_concurrency --mode threads --concurrency 1,10,50,200
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+# アプリのモジュールを読み込む前に、保存先を一時ディレクトリに向け、偽LLMの呼び出しを制限しないようにする
+_bench_dir = tempfile.mkdtemp(prefix="bench_chat_")
+os.environ.setdefault("SQLITE_URL", f"sqlite:///{_bench_dir}/manga.db")
+os.environ.setdefault("CHROMA_URL", f"{_bench_dir}/chroma")
+os.environ.setdefault("LLM_CACHE_PATH", f"{_bench_dir}/llm_cache.db")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", f"{_bench_dir}/embedding_cache.db")
+os.environ.setdefault("CHECKPOINT_DB_PATH", f"{_bench_dir}/checkpoints.db")
+os.environ.setdefault("SEMANTIC_CACHE_ENABLED", "false")
+os.environ.setdefault("LLM_CACHE_ENABLED", "false")
+os.environ.setdefault("LLM_GATEWAY_MAX_CONCURRENCY", "100000")
+os.environ.setdefault("LLM_GATEWAY_INTERACTIVE_CONCURRENCY", "100000")
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+from sqlmodel import Session
+import app.graph.nodes as nodes
+import app.models.chroma as chroma
+from app.core.llm_gateway import GatewayChatModel, llm_gateway
+from app.models.manga import MangaCreate, create_db_and_tables, engine, async_engine
+from app.services.manga import MangaService
+
+TAGS = ["バトル", "友情", "恋愛", "ミステリー", "日常", "ファンタジー", "SF", "ホラー", "スポーツ", "グルメ"]
+
+class FakeLLM:
+    """`with_structured_output`に対応し、指定秒数待ってからスキーマに合うダミーの出力を返す偽LLM。"""
+    model = "fake"
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def with_structured_output(self, schema):
+        def build(_inputs):
+            name = schema.__name__
+            if name == "SearchQueryExpansionOutput":
+                return schema(search_queries=["熱いバトル", "友情", "仲間と冒険"])
+            if name == "RankingResultsOutput":
+                return schema(ranking_ids=[])
+            if name == "ChatbotOutput":
+                return schema(answer="おすすめの漫画です。", found_manga_ids=[1, 2, 3])
+            return schema(**{field: "fake" for field in schema.model_fields})
+
+        def invoke(inputs):
+            time.sleep(self.latency)
+            return build(inputs)
+
+        async def ainvoke(inputs):
+            await asyncio.sleep(self.latency)
+            return build(inputs)
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    """指定秒数待ってからダミーのベクトルを返す偽の埋め込みモデル。"""
+    latency: float = 0.0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency)
+        return super().embed_documents(texts)
+
+def seed_manga(count: int) -> None:
+    """ベンチマーク用の漫画を登録し、ベクトルDBに反映します。"""
+    create_db_and_tables()
+    with Session(engine) as session:
+        service = MangaService(session, chroma.vectorDB)
+        for i in range(count):
+            tags = ",".join(TAGS[(i + j) % len(TAGS)] for j in range(3))
+            service.create_manga(MangaCreate(
+                title=f"漫画{i}", synopsis=f"{tags}の物語 その{i}", ai_tags=tags, score=5 + i % 5
+            ), vector_sync=False)
+        service.sync_vector_store()
+
+async def run_level(concurrency: int, mode: str) -> dict:
+    """同時にconcurrency件の会話を実行し、経過時間と応答時間を返します。"""
+    from app.graph.workflows import tool_llm_graph
+
+    async def one_chat(i: int) -> float:
+        inputs = {"messages": [HumanMessage(content=f"依頼{concurrency}-{i}: 熱いバトルと友情の物語が読みたい")]}
+        config = {"configurable": {"thread_id": f"bench-{mode}-{concurrency}-{i}"}}
+        started_at = time.monotonic()
+        if mode == "async":
+            await tool_llm_graph.ainvoke(inputs, config=config)
+        else:
+            await asyncio.to_thread(tool_llm_graph.invoke, inputs, config)
+        return time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    latencies = sorted(await asyncio.gather(*(one_chat(i) for i in range(concurrency))))
+    elapsed = time.monotonic() - started_at
+    return {
+        "elapsed": elapsed,
+        "throughput": concurrency / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+async def run_levels(levels: list[int], mode: str) -> list[tuple[int, dict]]:
+    try:
+        return [(level, await run_level(level, mode)) for level in levels]
+    finally:
+        # 非同期エンジンの接続（aiosqliteのスレッド）を閉じる
+        await async_engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットのグラフの同時実行性能のベンチマーク")
+    parser.add_argument("--concurrency", default="1,10,50,200", help="同時に実行する会話の数（カンマ区切りで複数指定）")
+    parser.add_argument("--mode", choices=["async", "threads"], default="async")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="偽LLMの1回の応答にかかる秒数")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="偽の埋め込みモデルの応答にかかる秒数")
+    parser.add_argument("--manga", type=int, default=200, help="登録する漫画の件数")
+    args = parser.parse_args()
+
+    embeddings = FakeEmbeddings(size=64)
+    embeddings.latency = args.embedding_latency
+    chroma.cached_embedding.base = embeddings
+    nodes.llm = GatewayChatModel(FakeLLM(args.llm_latency), llm_gateway)
+    seed_manga(args.manga)
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    print(f"mode={args.mode} llm_latency={args.llm_latency}s")
+    print(f"{'同時実行数':>8} {'経過(秒)':>8} {'件/秒':>8} {'p50(秒)':>8} {'p95(秒)':>8}")
+    for level, result in asyncio.run(run_levels(levels, args.mode)):
+        print(f"{level:>8} {result['elapsed']:>8.2f} {result['throughput']:>8.1f} {result['p50']:>8.2f} {result['p95']:>8.2f}")
+    print(f"保存先: {_bench_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+シード処理パイプラインのベンチマーク用スクリプトです。
+Jikan APIのローカルスタブ（HTTPサーバー）と、一定時間待つだけの偽LLMを使い、
+外部サービスに負荷をかけずにパイプラインのスループットを計測します。
+
+実行例:
+    python -m app.scripts.bench_seed --limit 200 --llm-latency 0.5 --llm-concurrency 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# アプリのモジュールを読み込む前に、保存先を一時ディレクトリのSQLiteに向ける
+_bench_dir = tempfile.mkdtemp(prefix="bench_seed_")
+os.environ.setdefault("SQLITE_URL", f"sqlite:///{_bench_dir}/manga.db")
+os.environ.setdefault("CHROMA_URL", f"{_bench_dir}/chroma")
+os.environ.setdefault("LLM_CACHE_PATH", f"{_bench_dir}/llm_cache.db")
+
+from langchain_core.runnables import RunnableLambda
+from app.models.manga import create_db_and_tables
+from app.scripts.seed_pipeline import run_seed_pipeline
+
+PAGE_SIZE = 25
+
+class JikanStubHandler(BaseHTTPRequestHandler):
+    """Jikan APIの`/top/manga`と`/manga/{id}/reviews`だけを模したハンドラ。"""
+    total = 1000
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/top/manga":
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            start = (page - 1) * PAGE_SIZE
+            ids = range(start + 1, min(start + PAGE_SIZE, self.total) + 1)
+            body = {"data": [self._manga(i) for i in ids]}
+        elif url.path.startswith("/manga/") and url.path.endswith("/reviews"):
+            body = {"data": [{"review": "A great story. " * 50} for _ in range(3)]}
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def _manga(mal_id: int) -> dict:
+        return {
+            "mal_id": mal_id,
+            "title": f"Manga {mal_id}",
+            "synopsis": "A synopsis.",
+            "score": 8.0,
+            "status": "Finished",
+            "genres": [{"name": "Action"}],
+            "themes": [{"name": "School"}],
+            "authors": [{"name": "Author, Some"}],
+            "serializations": [{"name": "Weekly"}],
+            "images": {"jpg": {"large_image_url": None}},
+            "url": f"https://example.com/manga/{mal_id}",
+        }
+
+class FakeLLM:
+    """`with_structured_output`に対応し、指定秒数待ってからダミーの出力を返す偽LLM。"""
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def with_structured_output(self, schema):
+        def build():
+            return schema(**{name: "fake" for name in schema.model_fields})
+
+        def invoke(_inputs):
+            time.sleep(self.latency)
+            return build()
+
+        async def ainvoke(_inputs):
+            await asyncio.sleep(self.latency)
+            return build()
+
+        return RunnableLambda(invoke, afunc=ainvoke)
+
+def main():
+    parser = argparse.ArgumentParser(description="シード処理パイプラインのベンチマーク")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-concurrency", type=int, default=4)
+    parser.add_argument("--review-concurrency", type=int, default=3)
+    parser.add_argument("--jikan-rate", type=float, default=20.0, help="スタブへの1秒あたりのリクエスト数")
+    parser.add_argument("--summarize", action="store_true")
+    args = parser.parse_args()
+
+    JikanStubHandler.total = args.limit
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JikanStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    create_db_and_tables()
+    started_at = time.monotonic()
+    stats = asyncio.run(run_seed_pipeline(
+        args.limit,
+        summarize_reviews=args.summarize,
+        llm=FakeLLM(args.llm_latency),
+        base_url=base_url,
+        llm_concurrency=args.llm_concurrency,
+        review_concurrency=args.review_concurrency,
+        jikan_rate=args.jikan_rate,
+    ))
+    elapsed = time.monotonic() - started_at
+    server.shutdown()
+    print(f"{stats['saved']}件を{elapsed:.1f}秒で保存 ({stats['saved'] / elapsed:.2f}件/秒)")
+    print(f"保存先: {_bench_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import time
 import json
@@ -6,8 +7,11 @@ from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from app.models.manga import MangaCreate, Manga, engine, create_db_and_tables
 from app.services.manga import MangaService
+from app.services.seed import SeedJobService
 from sqlmodel import Session, select
 from app.graph.nodes import llm
+from app.core.llm_cache import cached_structured_invoke
+from app.core.llm_gateway import use_lane, LANE_BATCH
 from app.models.chroma import vectorDB
 
 
@@ -40,6 +44,20 @@ def fetch_top_manga(limit_count=300):
     return manga_list[:limit_count]
 
 # 2 IDを使ってreviewを取得する
+REVIEW_TOTAL_LIMIT = 30000 # 原文レビューを連結する際の文字数の上限
+REVIEW_SUMMARY_COUNT = 12  # 要約するレビューの件数。500*12の6000文字を想定
+
+def join_reviews(review_list, total_limit=REVIEW_TOTAL_LIMIT):
+    """レビューの原文を、合計文字数が上限を超えるまで連結する"""
+    total_count = 0
+    review_count = 0
+    for review in review_list:
+        total_count += len(review)
+        review_count += 1
+        if total_count > total_limit:
+            break
+    return "\n\n---\n\n".join(review_list[:review_count])
+
 def fetch_manga_reviews(manga_list):
     manga_list_with_reviews = []
     base_url = "https://api.jikan.moe/v4/manga/"
@@ -48,17 +66,7 @@ def fetch_manga_reviews(manga_list):
         response = requests.get(f"{base_url}{manga['mal_id']}/reviews?preliminary=true")
         data = response.json().get('data', [])
         review_list = [item.get('review') for item in data]
-
-        total_count = 0
-        total_limit = 30000
-        review_count = 0
-        for review in review_list:
-            total_count += len(review)
-            review_count += 1
-            if total_count > total_limit:
-                break
-
-        reviews = "\n\n---\n\n".join(review_list[:review_count])
+        reviews = join_reviews(review_list)
         # print(review)
         manga.update({"reviews": reviews})
         manga_list_with_reviews.append(manga)
@@ -70,26 +78,25 @@ def fetch_manga_reviews(manga_list):
 class AIreviewsummaryOutput(BaseModel):
     review: str
 
+review_summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
+     [Role]
+     あなたは漫画のレビューを適切に解釈し翻訳・要約するエキスパートです。
+     [Task]
+     - 英語のreview(感想)を日本語で500文字程度に要約し出力してください。
+     [Output]
+        - review: 要約した日本語の感想
+     """
+     ),
+     ("human", """
+     [漫画のreview]
+        - review: {review}
+      """
+    )
+])
+
 def fetch_manga_reviews_and_summarize(manga_list):
     """reviewを要約させる"""
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """
-         [Role]
-         あなたは漫画のレビューを適切に解釈し翻訳・要約するエキスパートです。
-         [Task]
-         - 英語のreview(感想)を日本語で500文字程度に要約し出力してください。
-         [Output]
-            - review: 要約した日本語の感想
-         """
-         ),
-         ("human", """
-         [漫画のreview]
-            - review: {review}
-          """
-        )
-    ])
-    chain = prompt | llm.with_structured_output(AIreviewsummaryOutput)
-
     manga_list_with_reviews = []
     base_url = "https://api.jikan.moe/v4/manga/"
     for i, manga in enumerate(manga_list):
@@ -97,10 +104,9 @@ def fetch_manga_reviews_and_summarize(manga_list):
         response = requests.get(f"{base_url}{manga['mal_id']}/reviews?preliminary=true")
         data = response.json().get('data', [])
         review_list = [item.get('review') for item in data]
-        review_count = 12 # 500*12の6000文字を想定
         sumarized_review_list = []
-        for review in review_list[:review_count]:
-            response = chain.invoke({"review": review})
+        for review in review_list[:REVIEW_SUMMARY_COUNT]:
+            response = cached_structured_invoke(review_summary_prompt, llm, AIreviewsummaryOutput, {"review": review})
             sumarized_review_list.append(response.review)
         reviews = "\n\n---\n\n".join(sumarized_review_list)
         manga.update({"reviews": reviews})
@@ -114,35 +120,48 @@ class AICommentOutput(BaseModel):
     ai_tags: str
     ai_comment: str
 
+comment_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
+     [Role]
+     あなたは漫画の情報を適切に解釈し翻訳・推薦するエキスパートです。
+     [Task]
+     1. 英語のsynopsis(あらすじ)を日本語に翻訳してください。
+     2. synopsis(あらすじ)・genres(ジャンル)・themes(テーマ)・reviews(複数人の感想)を参考に、
+        以下の項目を日本語で考えてください。
+        - ai_tags: その漫画を表すジャンルなどを内包する7〜15個の日本語のタグ。カンマ区切り。
+        - ai_comment: その漫画のおすすめポイントを400文字程度で簡潔にまとめる。
+     [Output]
+        - synopsis_ja: 翻訳したあらすじ
+        - ai_tags: 7〜10個の日本語のタグ。カンマ区切り。
+        - ai_comment: その漫画のおすすめポイント。
+     """
+     ),
+     ("human", """
+     [漫画の情報]
+        - title: {title}
+        - synopsis: {synopsis}
+        - genres: {genres}
+        - themes: {themes}
+        - reviews: {reviews}
+      """
+    )
+])
+
+def build_comment_inputs(item):
+    """Jikan APIの漫画データから、comment_promptへの入力を作る"""
+    return {
+        "title": item.get("title_japanese") or item.get("title"),
+        "synopsis": item.get("synopsis"),
+        "genres": ",".join([g.get("name") for g in item.get("genres", [])]),
+        "themes": ",".join([t.get("name") for t in item.get("themes", [])]),
+        "reviews": item.get("reviews")
+    }
+
 def comment_by_llm(title:str, synopsis:str, genres:str, themes:str, reviews:str):
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """
-         [Role]
-         あなたは漫画の情報を適切に解釈し翻訳・推薦するエキスパートです。
-         [Task]
-         1. 英語のsynopsis(あらすじ)を日本語に翻訳してください。
-         2. synopsis(あらすじ)・genres(ジャンル)・themes(テーマ)・reviews(複数人の感想)を参考に、
-            以下の項目を日本語で考えてください。
-            - ai_tags: その漫画を表すジャンルなどを内包する7〜15個の日本語のタグ。カンマ区切り。
-            - ai_comment: その漫画のおすすめポイントを400文字程度で簡潔にまとめる。
-         [Output]
-            - synopsis_ja: 翻訳したあらすじ
-            - ai_tags: 7〜10個の日本語のタグ。カンマ区切り。
-            - ai_comment: その漫画のおすすめポイント。
-         """
-         ),
-         ("human", """
-         [漫画の情報]
-            - title: {title}
-            - synopsis: {synopsis}
-            - genres: {genres}
-            - themes: {themes}
-            - reviews: {reviews}
-          """
-        )
-    ])
-    chain = prompt | llm.with_structured_output(AICommentOutput)
-    response = chain.invoke({"title": title,"synopsis": synopsis, "genres": genres, "themes": themes ,"reviews": reviews})
+    response = cached_structured_invoke(
+        comment_prompt, llm, AICommentOutput,
+        {"title": title,"synopsis": synopsis, "genres": genres, "themes": themes ,"reviews": reviews}
+    )
     print(response)
     try:
         return response.model_dump()
@@ -150,6 +169,26 @@ def comment_by_llm(title:str, synopsis:str, genres:str, themes:str, reviews:str)
         print(f"パースエラー: {e}")
         return {"synopsis_ja": synopsis, "ai_tags": "", "ai_comment": ""} # 失敗時は英語をそのまま返す
 
+def build_manga_data(item, result):
+    """Jikan APIの漫画データとLLMの加工結果から、Mangaテーブルに保存するデータを作る"""
+    return {
+        "title": item.get("title_japanese") or item.get("title"),
+        "author": ",".join([str(a.get("name")).replace(",", "") for a in item.get("authors", [])]),
+        "serialization": ",".join([s.get("name") for s in item.get("serializations", [])]),
+        "volumes": item.get("volumes"),
+        "status": item.get("status"),
+        "synopsis": result.get("synopsis_ja"),
+        "score": item.get("score"),
+        "image_url": item.get("images", {}).get("jpg", {}).get("large_image_url"),
+        "site_url": item.get("url"),
+        "site_id": item.get("mal_id"),
+        "ai_tags": result.get("ai_tags"),
+        "ai_comment": result.get("ai_comment")
+    }
+
+# LLM加工済みの漫画をまとめて保存する件数
+SAVE_BATCH_SIZE = 20
+
 # 4. RDB保存：取得したデータを整形してSQLiteに書き込む
 def save_manga_to_sqlite(raw_data_list, manga_service):
     """
@@ -174,103 +213,105 @@ def save_manga_to_sqlite(raw_data_list, manga_service):
         updated_at: Optional[datetime] = None
     """
     print(f"RDB保存開始 (全{len(raw_data_list)}件)")
-    
+
+    # 既存確認（保存済みのsite_idをまとめて取得）
+    site_ids = [item.get("mal_id") for item in raw_data_list if item.get("mal_id") is not None]
+    existing_site_ids = set(manga_service.session.exec(
+        select(Manga.site_id).where(Manga.site_id.in_(site_ids))
+    ).all()) if site_ids else set()
+
+    # 加工済みの漫画は溜めておき、SAVE_BATCH_SIZE件ごとにまとめて保存する（1件ごとのコミットを避ける）
+    pending = []
     for i, item in enumerate(raw_data_list):
-        print(f"---{i+1}/{len(raw_data_list)}件目を保存中---")
-        
-        # 既存確認
-        existing = manga_service.session.exec(
-                    select(Manga).where(Manga.site_id == item.get("mal_id"))
-                ).first()
-        if existing:
+        print(f"---{i+1}/{len(raw_data_list)}件目を処理中---")
+        if item.get("mal_id") in existing_site_ids:
             print(f"Skip (Already exists): {item.get('title')}")
             continue
 
         try:
             # 翻訳＆追加項目（LLM呼び出し）
-            result = comment_by_llm(
-                title = item.get("title_japanese") or item.get("title"), 
-                synopsis = item.get("synopsis"),
-                genres = ",".join([g.get("name") for g in item.get("genres", [])]), 
-                themes = ",".join([t.get("name") for t in item.get("themes", [])]), 
-                reviews = item.get("reviews")
-            )
+            result = comment_by_llm(**build_comment_inputs(item))
             # データ整形
-            manga_data = {
-                "title": item.get("title_japanese") or item.get("title"),
-                "author": ",".join([str(a.get("name")).replace(",", "") for a in item.get("authors", [])]),
-                "serialization": ",".join([s.get("name") for s in item.get("serializations", [])]),
-                "volumes": item.get("volumes"),
-                "status": item.get("status"),
-                "synopsis": result.get("synopsis_ja"),
-                "score": item.get("score"),
-                "image_url": item.get("images", {}).get("jpg", {}).get("large_image_url"),
-                "site_url": item.get("url"),
-                "site_id": item.get("mal_id"),
-                "ai_tags": result.get("ai_tags"),
-                "ai_comment": result.get("ai_comment")
-            }
-            
-            # 保存実行
-            manga_obj = MangaCreate.model_validate(manga_data)
-            manga_service.create_manga(params=manga_obj, vector_sync=False)
-            
-            print(f"[{i+1}/{len(raw_data_list)}] Saved: {manga_data['title']}")
+            manga_data = build_manga_data(item, result)
+            pending.append(MangaCreate.model_validate(manga_data))
+            print(f"[{i+1}/{len(raw_data_list)}] Processed: {manga_data['title']}")
             time.sleep(1) # LLMサーバー(Ollama)の負荷調整用
-            
+
         except Exception as e:
-            print(f"Error saving {item.get('title')}: {e}")
+            print(f"Error processing {item.get('title')}: {e}")
+
+        if len(pending) >= SAVE_BATCH_SIZE:
+            _save_pending(manga_service, pending)
+            pending = []
+    if pending:
+        _save_pending(manga_service, pending)
+
+def _save_pending(manga_service, pending):
+    """溜めておいた漫画を一括登録する"""
+    try:
+        result = manga_service.bulk_upsert(pending, vector_sync=False)
+        print(f"Saved: {result['inserted']}件登録, {result['updated']}件更新")
+    except Exception as e:
+        manga_service.session.rollback()
+        print(f"Error saving {len(pending)} mangas: {e}")
 
-# 3. ベクトルDB同期：一括でベクトル化する（共通処理）
+# 3. ベクトルDB同期：変更のあった漫画だけをベクトル化する（共通処理）
 def sync_vector_store_batch(vector_db, batch_size=30):
-    """RDBの内容をベクトルDBへ一括登録する（ベクトル化担当）"""
+    """RDBの内容をベクトルDBへ差分同期する（ベクトル化担当）"""
     with Session(engine) as session:
-        all_manga = session.exec(select(Manga)).all()
-        print(f"ベクトル構築開始（全{len(all_manga)}件）---")
-        docs = []
-        ids = []
-        for m in all_manga:
-            content = f"タグ：{m.ai_tags},タイトル：{m.title},おすすめ：{m.ai_comment},あらすじ：{m.synopsis}"
-            docs.append(Document(page_content=content, metadata={"id": m.id, "title": m.title}))
-            ids.append(str(m.id))
-        for i in range(0, len(docs), batch_size):
-            vector_db.add_documents(docs[i:i+batch_size], ids=ids[i:i+batch_size])
-            print(f" {i+len(docs[i:i+batch_size])}/{len(docs)}バッチ登録中")
+        print("ベクトル差分同期開始---")
+        result = MangaService(session, vector_db).sync_vector_store(
+            batch_size=batch_size,
+            on_progress=lambda done, total: print(f" {done}/{total}バッチ登録中")
+        )
+        print(f"ベクトル同期完了: {result}")
+        return result
 
 # 4. 実行関数
-def run_full_seed_pipeline(limit: int):
+def run_seed_job(job_id: int):
+    """
+    シードジョブを実行（または再開）する。
+    途中結果はステージングテーブルに保存されるため、再開時は完了済みの取得・LLM加工をやり直さない。
+    """
+    # 循環importを避けるため関数内でimportする
+    from app.scripts.seed_pipeline import run_seed_pipeline
+
     # 1. テーブル作成
     create_db_and_tables()
-    
-    # 2. API取得 (既存関数)
-    raw_data = fetch_top_manga(limit)
-    raw_data_with_reviews = fetch_manga_reviews(raw_data)
-    # raw_data_with_reviews = fetch_manga_reviews_and_summarize(raw_data)
-    
-    # 3. SQLite保存 (既存関数を少し修正：ID重複チェックを入れる)
     with Session(engine) as session:
-        manga_service = MangaService(session, vectorDB)
-        save_manga_to_sqlite(raw_data_with_reviews, manga_service)
-        
-    # 4. ベクトル同期 (既存関数)
-    sync_vector_store_batch(vectorDB)
+        job = SeedJobService(session).start_job(job_id)
+    if not job:
+        print(f"シードジョブが見つからないか、実行待ちではありません: {job_id}")
+        return
 
-# 4.5. 実行関数(レビューサマリー版)
-def run_full_seed_pipeline_review_sumarize(limit: int):
-    # 1. テーブル作成
+    try:
+        # LLM・埋め込みの呼び出しはbatchレーンで行い、チャットの呼び出しを優先させる
+        with use_lane(LANE_BATCH):
+            # 2. API取得・(レビュー要約)・LLM加工・SQLite保存 (ステージ間をキューでつないだ非同期パイプライン)
+            asyncio.run(run_seed_pipeline(job.limit, summarize_reviews=job.summarize_reviews, job_id=job_id))
+
+            # 3. ベクトル同期 (既存関数)
+            sync_vector_store_batch(vectorDB)
+    except Exception as e:
+        with Session(engine) as session:
+            SeedJobService(session).finish_job(job_id, "failed", error=str(e))
+        raise
+    with Session(engine) as session:
+        SeedJobService(session).finish_job(job_id, "completed")
+
+def create_seed_job(limit: int, summarize_reviews: bool = False) -> int:
+    """シードジョブを作成し、そのIDを返す"""
     create_db_and_tables()
-    
-    # 2. API取得 (既存関数)
-    raw_data = fetch_top_manga(limit)
-    # raw_data_with_reviews = fetch_manga_reviews(raw_data)
-    raw_data_with_reviews = fetch_manga_reviews_and_summarize(raw_data)
-    
-    # 3. SQLite保存 (既存関数を少し修正：ID重複チェックを入れる)
     with Session(engine) as session:
-        manga_service = MangaService(session, vectorDB)
-        save_manga_to_sqlite(raw_data_with_reviews, manga_service)
-        
-    # 4. ベクトル同期 (既存関数)
-    sync_vector_store_batch(vectorDB)
+        return SeedJobService(session).create_job(limit, summarize_reviews=summarize_reviews).id
+
+def run_full_seed_pipeline(limit: int):
+    """原文のレビューを使って、シード処理を実行する"""
+    run_seed_job(create_seed_job(limit, summarize_reviews=False))
+
+# 4.5. 実行関数(レビューサマリー版)
+def run_full_seed_pipeline_review_sumarize(limit: int):
+    """レビューを要約してから使う版のシード処理を実行する"""
+    run_seed_job(create_seed_job(limit, summarize_reviews=True))
 
-# run_full_seed_pipeline(10)
\ No newline at end of file
+# run_full_seed_pipeline(10)
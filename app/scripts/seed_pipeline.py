@@ -0,0 +1,283 @@
+"""
+シード処理（Jikan APIからの取得・LLMによる加工・SQLiteへの保存）を行う非同期パイプラインです。
+「ページ取得」「レビュー取得」「LLM加工」の3ステージをキューでつなぎ、
+最初のページが届いた時点から後段の処理が並行して進むようにしています。
+
+- Jikan APIへのリクエストは、全ステージで共有するトークンバケットでレート制限します。
+- HTTPクライアントは1つを使い回し、コネクションをプールします。
+- LLM呼び出しは設定値 SEED_LLM_CONCURRENCY の同時実行数に制限し、応答はLLM応答キャッシュを通します。
+- 各ステージの結果は`mal_id`とステージ名をキーにステージングテーブルへ保存し、
+  再実行時は保存済みの結果を再利用します（途中で落ちてもLLM呼び出しをやり直しません）。
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+import httpx
+from sqlmodel import Session, select
+from app.core.config import settings
+from app.core.llm_cache import acached_structured_invoke
+from app.models.manga import Manga, MangaCreate, engine
+from app.models.seed import STAGE_REVIEWS, STAGE_REVIEW_SUMMARIES, STAGE_ENRICH_RAW, STAGE_ENRICH_SUMMARY
+from app.services.manga import MangaService
+from app.services.seed import SeedJobService
+from app.scripts.db_seed import (
+    AICommentOutput, AIreviewsummaryOutput, comment_prompt, review_summary_prompt,
+    build_comment_inputs, build_manga_data, join_reviews, REVIEW_SUMMARY_COUNT
+)
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッター。
+    1秒あたり`rate`個のトークンが補充され、最大`capacity`個まで貯められます。
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """トークンを1つ取得します。無い場合は補充されるまで待ちます。"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class JikanClient:
+    """レート制限とリトライ付きのJikan APIクライアント。"""
+    def __init__(self, client: httpx.AsyncClient, limiter: TokenBucket,
+                 base_url: str = settings.JIKAN_BASE_URL, max_retries: int = 3):
+        self.client = client
+        self.limiter = limiter
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+
+    async def get_json(self, path: str, params: dict | None = None) -> dict:
+        """GETリクエストを送り、JSONを返します。429や5xxの場合は待ってから再試行します。"""
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            response = await self.client.get(f"{self.base_url}{path}", params=params)
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt < self.max_retries:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+            response.raise_for_status()
+            return response.json()
+
+    async def fetch_top_manga_page(self, page: int) -> list[dict]:
+        """TOP漫画の1ページ分の基本情報を取得します。"""
+        data = await self.get_json("/top/manga", params={"page": page})
+        return data.get("data", [])
+
+    async def fetch_reviews(self, mal_id: int) -> list[str]:
+        """漫画のレビュー本文のリストを取得します。"""
+        data = await self.get_json(f"/manga/{mal_id}/reviews", params={"preliminary": "true"})
+        return [item.get("review") for item in data.get("data", []) if item.get("review")]
+
+class SeedPipeline:
+    """
+    ページ取得 → レビュー取得 → LLM加工(+保存) の3ステージからなるシード処理パイプライン。
+
+    Args:
+        limit (int): 取得する漫画の件数。
+        summarize_reviews (bool): レビューをLLMで要約してから使うかどうか。
+        llm: 使用するLLM。省略時はアプリ共通のLLMを使います。
+        base_url (str): Jikan APIのベースURL。
+        llm_concurrency (int): LLM呼び出しの同時実行数。
+        review_concurrency (int): レビュー取得の並列数。
+        jikan_rate (float): Jikan APIへの1秒あたりのリクエスト数。
+        job_id (int): 進捗を記録するシードジョブのID。省略時は記録しません。
+    """
+    # 進捗をジョブに書き込む最短の間隔（秒）
+    PROGRESS_INTERVAL_SEC = 1.0
+
+    def __init__(self, limit: int, summarize_reviews: bool = False, llm=None,
+                 base_url: str = settings.JIKAN_BASE_URL,
+                 llm_concurrency: int = settings.SEED_LLM_CONCURRENCY,
+                 review_concurrency: int = settings.SEED_REVIEW_CONCURRENCY,
+                 jikan_rate: float = settings.JIKAN_RATE_PER_SEC,
+                 queue_size: int = settings.SEED_QUEUE_SIZE,
+                 job_id: Optional[int] = None):
+        if llm is None:
+            from app.graph.nodes import llm
+        self.limit = limit
+        self.summarize_reviews = summarize_reviews
+        self.base_url = base_url
+        self.llm_concurrency = llm_concurrency
+        self.review_concurrency = review_concurrency
+        self.jikan_rate = jikan_rate
+        self.queue_size = queue_size
+        self.job_id = job_id
+        self._progress_saved_at = 0.0
+        self.llm = llm
+        self.stats = {"fetched": 0, "skipped": 0, "reviewed": 0, "enriched": 0, "saved": 0, "failed": 0, "reused": 0}
+
+    async def run(self) -> dict:
+        """パイプラインを実行し、ステージごとの処理件数を返します。"""
+        started_at = time.monotonic()
+        self._existing_site_ids = self._load_existing_site_ids()
+        self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        limiter = TokenBucket(self.jikan_rate, settings.JIKAN_RATE_BURST)
+        limits = httpx.Limits(max_connections=settings.JIKAN_MAX_CONNECTIONS)
+
+        async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+            self.jikan = JikanClient(client, limiter, self.base_url)
+            review_queue = asyncio.Queue(maxsize=self.queue_size)
+            enrich_queue = asyncio.Queue(maxsize=self.queue_size)
+            review_workers = [
+                asyncio.create_task(self._review_worker(review_queue, enrich_queue))
+                for _ in range(self.review_concurrency)
+            ]
+            enrich_workers = [
+                asyncio.create_task(self._enrich_worker(enrich_queue))
+                for _ in range(self.llm_concurrency)
+            ]
+            # ページ取得が終わったら、後段のワーカーに終了を伝える
+            try:
+                await self._fetch_pages(review_queue)
+            finally:
+                for _ in review_workers:
+                    await review_queue.put(None)
+                await asyncio.gather(*review_workers)
+                for _ in enrich_workers:
+                    await enrich_queue.put(None)
+                await asyncio.gather(*enrich_workers)
+                await self._persist_progress(force=True)
+
+        print(f"シード処理完了 ({time.monotonic() - started_at:.1f}秒): {self.stats}")
+        return self.stats
+
+    def _load_existing_site_ids(self) -> set[int]:
+        """保存済みの漫画のsite_idをまとめて取得します。"""
+        with Session(engine) as session:
+            return set(session.exec(select(Manga.site_id).where(Manga.site_id.is_not(None))).all())
+
+    async def _fetch_pages(self, review_queue: asyncio.Queue) -> None:
+        """ステージ1: TOP漫画のページを順に取得し、未登録の漫画をレビュー取得ステージへ流します。"""
+        page = 1
+        print(f"jikan apiからデータ取得開始（全{self.limit}件）")
+        while self.stats["fetched"] < self.limit:
+            print(f"---{page}ページ目を取得中---")
+            try:
+                items = await self.jikan.fetch_top_manga_page(page)
+            except httpx.HTTPError as e:
+                print(f"エラー: {e}")
+                break
+            if not items:
+                break
+            for item in items[:self.limit - self.stats["fetched"]]:
+                self.stats["fetched"] += 1
+                if item.get("mal_id") in self._existing_site_ids:
+                    self.stats["skipped"] += 1
+                    print(f"Skip (Already exists): {item.get('title')}")
+                    continue
+                await review_queue.put(item)
+            await self._persist_progress()
+            page += 1
+
+    async def _review_worker(self, review_queue: asyncio.Queue, enrich_queue: asyncio.Queue) -> None:
+        """ステージ2: 漫画ごとのレビューを取得し、LLM加工ステージへ流します。"""
+        while (item := await review_queue.get()) is not None:
+            mal_id = item["mal_id"]
+            try:
+                item["review_list"] = await self._staged(
+                    mal_id, STAGE_REVIEWS, lambda: self.jikan.fetch_reviews(mal_id)
+                )
+                self.stats["reviewed"] += 1
+                await enrich_queue.put(item)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Error fetching reviews {item.get('title')}: {e}")
+                await self._persist_progress()
+
+    async def _enrich_worker(self, enrich_queue: asyncio.Queue) -> None:
+        """ステージ3: レビューの整形（要約）とLLMによる翻訳・コメント生成を行い、SQLiteに保存します。"""
+        enrich_stage = STAGE_ENRICH_SUMMARY if self.summarize_reviews else STAGE_ENRICH_RAW
+        while (item := await enrich_queue.get()) is not None:
+            mal_id = item["mal_id"]
+            try:
+                item["reviews"] = await self._build_reviews(mal_id, item.pop("review_list"))
+                result = await self._staged(mal_id, enrich_stage, lambda: self._comment(item))
+                self.stats["enriched"] += 1
+                manga_data = build_manga_data(item, result)
+                await asyncio.to_thread(self._save, manga_data)
+                self.stats["saved"] += 1
+                print(f"[{self.stats['saved']}/{self.limit}] Saved: {manga_data['title']}")
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Error saving {item.get('title')}: {e}")
+            await self._persist_progress()
+
+    async def _comment(self, item: dict) -> dict:
+        """LLMで翻訳・タグ・コメントを生成します。"""
+        async with self._llm_semaphore:
+            response = await acached_structured_invoke(
+                comment_prompt, self.llm, AICommentOutput, build_comment_inputs(item)
+            )
+        return response.model_dump()
+
+    async def _build_reviews(self, mal_id: int, review_list: list[str]) -> str:
+        """レビューを1つの文字列にまとめます。要約モードの場合は各レビューをLLMで並列に要約します。"""
+        if not self.summarize_reviews:
+            return join_reviews(review_list)
+
+        async def summarize(review: str) -> str:
+            async with self._llm_semaphore:
+                response = await acached_structured_invoke(
+                    review_summary_prompt, self.llm, AIreviewsummaryOutput, {"review": review}
+                )
+            return response.review
+
+        async def summarize_all() -> list[str]:
+            return list(await asyncio.gather(*(summarize(r) for r in review_list[:REVIEW_SUMMARY_COUNT])))
+
+        summaries = await self._staged(mal_id, STAGE_REVIEW_SUMMARIES, summarize_all)
+        return "\n\n---\n\n".join(summaries)
+
+    async def _staged(self, mal_id: int, stage: str, produce: Callable[[], Awaitable[Any]]) -> Any:
+        """ステージングに結果があれば再利用し、無ければ`produce`で作成してステージングに保存します。"""
+        payload = await asyncio.to_thread(self._get_staged, mal_id, stage)
+        if payload is not None:
+            self.stats["reused"] += 1
+            return payload
+        payload = await produce()
+        await asyncio.to_thread(self._put_staged, mal_id, stage, payload)
+        return payload
+
+    def _get_staged(self, mal_id: int, stage: str) -> Any:
+        with Session(engine) as session:
+            return SeedJobService(session).get_staged(mal_id, stage)
+
+    def _put_staged(self, mal_id: int, stage: str, payload: Any) -> None:
+        with Session(engine) as session:
+            SeedJobService(session).put_staged(mal_id, stage, payload, job_id=self.job_id)
+
+    async def _persist_progress(self, force: bool = False) -> None:
+        """処理件数をジョブに書き込みます。書き込みすぎないよう一定間隔で間引きます。"""
+        if self.job_id is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._progress_saved_at < self.PROGRESS_INTERVAL_SEC:
+            return
+        self._progress_saved_at = now
+        await asyncio.to_thread(self._update_progress, dict(self.stats))
+
+    def _update_progress(self, counts: dict) -> None:
+        with Session(engine) as session:
+            SeedJobService(session).update_progress(self.job_id, counts)
+
+    def _save(self, manga_data: dict) -> None:
+        """加工済みの漫画データをSQLiteに保存します。再開時に同じ`site_id`の漫画が保存済みの場合は更新します。"""
+        with Session(engine) as session:
+            manga_service = MangaService(session)
+            manga_service.bulk_upsert([MangaCreate.model_validate(manga_data)], vector_sync=False)
+
+async def run_seed_pipeline(limit: int, summarize_reviews: bool = False, **kwargs) -> dict:
+    """シード処理パイプラインを実行します。"""
+    return await SeedPipeline(limit, summarize_reviews=summarize_reviews, **kwargs).run()
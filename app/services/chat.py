@@ -2,9 +2,41 @@
 大規模言語モデル(LLM)との対話に関するビジネスロジックを処理するサービスクラス。
 LangGraphで構築されたグラフ(Agent)を操作します。
 """
-from langchain_core.messages import HumanMessage, AIMessage
+from typing import AsyncIterator, Optional
+import numpy as np
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessageChunk
+from langchain_core.utils.json import parse_partial_json
 from app.graph.nodes import llm
 from app.graph.workflows import tool_llm_graph
+from app.core.config import settings
+from app.services.manga_cache import manga_cache
+from app.services.semantic_cache import semantic_cache
+
+# 回答をトークン単位でストリーミングするノード名
+ANSWER_NODE = "chatbot"
+
+def _chunk_text(chunk: BaseMessageChunk) -> str:
+    """
+    LLMのストリーミングチャンクから、構造化出力(JSON)の断片を取り出します。
+    JSONモードの場合は本文に、ツール呼び出しの場合は引数に断片が入ります。
+    """
+    if isinstance(chunk.content, str):
+        text = chunk.content
+    else:
+        text = "".join(part.get("text", "") for part in chunk.content if isinstance(part, dict))
+    for tool_call_chunk in getattr(chunk, "tool_call_chunks", None) or []:
+        text += tool_call_chunk.get("args") or ""
+    return text
+
+def _partial_answer(buffer: str) -> str:
+    """途中までのJSON文字列から、`answer`フィールドの現時点の値を取り出します。"""
+    try:
+        parsed = parse_partial_json(buffer)
+    except Exception:
+        return ""
+    if isinstance(parsed, dict) and isinstance(parsed.get("answer"), str):
+        return parsed["answer"]
+    return ""
 
 class LLMService:
     """LLMサービスのクラス"""
@@ -28,15 +60,154 @@ class LLMService:
         Returns:
             str: AIアシスタントからの最終的な応答メッセージ。
         """
-        # スレッドIDをコンフィグに設定
+        result = await self._run_graph(thread_id, message)
+        return result["answer"]
+
+    async def chat_full(self, thread_id: str, message: str) -> dict:
+        """
+        `chat`と同じくグラフを実行し、回答・推薦された漫画のIDリスト・漫画の詳細をまとめて返します。
+        グラフの実行結果をそのまま使い、漫画の詳細はグラフが読み込んだ漫画キャッシュから取り出すため、
+        会話状態の再読み込みや漫画の再取得は行いません。
+        会話の最初のメッセージが以前の質問とほぼ同じ場合は、グラフを実行せずにキャッシュの回答を返します。
+
+        Args:
+            thread_id (str): 会話を一意に識別するスレッドID。
+            message (str): ユーザーからのメッセージ。
+
+        Returns:
+            dict: {"answer": 回答, "found_manga_ids": [...], "manga": [MangaReadの辞書, ...]}
+        """
+        result = await self._run_graph(thread_id, message)
+        return {**result, "manga": await self.hydrate_manga(result["found_manga_ids"])}
+
+    async def _run_graph(self, thread_id: str, message: str) -> dict:
+        """セマンティックキャッシュを確認し、無ければグラフを実行して{"answer", "found_manga_ids"}を返します。"""
         config = {"configurable": {"thread_id": thread_id}}
-        # 入力メッセージを作成
+        cached, vector, generation = await self._lookup_semantic_cache(config, message)
+        if cached:
+            return {"answer": cached["answer"], "found_manga_ids": cached["found_manga_ids"]}
         inputs = {"messages": [HumanMessage(content=message)]}
         # グラフ(Agent)を非同期で実行
         response = await self.tool_llm_graph.ainvoke(inputs, config=config)
-        # 最後のメッセージ（AIの応答）を返す
-        return response["messages"][-1].content
+        result = {"answer": response["messages"][-1].content, "found_manga_ids": response.get("found_manga_ids", [])}
+        self._store_semantic_cache(message, vector, generation, result)
+        return result
+
+    async def _lookup_semantic_cache(self, config: dict, message: str) -> tuple[Optional[dict], Optional[np.ndarray], Optional[int]]:
+        """
+        会話の最初のメッセージであれば、セマンティックキャッシュから似た質問の回答を探します。
+        見つかった場合は、以降のターンで会話の履歴として使えるよう、質問と回答をスレッドの状態に書き込みます。
+
+        Returns:
+            tuple[Optional[dict], Optional[np.ndarray], Optional[int]]: (キャッシュの回答, メッセージの埋め込み, 検索前の世代)。
+                最初のメッセージでない場合やキャッシュが無効な場合は (None, None, None) です。
+                世代は、回答を保存する際に、その間に漫画の変更が無かったことの確認に使います。
+        """
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return None, None, None
+        # グラフが検索を始めるより前の世代を記録する
+        generation = semantic_cache.generation
+        checkpoint = await self.tool_llm_graph.checkpointer.aget_tuple(config)
+        if checkpoint and checkpoint.checkpoint["channel_values"].get("messages"):
+            return None, None, None
+        try:
+            vector = await semantic_cache.aembed(message)
+        except Exception as e:
+            # 埋め込みに失敗してもチャット自体は続ける
+            semantic_cache.record_error(e)
+            return None, None, None
+        cached = semantic_cache.lookup(vector)
+        if cached:
+            await self.tool_llm_graph.aupdate_state(
+                config,
+                {
+                    "messages": [HumanMessage(content=message), AIMessage(content=cached["answer"])],
+                    "found_manga_ids": cached["found_manga_ids"]
+                },
+                as_node=ANSWER_NODE
+            )
+        return cached, vector, generation
+
+    @staticmethod
+    def _store_semantic_cache(message: str, vector: Optional[np.ndarray], generation: Optional[int], result: dict) -> None:
+        """最初のメッセージに対する回答を、セマンティックキャッシュに保存します。"""
+        if vector is not None and result["answer"]:
+            semantic_cache.store(message, vector, result["answer"], result["found_manga_ids"], generation)
+
+    @staticmethod
+    async def hydrate_manga(manga_ids: list[int]) -> list[dict]:
+        """漫画IDのリストを、その順に漫画の詳細（MangaReadの辞書）に変換します。キャッシュに無い分はDBから読み込みます。"""
+        if not manga_ids:
+            return []
+        return await manga_cache.aget_in_order(manga_ids)
     
+    async def chat_stream(self, thread_id: str, message: str) -> AsyncIterator[dict]:
+        """
+        `chat`のストリーミング版です。グラフの進行と回答のトークンを、生成され次第イベントとして返します。
+
+        イベントは次のいずれかの辞書です。
+        - {"event": "node", "node": ノード名, "status": "start" | "end"}: ノードの開始・終了
+        - {"event": "token", "text": 文字列}: 回答の差分
+        - {"event": "done", "answer": 文字列, "found_manga_ids": [...], "manga": [...], "cached": bool}:
+          最終結果（漫画の詳細と、セマンティックキャッシュの回答かどうかを含む）
+        - {"event": "error", "message": 文字列}: 実行中のエラー
+
+        Args:
+            thread_id (str): 会話を一意に識別するスレッドID。
+            message (str): ユーザーからのメッセージ。
+        """
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            cached, vector, generation = await self._lookup_semantic_cache(config, message)
+            if cached:
+                # キャッシュの回答は全文を1つのトークンとして送る
+                yield {"event": "token", "text": cached["answer"]}
+                yield {
+                    "event": "done",
+                    "answer": cached["answer"],
+                    "found_manga_ids": cached["found_manga_ids"],
+                    "manga": await self.hydrate_manga(cached["found_manga_ids"]),
+                    "cached": True
+                }
+                return
+        except Exception as e:
+            yield {"event": "error", "message": str(e)}
+            return
+        inputs = {"messages": [HumanMessage(content=message)]}
+        # chatbotノードのLLM出力（JSON）の断片を溜め、answerの増えた分だけを送る
+        buffer = ""
+        sent_answer = ""
+        final_state = None
+        try:
+            async for event in self.tool_llm_graph.astream_events(inputs, config=config, version="v2"):
+                kind = event["event"]
+                node = event.get("metadata", {}).get("langgraph_node")
+                # グラフ直下のノードのイベントだけを進行状況として送る（ノード内部のRunnableは除く）
+                if kind in ("on_chain_start", "on_chain_end") and event["name"] == node and len(event.get("parent_ids", [])) == 1:
+                    yield {"event": "node", "node": node, "status": "start" if kind == "on_chain_start" else "end"}
+                elif kind == "on_chat_model_stream" and node == ANSWER_NODE:
+                    buffer += _chunk_text(event["data"]["chunk"])
+                    answer = _partial_answer(buffer)
+                    if len(answer) > len(sent_answer) and answer.startswith(sent_answer):
+                        yield {"event": "token", "text": answer[len(sent_answer):]}
+                        sent_answer = answer
+                elif kind == "on_chain_end" and not event.get("parent_ids"):
+                    # グラフ全体の終了イベントに最終状態が含まれるため、会話状態を読み直さずに使う
+                    final_state = event["data"]["output"]
+            if final_state is None:
+                final_state = (await self.tool_llm_graph.aget_state(config)).values
+            manga = await self.hydrate_manga(final_state.get("found_manga_ids", []))
+        except Exception as e:
+            yield {"event": "error", "message": str(e)}
+            return
+        answer = final_state["messages"][-1].content
+        found_manga_ids = final_state.get("found_manga_ids", [])
+        self._store_semantic_cache(message, vector, generation, {"answer": answer, "found_manga_ids": found_manga_ids})
+        # ストリーミングできなかった場合（LLMがストリーミング非対応など）も、残りの回答を送る
+        if answer.startswith(sent_answer) and len(answer) > len(sent_answer):
+            yield {"event": "token", "text": answer[len(sent_answer):]}
+        yield {"event": "done", "answer": answer, "found_manga_ids": found_manga_ids, "manga": manga, "cached": False}
+
     async def get_found_manga_ids(self, thread_id: str) -> list[int]:
         """
         指定されたスレッドIDの会話状態から、見つかった漫画のIDリストを取得します。
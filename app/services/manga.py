@@ -2,28 +2,59 @@
 漫画情報に関するビジネスロジックを処理するサービスクラス。
 データベースセッションとベクトルDBクライアントを操作します。
 """
+import asyncio
 import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, List
-from sqlmodel import Session, select, col, or_, desc
+from typing import Callable, Optional, List, TYPE_CHECKING
+from sqlmodel import Session, select, col, or_, desc, text
+from sqlalchemy import Integer, and_, bindparam, delete, func, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel.ext.asyncio.session import AsyncSession
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
-from app.models.manga import Manga, MangaCreate, MangaUpdate, MangaSearchKeywordParams, MangaSearchQueryParams, MangaSearchVectorParams
+from app.models.manga import (
+    Manga, MangaCreate, MangaUpdate, MangaFacet, MangaSearchKeywordParams, MangaSearchQueryParams, MangaSearchVectorParams,
+    FACET_FIELDS, build_facet_rows, split_tags
+)
 from app.core.config import settings
+from app.core.pagination import encode_cursor, decode_cursor
+from app.services.manga_cache import manga_cache
+from app.services.manga_stats import manga_stats, snapshot, STATS_FIELDS
+from app.services.semantic_cache import semantic_cache
+
+if TYPE_CHECKING:
+    from app.services.vector_indexer import VectorIndexer
+
+# FTS5のtrigramトークナイザは3文字未満の語を検索できないため、それより短い語はLIKE検索で扱います
+FTS_MIN_TERM_LENGTH = 3
+# BM25の列ごとの重み (title, synopsis, ai_tags)
+FTS_BM25_WEIGHTS = (3.0, 1.0, 2.0)
+# 全文検索インデックスの対象フィールド
+FTS_FIELDS = ("title", "synopsis", "ai_tags")
+# ベクトルDBに登録する本文の元になるフィールド
+VECTOR_FIELDS = ("ai_tags", "title", "ai_comment", "synopsis", "my_review")
+
+# ベクトル検索（Chroma）の問い合わせ専用のスレッドプール。Chromaは同期APIのみのため、非同期の検索はここで実行する
+vector_query_executor = ThreadPoolExecutor(max_workers=settings.VECTOR_QUERY_WORKERS, thread_name_prefix="vector-query")
 
 class MangaService:
     """漫画サービスのクラス"""
     def __init__(self, session: Session,
-                 vectorDB: Optional[Chroma] = None):
+                 vectorDB: Optional[Chroma] = None,
+                 vector_indexer: Optional["VectorIndexer"] = None):
         """
         コンストラクタ
 
         Args:
             session (Session): SQLModelのデータベースセッション
             vectorDB (Optional[Chroma]): ベクトルDBクライアント
+            vector_indexer (Optional[VectorIndexer]): 変更をベクトルDBへ非同期に反映するインデクサ
         """
         self.session = session
         self.vectorDB = vectorDB
+        self.vector_indexer = vector_indexer
 
     def get_manga(self, manga_id: int) -> Optional[Manga]:
         """IDで単一の漫画を取得します。"""
@@ -34,65 +65,400 @@ class MangaService:
         statement = select(Manga).where(Manga.id.in_(manga_ids))
         return self.session.exec(statement).all()
 
+    def get_manga_list_by_ids_in_order(self, manga_ids: list[int]) -> list[Manga]:
+        """IDのリストに基づいて漫画を取得し、与えられたIDの順に並べて返します。"""
+        if not manga_ids:
+            return []
+        result_map = {m.id: m for m in self.get_manga_list_by_ids(manga_ids)}
+        return [result_map[m_id] for m_id in manga_ids if m_id in result_map]
+
     def create_manga(self, params: MangaCreate, vector_sync: bool = True) -> Manga:
         """新しい漫画を作成します。"""
         manga = Manga.model_validate(params)
         manga.created_at = datetime.now()
         manga.updated_at = datetime.now()
         self.session.add(manga)
+        self.session.flush()
+        self._sync_fts(manga)
+        self._sync_facets([manga.id])
         self.session.commit()
         self.session.refresh(manga)
-        # ベクトル同期が有効な場合、ベクトルを作成
-        # if (manga.summary or manga.tags) and vector_sync:
-        #     self._sync_vector(manga)
+        self._notify_changed([manga.id], added_or_removed=True)
+        manga_stats.apply(added=[snapshot(manga)])
+        # ベクトル同期が有効な場合、ベクトルの作成をインデクサに依頼
+        if vector_sync:
+            self._sync_vector([manga.id])
         return manga
 
+    def bulk_upsert(self, items: list[MangaCreate], vector_sync: bool = True,
+                    batch_size: int = settings.BULK_UPSERT_BATCH_SIZE) -> dict:
+        """
+        漫画をまとめて登録します。`site_id`が登録済みの漫画は、その行を更新します（カタログの取り込み用）。
+        `INSERT ... ON CONFLICT(site_id) DO UPDATE`をbatch_size件ずつ実行し、全体を1つのトランザクションでコミットします。
+        更新時は値がNoneの項目で既存の値を上書きしないため、ユーザーの感想・評価などは取り込みで消えません。
+
+        Returns:
+            dict: 登録・更新した漫画のID（重複は除く）と、新規登録した件数・更新した件数。
+        """
+        now = datetime.now()
+        rows = [
+            {**item.model_dump(exclude={"created_at", "updated_at"}), "created_at": item.created_at or now, "updated_at": now}
+            for item in items
+        ]
+        # 1行分のINSERT文をexecutemanyで実行すると、SQLAlchemyが複数行のVALUESにまとめて送る（文のコンパイルは1回で済む）
+        table = Manga.__table__
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.site_id],
+            set_={
+                name: func.coalesce(statement.excluded[name], table.c[name])
+                for name in MangaCreate.model_fields if name not in ("created_at", "updated_at")
+            } | {"updated_at": statement.excluded.updated_at}
+        ).returning(table.c.id)
+        stats_columns = [getattr(Manga, field) for field in STATS_FIELDS]
+        manga_ids: list[int] = []
+        # 統計に反映するための、この呼び出しの前の行のスナップショット（前のバッチで登録した行は含めない）
+        before: list[tuple] = []
+        upserted_site_ids = set()
+        inserted = 0
+        updated = 0
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i+batch_size]
+            site_ids = {row["site_id"] for row in batch if row["site_id"] is not None}
+            existing = set()
+            if site_ids:
+                for row in self.session.exec(select(Manga.site_id, *stats_columns).where(col(Manga.site_id).in_(site_ids))):
+                    existing.add(row[0])
+                    if row[0] not in upserted_site_ids:
+                        before.append(tuple(row[1:]))
+            upserted_site_ids |= site_ids
+            for row in batch:
+                if row["site_id"] is not None and row["site_id"] in existing:
+                    updated += 1
+                else:
+                    inserted += 1
+                    existing.add(row["site_id"])
+            manga_ids.extend(self.session.connection().execute(statement, batch).scalars())
+        manga_ids = list(dict.fromkeys(manga_ids))
+        self._sync_fts_ids(manga_ids, batch_size)
+        self._sync_facets(manga_ids, batch_size)
+        after = [
+            tuple(row)
+            for i in range(0, len(manga_ids), batch_size)
+            for row in self.session.exec(select(*stats_columns).where(col(Manga.id).in_(manga_ids[i:i+batch_size])))
+        ]
+        self.session.commit()
+        self._notify_changed(manga_ids, added_or_removed=inserted > 0)
+        manga_stats.apply(removed=before, added=after)
+        # ベクトル同期が有効な場合、変更した漫画をまとめてインデクサに依頼
+        if vector_sync and manga_ids:
+            self._sync_vector(manga_ids)
+        return {"ids": manga_ids, "inserted": inserted, "updated": updated}
+
     def update_manga(self, manga_id: int, params: MangaUpdate, vector_sync: bool = True) -> Optional[Manga]:
         """既存の漫画を更新します。"""
         manga = self.session.get(Manga, manga_id)
         if not manga:
             return None
+        before = snapshot(manga)
         update_data = params.model_dump(exclude_unset=True)
         manga.sqlmodel_update(update_data)
         manga.updated_at = datetime.now()
         self.session.add(manga)
+        if any(field in update_data for field in FTS_FIELDS):
+            self._sync_fts(manga)
+        if any(field in update_data for field in FACET_FIELDS.values()):
+            self.session.flush()
+            self._sync_facets([manga.id])
         self.session.commit()
         self.session.refresh(manga)
-        # # ベクトル同期が有効で、対象フィールドが更新された場合、ベクトルを更新
-        # if ("summary" in update_data or "tags" in update_data) and vector_sync:
-        #     self._sync_vector(manga)
+        self._notify_changed([manga.id])
+        manga_stats.apply(removed=[before], added=[snapshot(manga)])
+        # ベクトル同期が有効で、対象フィールドが更新された場合、ベクトルの更新をインデクサに依頼
+        if vector_sync and any(field in update_data for field in VECTOR_FIELDS):
+            self._sync_vector([manga.id])
         return manga
 
-    def delete_manga(self, manga_id: int) -> Optional[Manga]:
+    def delete_manga(self, manga_id: int, vector_sync: bool = True) -> Optional[Manga]:
         """漫画を削除します。"""
         manga = self.session.get(Manga, manga_id)
         if not manga:
             return None
+        before = snapshot(manga)
         self.session.delete(manga)
+        self._delete_fts(manga_id)
+        self.session.connection().execute(delete(MangaFacet).where(col(MangaFacet.manga_id) == manga_id))
         self.session.commit()
+        self._notify_changed([manga_id], added_or_removed=True)
+        manga_stats.apply(removed=[before])
+        # 削除された漫画はインデクサがベクトルDBからも削除する
+        if vector_sync:
+            self._sync_vector([manga_id])
         # 削除したオブジェクトを返すことで、エンドポイント側で情報を利用できる
         return manga
     
-    def get_manga_list_by_keyword(self, params: MangaSearchKeywordParams) -> List[Manga]:
-        """キーワードで漫画を検索します（タイトル、あらすじ、タグが対象）。"""
-        statement = select(Manga).where(
-            or_(
-                col(Manga.title).like(f"%{params.keyword}%"),
-                col(Manga.synopsis).like(f"%{params.keyword}%"),
-                col(Manga.ai_tags).like(f"%{params.keyword}%")
+    @staticmethod
+    def _notify_changed(manga_ids: list[int], added_or_removed: bool = False) -> None:
+        """
+        漫画の変更を、漫画情報を保持しているキャッシュに反映します。
+        漫画が追加・削除された場合はどの質問の回答も変わり得るため、セマンティックキャッシュを全て削除します。
+        更新の場合は、その漫画を回答に含むエントリだけを削除します。
+        """
+        manga_cache.invalidate(manga_ids)
+        if added_or_removed:
+            semantic_cache.clear()
+        else:
+            semantic_cache.invalidate_manga(manga_ids)
+
+    @staticmethod
+    def _notify_vectors_changed(changed: int) -> None:
+        """
+        ベクトルDBへの反映が終わった時に、セマンティックキャッシュを全て削除します。
+        ベクトルの登録・削除はどの質問の検索結果も変え得るため、SQLの変更時の無効化の後、反映までの間に
+        古いベクトルで検索して保存された回答も、ここで削除します。
+        """
+        if changed:
+            semantic_cache.clear()
+
+    def _sync_vector(self, manga_ids: list[int]) -> None:
+        """
+        ベクトルDBへの反映をインデクサのキューに積みます。
+        埋め込みはバックグラウンドで行われるため、API応答は埋め込みモデルを待ちません。
+        """
+        if self.vector_indexer:
+            self.vector_indexer.enqueue(manga_ids)
+
+    def _sync_fts(self, manga: Manga) -> None:
+        """全文検索インデックス`manga_fts`の該当行を最新の内容で置き換えます（コミットは呼び出し側で行います）。"""
+        self._delete_fts(manga.id)
+        self.session.connection().execute(
+            text("INSERT INTO manga_fts(rowid, title, synopsis, ai_tags) VALUES (:id, :title, :synopsis, :ai_tags)"),
+            {"id": manga.id, "title": manga.title, "synopsis": manga.synopsis, "ai_tags": manga.ai_tags}
+        )
+
+    def _sync_fts_ids(self, manga_ids: list[int], batch_size: int) -> None:
+        """全文検索インデックス`manga_fts`の複数の行を、`manga`テーブルの内容でまとめて置き換えます（コミットは呼び出し側で行います）。"""
+        delete_statement = text("DELETE FROM manga_fts WHERE rowid IN :ids").bindparams(bindparam("ids", expanding=True))
+        insert_statement = text(
+            "INSERT INTO manga_fts(rowid, title, synopsis, ai_tags) "
+            "SELECT id, title, synopsis, ai_tags FROM manga WHERE id IN :ids"
+        ).bindparams(bindparam("ids", expanding=True))
+        for i in range(0, len(manga_ids), batch_size):
+            ids = manga_ids[i:i+batch_size]
+            self.session.connection().execute(delete_statement, {"ids": ids})
+            self.session.connection().execute(insert_statement, {"ids": ids})
+
+    def _sync_facets(self, manga_ids: list[int], batch_size: int = settings.BULK_UPSERT_BATCH_SIZE) -> None:
+        """
+        転置インデックス`manga_facet`の該当する漫画の行を、`manga`テーブルのタグ・著者・連載誌で置き換えます（コミットは呼び出し側で行います）。
+        """
+        columns = [getattr(Manga, field) for field in FACET_FIELDS.values()]
+        for i in range(0, len(manga_ids), batch_size):
+            ids = manga_ids[i:i+batch_size]
+            self.session.connection().execute(delete(MangaFacet).where(col(MangaFacet.manga_id).in_(ids)))
+            rows = self.session.exec(select(Manga.id, *columns).where(col(Manga.id).in_(ids))).all()
+            facet_rows = [facet for row in rows for facet in build_facet_rows(row.id, row._mapping)]
+            if facet_rows:
+                self.session.connection().execute(insert(MangaFacet), facet_rows)
+
+    def _delete_fts(self, manga_id: int) -> None:
+        """全文検索インデックス`manga_fts`から該当行を削除します（コミットは呼び出し側で行います）。"""
+        self.session.connection().execute(
+            text("DELETE FROM manga_fts WHERE rowid = :id"), {"id": manga_id}
+        )
+
+    @staticmethod
+    def _build_fts_query(keyword: str) -> Optional[str]:
+        """
+        キーワードをFTS5のMATCH式に変換します。空白区切りの各語をフレーズとしてAND検索します。
+        trigramで検索できない短い語を含む場合はNoneを返します。
+        """
+        terms = keyword.split()
+        if not terms or any(len(term) < FTS_MIN_TERM_LENGTH for term in terms):
+            return None
+        return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    @classmethod
+    def _build_keyword_search(cls, keyword: str, limit: int):
+        """
+        キーワード検索のSQLを作成します（同期版・非同期版で共用）。
+        全文検索インデックスを使える場合はBM25の順、使えない短い語の場合はLIKE検索の評価順のSQLになります。
+
+        Returns:
+            tuple: (SQL, 全文検索インデックスを使うかどうか)
+        """
+        fts_query = cls._build_fts_query(keyword)
+        if fts_query is None:
+            statement = select(Manga.id).where(
+                or_(
+                    col(Manga.title).like(f"%{keyword}%"),
+                    col(Manga.synopsis).like(f"%{keyword}%"),
+                    col(Manga.ai_tags).like(f"%{keyword}%")
+                )
+            )
+            return statement.order_by(desc(Manga.score)).limit(limit), False
+
+        weights = ", ".join(str(w) for w in FTS_BM25_WEIGHTS)
+        statement = text(
+            f"SELECT rowid FROM manga_fts WHERE manga_fts MATCH :query "
+            f"ORDER BY bm25(manga_fts, {weights}) LIMIT :limit"
+        ).bindparams(query=fts_query, limit=limit)
+        return statement, True
+
+    def search_keyword_ids(self, keyword: str, limit: int) -> list[int]:
+        """
+        キーワードに一致する漫画のIDを関連度順に返します。
+        全文検索インデックスを使える場合はBM25の順、使えない短い語の場合はLIKE検索の評価順になります。
+        """
+        statement, use_fts = self._build_keyword_search(keyword, limit)
+        if not use_fts:
+            return list(self.session.exec(statement).all())
+        return [row[0] for row in self.session.connection().execute(statement)]
+
+    def get_manga_list_by_keyword(self, params: MangaSearchKeywordParams) -> tuple[List[Manga], Optional[str]]:
+        """
+        キーワードで漫画を検索します（タイトル、あらすじ、タグが対象）。
+        `params.sort`が"relevance"の場合は関連度順（全文検索インデックスを使えない短い語は評価順）です。
+
+        Returns:
+            tuple: (このページの漫画, 次のページのカーソル。最後のページの場合はNone)
+        """
+        fts_query = self._build_fts_query(params.keyword)
+        if params.sort != "relevance":
+            statement = select(Manga).where(self._keyword_condition(params.keyword, fts_query))
+            return self._paginate(statement, params.sort, params.limit, params.cursor)
+        if fts_query is None:
+            # LIKE検索の関連度は評価順のため、評価順のキーでページを区切る
+            statement = select(Manga).where(self._keyword_condition(params.keyword, fts_query))
+            return self._paginate(statement, "score", params.limit, params.cursor, cursor_sort="relevance")
+
+        position = self._read_cursor(params.cursor, "relevance")
+        # BM25の値（小さいほど関連度が高い）とrowidの昇順で並べ、カーソルより後ろの行を取得する
+        weights = ", ".join(str(w) for w in FTS_BM25_WEIGHTS)
+        statement = text(
+            f"SELECT rowid, rank FROM (SELECT rowid, bm25(manga_fts, {weights}) AS rank FROM manga_fts WHERE manga_fts MATCH :query) "
+            f"WHERE :rank IS NULL OR rank > :rank OR (rank = :rank AND rowid > :id) "
+            f"ORDER BY rank, rowid LIMIT :limit"
+        ).bindparams(
+            query=fts_query, limit=params.limit + 1,
+            rank=position["value"] if position else None, id=position["id"] if position else None
+        )
+        rows = self.session.connection().execute(statement).all()
+        next_cursor = None
+        if len(rows) > params.limit:
+            rows = rows[:params.limit]
+            next_cursor = encode_cursor({"sort": "relevance", "value": rows[-1][1], "id": rows[-1][0]})
+        return self.get_manga_list_by_ids_in_order([row[0] for row in rows]), next_cursor
+
+    @staticmethod
+    def _keyword_condition(keyword: str, fts_query: Optional[str]):
+        """キーワードに一致する漫画に絞り込む条件を返します（全文検索インデックスを使えない短い語はLIKE検索）。"""
+        if fts_query is None:
+            return or_(
+                col(Manga.title).like(f"%{keyword}%"),
+                col(Manga.synopsis).like(f"%{keyword}%"),
+                col(Manga.ai_tags).like(f"%{keyword}%")
             )
+        return col(Manga.id).in_(
+            text("SELECT rowid FROM manga_fts WHERE manga_fts MATCH :query").bindparams(query=fts_query).columns(rowid=Integer)
         )
-        statement = statement.order_by(desc(Manga.score))
-        statement = statement.limit(params.limit) 
-        results = self.session.exec(statement).all()
-        return list(results)
+
+    @staticmethod
+    def _read_cursor(cursor: Optional[str], sort: str) -> Optional[dict]:
+        """
+        カーソルを復号し、並び順が一致することを確認します。
+
+        Raises:
+            ValueError: カーソルの形式が正しくない場合や、別の並び順で発行されたカーソルの場合。
+        """
+        if cursor is None:
+            return None
+        position = decode_cursor(cursor)
+        if position.get("sort") != sort or "value" not in position or not isinstance(position.get("id"), int):
+            raise ValueError(f"並び順「{sort}」のカーソルではありません")
+        return position
+
+    def _paginate(self, statement, sort: str, limit: int, cursor: Optional[str],
+                  cursor_sort: Optional[str] = None) -> tuple[List[Manga], Optional[str]]:
+        """
+        漫画を (sortの列, ID) の降順に並べ、カーソルより後ろの1ページ分を取得します（キーセットページネーション）。
+        sortの列がNULLの漫画は最後に並びます。
+
+        Args:
+            statement: 絞り込み条件を指定した`select(Manga)`。
+            sort (str): 並び替えに使う列（"score" | "updated_at"）。
+            limit (int): 1ページの件数。
+            cursor (Optional[str]): 前のページの`next_cursor`。最初のページはNone。
+            cursor_sort (Optional[str]): カーソルに記録する並び順の名前（省略時はsort）。
+        """
+        cursor_sort = cursor_sort or sort
+        column = getattr(Manga, sort)
+        position = self._read_cursor(cursor, cursor_sort)
+        if position is not None:
+            value = position["value"]
+            if value is None:
+                statement = statement.where(column.is_(None), Manga.id < position["id"])
+            else:
+                if sort == "updated_at":
+                    value = datetime.fromisoformat(value)
+                statement = statement.where(or_(
+                    column < value,
+                    and_(column == value, Manga.id < position["id"]),
+                    column.is_(None)
+                ))
+        statement = statement.order_by(desc(column), desc(Manga.id)).limit(limit + 1)
+        manga_list = list(self.session.exec(statement).all())
+        if len(manga_list) <= limit:
+            return manga_list, None
+        manga_list = manga_list[:limit]
+        value = getattr(manga_list[-1], sort)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        return manga_list, encode_cursor({"sort": cursor_sort, "value": value, "id": manga_list[-1].id})
     
-    def get_manga_list_by_query(self, params: MangaSearchQueryParams) -> List[Manga]:
-        """複数の検索条件を組み合わせて漫画を検索します。
+    @staticmethod
+    def _facet_condition(kind: str, values: list[str], match: str = "any"):
+        """
+        転置インデックス`manga_facet`で、値（タグなど）を持つ漫画に絞り込む条件を返します。
+
+        Args:
+            kind (str): 転置インデックスの種類（"tag" | "author" | "serialization"）。
+            values (list[str]): 値のリスト（重複の無いこと）。
+            match (str): "all"は全ての値を持つ漫画（ポスティングリストの積集合）、"any"はいずれかの値を持つ漫画（和集合）。
+        """
+        postings = select(MangaFacet.manga_id).where(MangaFacet.kind == kind, col(MangaFacet.value).in_(values))
+        if match == "all" and len(values) > 1:
+            # (種類, 値, 漫画ID) は一意のため、値の数だけ行がある漫画が全ての値を持つ
+            postings = postings.group_by(MangaFacet.manga_id).having(func.count() == len(values))
+        return col(Manga.id).in_(postings)
+
+    @staticmethod
+    def _facet_counts_statement(kind: str, prefix: Optional[str] = None, limit: Optional[int] = None):
+        """転置インデックス`manga_facet`から、値ごとの漫画の件数を件数の多い順に集計するSQLを作成します（同期版・非同期版で共用）。"""
+        statement = select(MangaFacet.value, func.count()).where(MangaFacet.kind == kind)
+        if prefix:
+            # 主キーの範囲で前方一致させる（LIKEでは大文字・小文字を区別しないためインデックスを使えない）
+            statement = statement.where(MangaFacet.value >= prefix, MangaFacet.value < prefix + "\U0010ffff")
+        statement = statement.group_by(MangaFacet.value).order_by(desc(func.count()), MangaFacet.value)
+        return statement.limit(limit) if limit else statement
+
+    def get_facet_counts(self, kind: str, prefix: Optional[str] = None, limit: Optional[int] = None) -> dict[str, int]:
+        """
+        タグ・著者・連載誌の語彙を、{値: 漫画の件数} で件数の多い順に返します。
+
+        Args:
+            kind (str): 転置インデックスの種類（"tag" | "author" | "serialization"）。
+            prefix (Optional[str]): 指定した場合は、この文字列で始まる値だけを返します。
+            limit (Optional[int]): 返す値の数の上限。
+        """
+        return dict(self.session.exec(self._facet_counts_statement(kind, prefix, limit)).all())
+
+    def get_manga_list_by_query(self, params: MangaSearchQueryParams) -> tuple[List[Manga], Optional[str]]:
+        """複数の検索条件を組み合わせて漫画を検索します。戻り値は`get_manga_list_by_keyword`と同じです。
             id: int = Field(description="データ管理用ID")
             title: Optional[str] = Field(default=None, description="漫画のタイトル")
-            author: Optional[str] = Field(default=None, description="漫画の著者")
-            serialization: Optional[str] = Field(default=None, description="漫画の連載誌")
+            author: Optional[str] = Field(default=None, description="漫画の著者（完全一致、カンマ区切りでいずれか）")
+            serialization: Optional[str] = Field(default=None, description="漫画の連載誌（完全一致、カンマ区切りでいずれか）")
             status: Optional[str] = Field(default=None, description="漫画のステータス, 「完結」など")
             synopsis: Optional[str] = Field(default=None, description="漫画のあらすじ")
             score: Optional[float] = Field(default=None, description="漫画の評価", ge=0, le=10)
@@ -101,7 +467,11 @@ class MangaService:
             my_score: Optional[int] = Field(default=None, description="ユーザーの評価", ge=0, le=5)
             my_score_filter_method: Literal["min", "max", "equal"] = Field(default="equal", description="漫画のユーザー評価のフィルター方法, 「min」「max」「equal」")
             my_status: Optional[Literal["読みたい", "読んでいる", "読み終えた"]] = Field(default=None, description="ユーザー管理のステータス, 「読みたい」「読んでいる」「読み終えた」")
-            ai_tags: Optional[str] = Field(default=None, description="AIによるタグ")
+            ai_tags: Optional[str] = Field(default=None, description="AIによるタグ（完全一致、カンマ区切りで複数指定）")
+            tag_match: Literal["all", "any"] = PyField(default="all", description="複数のタグの条件, 「all」「any」")
+
+        タグ・著者・連載誌は転置インデックス`manga_facet`のポスティングリストで絞り込むため、
+        部分文字列が一致するだけの別のタグ（「恋愛」に対する「恋愛コメディ」など）には一致しません。
         """
         statement = select(Manga)
         if params.id:
@@ -109,9 +479,9 @@ class MangaService:
         if params.title:
             statement = statement.where(col(Manga.title).like(f"%{params.title}%"))
         if params.author:
-            statement = statement.where(col(Manga.author).like(f"%{params.author}%"))
+            statement = statement.where(self._facet_condition("author", split_tags(params.author), "any"))
         if params.serialization:
-            statement = statement.where(col(Manga.serialization).like(f"%{params.serialization}%"))
+            statement = statement.where(self._facet_condition("serialization", split_tags(params.serialization), "any"))
         if params.status:
             statement = statement.where(Manga.status == params.status)
         if params.synopsis:
@@ -126,48 +496,266 @@ class MangaService:
         if params.my_review:
             statement = statement.where(col(Manga.my_review).like(f"%{params.my_review}%"))
         if params.my_score:
-            if params.my_score_filter:
+            if params.my_score_filter_method == "min":
                 statement = statement.where(Manga.my_score >= params.my_score)
-            elif params.my_score_filter == "max":
+            elif params.my_score_filter_method == "max":
                 statement = statement.where(Manga.my_score <= params.my_score)
             else:
                 statement = statement.where(Manga.my_score == params.my_score)
         if params.my_status:
             statement = statement.where(Manga.my_status == params.my_status)
         if params.ai_tags:
-            statement = statement.where(col(Manga.ai_tags).like(f"%{params.ai_tags}%"))
-
-        # statement = statement.order_by(desc(Manga.updated_at))
-        statement = statement.order_by(desc(Manga.score))
-        statement = statement.limit(params.limit) 
-        results = self.session.exec(statement).all()
-        return list(results)
-
-    def get_manga_list_by_vector(self, params: MangaSearchVectorParams) -> List[Manga]:
-        """ベクトル検索（セマンティック検索）を実行します。"""
-        docs = self.vectorDB.similarity_search(params.keyword, k=params.limit)
-        if not docs:
+            statement = statement.where(self._facet_condition("tag", split_tags(params.ai_tags), params.tag_match))
+
+        # 評価の高い順（params.sortが"updated_at"の場合は更新の新しい順）に、カーソルより後ろの1ページ分を取得
+        return self._paginate(statement, params.sort, params.limit, params.cursor)
+
+    def get_manga_list_by_vector(self, params: MangaSearchVectorParams) -> tuple[List[Manga], Optional[str]]:
+        """
+        ベクトル検索（セマンティック検索）を実行します。
+        ベクトルDBはキーの位置から検索を続けられないため、カーソルには返した件数を記録し、次のページでは上位から読み飛ばします。
+        """
+        offset = 0
+        if params.cursor is not None:
+            position = decode_cursor(params.cursor)
+            if position.get("sort") != "similarity" or not isinstance(position.get("offset"), int) or position["offset"] < 0:
+                raise ValueError("並び順「similarity」のカーソルではありません")
+            offset = position["offset"]
+        docs = self.vectorDB.similarity_search(params.keyword, k=offset + params.limit + 1)
+        # 取得したドキュメントから漫画IDを抽出し、ベクトル検索の類似度順のまま漫画情報を取得
+        manga_ids = [int(doc.metadata["id"]) for doc in docs[offset:offset + params.limit]]
+        next_cursor = None
+        if len(docs) > offset + params.limit:
+            next_cursor = encode_cursor({"sort": "similarity", "offset": offset + params.limit})
+        return self.get_manga_list_by_ids_in_order(manga_ids), next_cursor
+
+    def iter_manga(self, batch_size: int = settings.MANGA_EXPORT_BATCH_SIZE):
+        """
+        全ての漫画をIDの順に、batch_size件ずつのリストで返すジェネレータです。
+        batch_size件ずつ読み込むため、件数が多くてもメモリ使用量は一定です。
+        """
+        statement = select(Manga).order_by(Manga.id).execution_options(yield_per=batch_size)
+        for partition in self.session.exec(statement).partitions():
+            yield partition
+
+    def search_vector_ids(self, queries: list[str], k: int) -> list[list[tuple[int, float]]]:
+        """
+        複数クエリのベクトル検索を、1回の埋め込み呼び出しと1回のChroma問い合わせでまとめて実行します。
+
+        Returns:
+            list[list[tuple[int, float]]]: クエリごとの (漫画ID, コサイン距離) のリスト。距離の小さい順です。
+        """
+        if not queries:
             return []
-        # 取得したドキュメントから漫画IDを抽出
-        manga_ids = [int(doc.metadata["id"]) for doc in docs]
-        
-        # 漫画IDでデータベースから漫画情報を取得
-        statement = select(Manga).where(Manga.id.in_(manga_ids))
-        results = self.session.exec(statement).all()
-        
-        # ベクトル検索の類似度順に並べ替える
-        result_map = {m.id: m for m in results}
-        ordered_results = [result_map[m_id] for m_id in manga_ids if m_id in result_map]
-        
-        return ordered_results
+        embeddings = self.vectorDB.embeddings
+        # キャッシュ付きの埋め込みモデル（CachedEmbeddings）の場合は、クエリをドキュメントのキャッシュに書き込まない`embed_queries`を使う
+        embed = getattr(embeddings, "embed_queries", embeddings.embed_documents)
+        query_embeddings = embed(queries)
+        return self.search_vector_ids_by_embeddings(query_embeddings, k)
+
+    def search_vector_ids_by_embeddings(self, query_embeddings: list[list[float]], k: int) -> list[list[tuple[int, float]]]:
+        """埋め込み済みの複数クエリで、Chromaを1回だけ問い合わせます。戻り値は`search_vector_ids`と同じです。"""
+        return self._query_vector_ids(self.vectorDB, query_embeddings, k)
+
+    @staticmethod
+    def _query_vector_ids(vectorDB: Chroma, query_embeddings: list[list[float]], k: int) -> list[list[tuple[int, float]]]:
+        if not query_embeddings:
+            return []
+        results = vectorDB._collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            include=["metadatas", "distances"]
+        )
+        return [
+            [(int(metadata["id"]), distance) for metadata, distance in zip(metadatas, distances)]
+            for metadatas, distances in zip(results["metadatas"], results["distances"])
+        ]
+
+    @staticmethod
+    def merge_vector_hits(hits_per_query: list[list[tuple[int, float]]]) -> list[tuple[int, float]]:
+        """クエリごとの検索結果を、漫画IDごとに最も近い距離で統合し、距離の小さい順に並べます。"""
+        best_distances: dict[int, float] = {}
+        for hits in hits_per_query:
+            for manga_id, distance in hits:
+                if manga_id not in best_distances or distance < best_distances[manga_id]:
+                    best_distances[manga_id] = distance
+        return sorted(best_distances.items(), key=lambda hit: hit[1])
+
+    def get_manga_list_by_vectors(self, queries: list[str], k: int = 10) -> List[Manga]:
+        """
+        複数クエリのベクトル検索をまとめて実行し、結果を最も近い距離の順に統合して返します。
+        埋め込み・Chroma検索・SQL取得がそれぞれ1回で済みます。
+        """
+        merged_hits = self.merge_vector_hits(self.search_vector_ids(queries, k))
+        return self.get_manga_list_by_ids_in_order([manga_id for manga_id, _ in merged_hits])
+
+    def get_manga_list_by_embeddings(self, query_embeddings: list[list[float]], k: int = 10) -> List[Manga]:
+        """`get_manga_list_by_vectors`の、クエリの埋め込みを呼び出し側で済ませた版です。"""
+        merged_hits = self.merge_vector_hits(self.search_vector_ids_by_embeddings(query_embeddings, k))
+        return self.get_manga_list_by_ids_in_order([manga_id for manga_id, _ in merged_hits])
     
+    @staticmethod
+    def build_vector_content(manga) -> str:
+        """漫画の情報から、ベクトルDBに登録する本文を作成します。"""
+        content = f"タグ：{manga.ai_tags},タイトル：{manga.title},おすすめ：{manga.ai_comment},あらすじ：{manga.synopsis}"
+        if manga.my_review:
+            content += f",感想：{manga.my_review}"
+        return content
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        """ベクトルDBに登録する本文のハッシュを返します。本文が変わったかどうかの判定に使います。"""
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _get_vector_hashes(self, page_size: int = 5000) -> dict[str, Optional[str]]:
+        """ベクトルDBに登録済みのIDと、登録時の本文のハッシュを取得します。"""
+        hashes = {}
+        offset = 0
+        while True:
+            result = self.vectorDB.get(include=["metadatas"], limit=page_size, offset=offset)
+            for doc_id, metadata in zip(result["ids"], result["metadatas"]):
+                hashes[doc_id] = (metadata or {}).get("content_hash")
+            if len(result["ids"]) < page_size:
+                return hashes
+            offset += page_size
+
+    def _upsert_changed_vectors(self, rows: list, vector_hashes: dict[str, Optional[str]], batch_size: int,
+                                on_progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        本文のハッシュが登録時と異なる漫画だけを埋め込み、ベクトルDBに登録（上書き）します。
+        on_progressを指定した場合は、バッチごとに (登録した件数, 登録する件数) を渡して呼び出します。
+        """
+        docs = []
+        ids = []
+        for row in rows:
+            content = self.build_vector_content(row)
+            content_hash = self.content_hash(content)
+            if vector_hashes.get(str(row.id)) == content_hash:
+                continue
+            docs.append(Document(
+                page_content=content,
+                metadata={"id": row.id, "title": row.title, "content_hash": content_hash}
+            ))
+            ids.append(str(row.id))
+        for i in range(0, len(docs), batch_size):
+            self.vectorDB.add_documents(docs[i:i+batch_size], ids=ids[i:i+batch_size])
+            if on_progress:
+                on_progress(i + len(docs[i:i+batch_size]), len(docs))
+        return len(docs)
+
+    def _select_vector_rows(self):
+        """ベクトルDBの本文の作成に必要な列だけを選択するクエリを返します。"""
+        return select(Manga.id, *(getattr(Manga, f) for f in VECTOR_FIELDS))
+
+    def sync_vector_store(self, batch_size: int = 30, on_progress: Optional[Callable[[int, int], None]] = None) -> dict:
+        """
+        RDBの内容をベクトルDBへ差分同期します。
+        本文のハッシュがベクトルDBのメタデータと異なる漫画だけを埋め込み直し、
+        RDBから削除された漫画はベクトルDBからも削除します。
+
+        Args:
+            batch_size (int): 1回に埋め込む件数。
+            on_progress (Optional[Callable[[int, int], None]]): バッチごとに (登録した件数, 登録する件数) を受け取る関数。
+
+        Returns:
+            dict: 全件数・登録した件数・削除した件数・変更の無かった件数。
+        """
+        rows = self.session.exec(self._select_vector_rows()).all()
+        vector_hashes = self._get_vector_hashes()
+        embedded = self._upsert_changed_vectors(rows, vector_hashes, batch_size, on_progress)
+
+        stale_ids = list(set(vector_hashes) - {str(row.id) for row in rows})
+        if stale_ids:
+            self.vectorDB.delete(ids=stale_ids)
+        self._notify_vectors_changed(embedded + len(stale_ids))
+        return {
+            "total": len(rows),
+            "embedded": embedded,
+            "deleted": len(stale_ids),
+            "unchanged": len(rows) - embedded
+        }
+
+    def sync_vector_ids(self, manga_ids: list[int], batch_size: int = 30) -> dict:
+        """
+        指定したIDの漫画だけをベクトルDBへ同期します。
+        RDBに存在する漫画は（本文が変わっていれば）登録し、存在しない漫画はベクトルDBから削除します。
+        """
+        rows = self.session.exec(self._select_vector_rows().where(Manga.id.in_(manga_ids))).all()
+        existing = self.vectorDB.get(ids=[str(m_id) for m_id in manga_ids], include=["metadatas"])
+        vector_hashes = {
+            doc_id: (metadata or {}).get("content_hash")
+            for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+        }
+        embedded = self._upsert_changed_vectors(rows, vector_hashes, batch_size)
+
+        stale_ids = list(set(vector_hashes) - {str(row.id) for row in rows})
+        if stale_ids:
+            self.vectorDB.delete(ids=stale_ids)
+        self._notify_vectors_changed(embedded + len(stale_ids))
+        return {"embedded": embedded, "deleted": len(stale_ids)}
+
+    def get_ai_tag_counts(self) -> dict[str, int]:
+        """全ての漫画の`ai_tags`のタグごとの {タグ: 漫画の件数} を、転置インデックスから返します。"""
+        return self.get_facet_counts("tag")
+
     def get_manga_count(self) -> int:
         """漫画の件数を取得します。"""
-        statement = select(Manga)
-        return len(self.session.exec(statement).all())
+        return self.session.exec(select(func.count()).select_from(Manga)).one()
     
     def delete_manga_db(self) -> None:
         """漫画のデータベースを削除します。"""
+        manga_cache.clear()
+        semantic_cache.clear()
+        manga_stats.clear()
         if os.path.exists(settings.SQLITE_URL):
             os.remove(settings.SQLITE_URL)
-            os.remove(settings.CHROMA_URL)
\ No newline at end of file
+            os.remove(settings.CHROMA_URL)
+
+
+class AsyncMangaService:
+    """
+    漫画サービスの読み取り処理の非同期版のクラス。
+    チャットのグラフなど、イベントループ上でスレッドを使わずにデータベースを読み取るために使用します。
+    """
+    def __init__(self, session: AsyncSession, vectorDB: Optional[Chroma] = None):
+        """
+        コンストラクタ
+
+        Args:
+            session (AsyncSession): SQLModelの非同期データベースセッション
+            vectorDB (Optional[Chroma]): ベクトルDBクライアント
+        """
+        self.session = session
+        self.vectorDB = vectorDB
+
+    async def get_manga_list_by_ids(self, manga_ids: list[int]) -> list[Manga]:
+        """複数のIDに基づいて漫画のリストを取得します。"""
+        statement = select(Manga).where(Manga.id.in_(manga_ids))
+        return list((await self.session.exec(statement)).all())
+
+    async def get_manga_list_by_ids_in_order(self, manga_ids: list[int]) -> list[Manga]:
+        """IDのリストに基づいて漫画を取得し、与えられたIDの順に並べて返します。"""
+        if not manga_ids:
+            return []
+        result_map = {m.id: m for m in await self.get_manga_list_by_ids(manga_ids)}
+        return [result_map[m_id] for m_id in manga_ids if m_id in result_map]
+
+    async def search_keyword_ids(self, keyword: str, limit: int) -> list[int]:
+        """`MangaService.search_keyword_ids`の非同期版です。"""
+        statement, use_fts = MangaService._build_keyword_search(keyword, limit)
+        if not use_fts:
+            return list((await self.session.exec(statement)).all())
+        connection = await self.session.connection()
+        return [row[0] for row in await connection.execute(statement)]
+
+    async def get_ai_tag_counts(self) -> dict[str, int]:
+        """`MangaService.get_ai_tag_counts`の非同期版です。"""
+        return dict((await self.session.exec(MangaService._facet_counts_statement("tag"))).all())
+
+    async def search_vector_ids_by_embeddings(self, query_embeddings: list[list[float]], k: int) -> list[list[tuple[int, float]]]:
+        """`MangaService.search_vector_ids_by_embeddings`の非同期版です。問い合わせは専用のスレッドプールで実行します。"""
+        if not query_embeddings:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(
+            vector_query_executor, MangaService._query_vector_ids, self.vectorDB, query_embeddings, k
+        )
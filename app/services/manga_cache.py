@@ -0,0 +1,123 @@
+"""
+漫画情報を、IDをキーにプロセス内のメモリへ保持するリードスルーキャッシュです。
+チャットのグラフの状態には候補のIDとスコアだけを持たせ、本文が必要なノードはこのキャッシュから取り出します。
+キャッシュに無い漫画は`MangaService.get_manga_list_by_ids`（非同期版は`AsyncMangaService`）でまとめて読み込み、漫画の作成・更新・削除時に無効化されます。
+"""
+import threading
+from typing import Optional
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.core.cache import LRUCache
+from app.core.config import settings
+from app.models.manga import MangaRead, engine, async_engine
+
+class MangaCache:
+    """
+    漫画情報（`MangaRead`の辞書）のリードスルーキャッシュ。
+
+    Args:
+        max_entries (int): 保持する漫画数の上限。
+    """
+    def __init__(self, max_entries: int = settings.MANGA_CACHE_MAX_ENTRIES):
+        self._cache = LRUCache(max_entries)
+        # 読み込み中に無効化された場合に古い内容を保存しないよう、無効化のたびに世代を進める
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, manga_ids: list[int], session: Optional[Session] = None) -> dict[int, dict]:
+        """
+        IDに対応する漫画情報を返します。キャッシュに無いものはデータベースからまとめて読み込みます。
+        存在しない（削除された）IDは結果に含まれません。
+
+        Args:
+            manga_ids (list[int]): 漫画IDのリスト。
+            session (Optional[Session]): 読み込みに使うセッション。省略時は新しく作成します。
+
+        Returns:
+            dict[int, dict]: 漫画ID -> `MangaRead`の辞書
+        """
+        found, missing = self._lookup(manga_ids)
+        if missing:
+            generation = self._current_generation()
+            loaded = self._load(missing, session)
+            self._store(loaded, generation)
+            found.update(loaded)
+        return found
+
+    async def aget_many(self, manga_ids: list[int]) -> dict[int, dict]:
+        """`get_many`の非同期版です。キャッシュに無いものは非同期エンジンで読み込みます。"""
+        found, missing = self._lookup(manga_ids)
+        if missing:
+            generation = self._current_generation()
+            loaded = await self._aload(missing)
+            self._store(loaded, generation)
+            found.update(loaded)
+        return found
+
+    def _lookup(self, manga_ids: list[int]) -> tuple[dict[int, dict], list[int]]:
+        """キャッシュにある漫画情報と、キャッシュに無いIDのリストを返します。"""
+        found = {}
+        missing = []
+        for manga_id in dict.fromkeys(manga_ids):
+            manga = self._cache.get(manga_id)
+            if manga is None:
+                missing.append(manga_id)
+            else:
+                found[manga_id] = manga
+        return found, missing
+
+    def _current_generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def _store(self, loaded: dict[int, dict], generation: int) -> None:
+        with self._lock:
+            if generation == self._generation:
+                for manga_id, manga in loaded.items():
+                    self._cache.set(manga_id, manga)
+
+    def get_in_order(self, manga_ids: list[int], session: Optional[Session] = None) -> list[dict]:
+        """IDの順に漫画情報を並べて返します。存在しないIDは除きます。"""
+        found = self.get_many(manga_ids, session)
+        return [found[m_id] for m_id in manga_ids if m_id in found]
+
+    async def aget_in_order(self, manga_ids: list[int]) -> list[dict]:
+        """`get_in_order`の非同期版です。"""
+        found = await self.aget_many(manga_ids)
+        return [found[m_id] for m_id in manga_ids if m_id in found]
+
+    @staticmethod
+    def _load(manga_ids: list[int], session: Optional[Session]) -> dict[int, dict]:
+        # MangaServiceはこのキャッシュを無効化するためにこのモジュールを読み込むので、循環importを避けてここで読み込む
+        from app.services.manga import MangaService
+        if session is None:
+            with Session(engine) as new_session:
+                return MangaCache._load(manga_ids, new_session)
+        return {m.id: MangaRead.model_validate(m).model_dump() for m in MangaService(session).get_manga_list_by_ids(manga_ids)}
+
+    @staticmethod
+    async def _aload(manga_ids: list[int]) -> dict[int, dict]:
+        from app.services.manga import AsyncMangaService
+        async with AsyncSession(async_engine) as session:
+            manga_list = await AsyncMangaService(session).get_manga_list_by_ids(manga_ids)
+            return {m.id: MangaRead.model_validate(m).model_dump() for m in manga_list}
+
+    def invalidate(self, manga_ids: list[int]) -> None:
+        """指定された漫画をキャッシュから削除します。"""
+        with self._lock:
+            self._generation += 1
+            for manga_id in manga_ids:
+                self._cache.pop(manga_id)
+
+    def clear(self) -> None:
+        """キャッシュを全て削除します。"""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・ヒット率・エントリ数を返します。"""
+        return self._cache.stats()
+
+# アプリ全体で共有する漫画キャッシュのインスタンス
+manga_cache = MangaCache()
@@ -0,0 +1,142 @@
+"""
+漫画ライブラリの統計（ステータス・評価ごとの件数や、よく使われるタグ・著者）を、プロセス内のメモリに集計して保持します。
+最初の取得時に全件から集計し、以降は`MangaService`の作成・更新・削除のたびに、変更前後の行の差分だけを反映します。
+別のプロセスからの書き込みなど差分が届かない変更に備えて、一定時間ごとに全件から集計し直します。
+"""
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+from sqlmodel import Session, select
+from app.core.config import settings
+from app.models.manga import Manga, engine, split_tags
+
+# 集計に使う列。差分の反映には、変更前後の行のこれらの値（スナップショット）を使う
+STATS_FIELDS = ("status", "my_status", "my_score", "score", "ai_tags", "author")
+# 評価（0〜10）のヒストグラムの区間の数。区間の幅は1で、10点は最後の区間に含める
+SCORE_BUCKETS = 10
+
+def snapshot(row) -> tuple:
+    """漫画（または集計に使う列を選択した行）から、集計に使う列の値を取り出します。"""
+    return tuple(getattr(row, field) for field in STATS_FIELDS)
+
+def score_bucket(score: Optional[float]) -> Optional[int]:
+    """評価が含まれるヒストグラムの区間の番号を返します。評価が無い場合はNoneです。"""
+    if score is None:
+        return None
+    return min(max(int(score), 0), SCORE_BUCKETS - 1)
+
+def _ranked(counter: Counter, limit: Optional[int] = None) -> list[dict]:
+    """件数の多い順に {"value": 値, "count": 件数} のリストにします。件数が0になった値は除きます。"""
+    return [{"value": value, "count": count} for value, count in counter.most_common(limit) if count > 0]
+
+class MangaStats:
+    """
+    漫画ライブラリの統計の集計結果を保持するクラス。
+
+    Args:
+        refresh_sec (float): 全件から集計し直すまでの秒数。
+    """
+    def __init__(self, refresh_sec: float = settings.MANGA_STATS_REFRESH_SEC):
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._loaded_at: Optional[float] = None
+        self._refreshed_at: Optional[datetime] = None
+        # 集計中に差分が届いた場合に、集計結果を古いものとして扱うため、差分の反映のたびに世代を進める
+        self._generation = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self._total = 0
+        self._status = Counter()
+        self._my_status = Counter()
+        self._my_score = Counter()
+        self._score_buckets = Counter()
+        self._tags = Counter()
+        self._authors = Counter()
+
+    def _count(self, row: tuple, sign: int) -> None:
+        """1件の漫画のスナップショットを集計に加えます（signが-1の場合は取り除きます）。"""
+        status, my_status, my_score, score, ai_tags, author = row
+        self._total += sign
+        self._status[status] += sign
+        self._my_status[my_status] += sign
+        self._my_score[my_score] += sign
+        self._score_buckets[score_bucket(score)] += sign
+        for tag in split_tags(ai_tags):
+            self._tags[tag] += sign
+        for name in split_tags(author):
+            self._authors[name] += sign
+
+    def apply(self, removed: list[tuple] = (), added: list[tuple] = ()) -> None:
+        """
+        漫画の変更を集計に反映します。まだ集計していない場合は何もしません（最初の取得時に全件から集計するため）。
+
+        Args:
+            removed (list[tuple]): 削除した漫画、または更新前の漫画のスナップショット。
+            added (list[tuple]): 作成した漫画、または更新後の漫画のスナップショット。
+        """
+        with self._lock:
+            self._generation += 1
+            if self._loaded_at is None:
+                return
+            for row in removed:
+                self._count(row, -1)
+            for row in added:
+                self._count(row, 1)
+
+    def _is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_sec
+
+    def refresh(self, session: Optional[Session] = None) -> None:
+        """全ての漫画から集計し直します。"""
+        if session is None:
+            with Session(engine) as new_session:
+                return self.refresh(new_session)
+        with self._lock:
+            generation = self._generation
+        rows = session.exec(select(*(getattr(Manga, field) for field in STATS_FIELDS))).all()
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._count(tuple(row), 1)
+            # 集計中に差分が届いた場合は、読み込んだ内容に含まれていない可能性があるため、次の取得時に集計し直す
+            self._loaded_at = time.monotonic() if generation == self._generation else None
+            self._refreshed_at = datetime.now()
+
+    def get(self, top: int = settings.MANGA_STATS_TOP_N, session: Optional[Session] = None) -> dict:
+        """
+        統計を返します。集計していない場合や、集計し直す時刻を過ぎている場合は、先に全件から集計します。
+
+        Args:
+            top (int): よく使われるタグ・著者を返す件数。
+            session (Optional[Session]): 集計に使うセッション。省略時は新しく作成します。
+        """
+        if self._is_stale():
+            self.refresh(session)
+        with self._lock:
+            return {
+                "total": self._total,
+                "by_status": _ranked(self._status),
+                "by_my_status": _ranked(self._my_status),
+                "by_my_score": sorted(_ranked(self._my_score), key=lambda c: (c["value"] is None, c["value"])),
+                "score_histogram": [
+                    {"min": bucket, "max": bucket + 1, "count": self._score_buckets[bucket]}
+                    for bucket in range(SCORE_BUCKETS)
+                ],
+                "unscored": self._score_buckets[None],
+                "top_ai_tags": _ranked(self._tags, top),
+                "top_authors": _ranked(self._authors, top),
+                "refreshed_at": self._refreshed_at,
+            }
+
+    def clear(self) -> None:
+        """集計結果を破棄します。次の取得時に全件から集計し直します。"""
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+            self._reset()
+
+# アプリ全体で共有する統計のインスタンス
+manga_stats = MangaStats()
@@ -0,0 +1,153 @@
+"""
+シード処理のジョブ管理と、ステージングテーブルへの途中結果の保存を行うサービスクラス。
+"""
+import json
+from datetime import datetime
+from typing import Any, Optional
+from sqlalchemy import update
+from sqlmodel import Session, select
+from app.models.seed import SeedJob, SeedStaging, SeedJobStatus, SEED_JOB_COUNTERS, RESUMABLE_STATUSES
+
+class SeedJobService:
+    """シードジョブサービスのクラス"""
+    def __init__(self, session: Session):
+        """
+        コンストラクタ
+
+        Args:
+            session (Session): SQLModelのデータベースセッション
+        """
+        self.session = session
+
+    def create_job(self, limit: int, summarize_reviews: bool = False) -> SeedJob:
+        """新しいシードジョブを作成します。"""
+        job = SeedJob(limit=limit, summarize_reviews=summarize_reviews, created_at=datetime.now(), updated_at=datetime.now())
+        self.session.add(job)
+        self.session.commit()
+        self.session.refresh(job)
+        return job
+
+    def get_job(self, job_id: int) -> Optional[SeedJob]:
+        """IDでシードジョブを取得します。"""
+        return self.session.get(SeedJob, job_id)
+
+    def _transition(self, job_id: int, from_statuses: tuple[str, ...], values: dict) -> bool:
+        """
+        ジョブが指定の状態の場合だけ、1回のUPDATEで状態を変更します。
+        確認と変更の間に他のリクエストが割り込まないため、同じジョブを二重に実行することがありません。
+
+        Returns:
+            bool: 状態を変更できた場合はTrue。
+        """
+        result = self.session.execute(
+            update(SeedJob)
+            .where(SeedJob.id == job_id, SeedJob.status.in_(from_statuses))
+            .values(updated_at=datetime.now(), **values)
+        )
+        self.session.commit()
+        return result.rowcount == 1
+
+    def queue_resume(self, job_id: int) -> bool:
+        """
+        中断・失敗したジョブを実行待ち（pending）に戻します。
+
+        Returns:
+            bool: 再開できた場合はTrue。実行待ち・実行中・完了済みの場合はFalse。
+        """
+        return self._transition(job_id, RESUMABLE_STATUSES, {"status": "pending"})
+
+    def start_job(self, job_id: int) -> Optional[SeedJob]:
+        """
+        実行待ちのジョブを実行中にし、カウンタを初期化します。再開時も同じ扱いで、完了済みの作業はステージングから再利用されます。
+        ジョブが無い場合や、実行待ちでない場合（既に他の処理が開始した場合など）はNoneを返します。
+        """
+        started = self._transition(job_id, ("pending",), {
+            **{counter: 0 for counter in SEED_JOB_COUNTERS},
+            "status": "running",
+            "error": None,
+            "started_at": datetime.now(),
+            "finished_at": None,
+        })
+        if not started:
+            return None
+        job = self.session.get(SeedJob, job_id)
+        self.session.refresh(job)
+        return job
+
+    def update_progress(self, job_id: int, counts: dict[str, int]) -> None:
+        """ジョブのステージごとの処理件数を更新します。"""
+        job = self.session.get(SeedJob, job_id)
+        if not job:
+            return
+        job.sqlmodel_update({k: v for k, v in counts.items() if k in SEED_JOB_COUNTERS})
+        job.updated_at = datetime.now()
+        self.session.add(job)
+        self.session.commit()
+
+    def finish_job(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        """ジョブを終了状態（completed / failed）にします。"""
+        job = self.session.get(SeedJob, job_id)
+        if not job:
+            return
+        job.status = status
+        job.error = error
+        job.finished_at = datetime.now()
+        job.updated_at = datetime.now()
+        self.session.add(job)
+        self.session.commit()
+
+    def mark_interrupted_jobs(self) -> int:
+        """
+        実行中のまま残っているジョブを中断扱いにします。
+        アプリ起動時に呼び出し、前回のプロセスで途中終了したジョブを再開できるようにします。
+        """
+        # 前回のプロセスで実行待ちのまま開始されなかったジョブも、再開できるように中断扱いにする
+        jobs = self.session.exec(select(SeedJob).where(SeedJob.status.in_(("pending", "running")))).all()
+        for job in jobs:
+            job.status = "interrupted"
+            job.updated_at = datetime.now()
+            self.session.add(job)
+        self.session.commit()
+        return len(jobs)
+
+    def get_job_status(self, job: SeedJob) -> SeedJobStatus:
+        """ジョブの進捗に、経過時間・スループット・完了までの推定時間を加えて返します。"""
+        counts = {counter: getattr(job, counter) for counter in SEED_JOB_COUNTERS}
+        elapsed_sec = throughput_per_min = eta_sec = None
+        if job.started_at:
+            elapsed_sec = ((job.finished_at or datetime.now()) - job.started_at).total_seconds()
+            processed = job.skipped + job.saved + job.failed
+            if elapsed_sec > 0 and processed > 0:
+                throughput_per_min = processed / elapsed_sec * 60
+                if job.status == "running":
+                    eta_sec = max(job.limit - processed, 0) / (processed / elapsed_sec)
+        return SeedJobStatus(
+            job_id=job.id,
+            status=job.status,
+            limit=job.limit,
+            summarize_reviews=job.summarize_reviews,
+            counts=counts,
+            elapsed_sec=elapsed_sec,
+            throughput_per_min=throughput_per_min,
+            eta_sec=eta_sec,
+            error=job.error,
+            created_at=job.created_at,
+            started_at=job.started_at,
+            finished_at=job.finished_at
+        )
+
+    def get_staged(self, mal_id: int, stage: str) -> Optional[Any]:
+        """ステージングに保存済みの途中結果を取得します。無い場合はNoneを返します。"""
+        staging = self.session.get(SeedStaging, (mal_id, stage))
+        if not staging:
+            return None
+        return json.loads(staging.payload)
+
+    def put_staged(self, mal_id: int, stage: str, payload: Any, job_id: Optional[int] = None) -> None:
+        """途中結果をステージングに保存します。既にある場合は上書きします。"""
+        staging = self.session.get(SeedStaging, (mal_id, stage)) or SeedStaging(mal_id=mal_id, stage=stage)
+        staging.payload = json.dumps(payload, ensure_ascii=False)
+        staging.job_id = job_id
+        staging.created_at = datetime.now()
+        self.session.add(staging)
+        self.session.commit()
@@ -0,0 +1,150 @@
+"""
+会話の最初のメッセージに対する回答を、メッセージの埋め込みをキーにキャッシュするセマンティックキャッシュです。
+「おすすめの漫画は？」のように、ほぼ同じ質問が繰り返される場合に、グラフ（検索クエリ生成・検索・ランキング・回答生成）を
+実行せずに、以前の回答と漫画IDのリストを返します。
+ライブラリ（漫画）が変更された場合は、結果が変わり得るエントリを無効化します。
+ベクトルDBへの反映は後から行われるため、反映後にもう一度無効化します。
+無効化のたびに世代を進め、無効化より前に検索を始めた回答は保存しません（古い検索結果の回答を保存しないため）。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from app.core.config import settings
+from app.models.chroma import embedding
+
+class SemanticCache:
+    """
+    メッセージの埋め込みのコサイン類似度で引く、件数上限と有効期限付きの回答キャッシュ。
+
+    Args:
+        embeddings (Embeddings): メッセージを埋め込むモデル。
+        threshold (float): キャッシュを使うコサイン類似度の下限。
+        max_entries (int): 保持するエントリ数の上限（超えると最も長く使われていないものから削除）。
+        ttl_sec (float): エントリの有効期限（秒）。
+    """
+    def __init__(self, embeddings: Embeddings,
+                 threshold: float = settings.SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = settings.SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl_sec: float = settings.SEMANTIC_CACHE_TTL_SEC):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        # メッセージ -> {"vector": 正規化済みの埋め込み, "answer", "found_manga_ids", "created_at"}
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidated": 0, "rejected_stale": 0, "embed_errors": 0}
+        self._last_error: Optional[str] = None
+        # 無効化のたびに進める世代
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        """現在の世代。回答を作り始める前に取得し、保存時に`store`へ渡します。"""
+        return self._generation
+
+    async def aembed(self, message: str) -> np.ndarray:
+        """メッセージを埋め込み、長さ1に正規化したベクトルを返します。"""
+        vector = np.asarray(await self.embeddings.aembed_query(message), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def record_error(self, error: Exception) -> None:
+        """メッセージの埋め込みに失敗したことを記録します（`stats`のembed_errors・last_errorで確認できます）。"""
+        with self._lock:
+            self._stats["embed_errors"] += 1
+            self._last_error = str(error)
+
+    def lookup(self, vector: np.ndarray) -> Optional[dict]:
+        """
+        類似度が閾値以上で最も近いエントリを返します。無い場合はNoneを返します。
+
+        Returns:
+            Optional[dict]: {"message": 元のメッセージ, "answer", "found_manga_ids", "similarity"}
+        """
+        with self._lock:
+            self._drop_expired()
+            best_message, best_similarity = None, self.threshold
+            if self._entries:
+                messages = list(self._entries)
+                similarities = np.stack([self._entries[m]["vector"] for m in messages]) @ vector
+                index = int(np.argmax(similarities))
+                if similarities[index] >= best_similarity:
+                    best_message, best_similarity = messages[index], float(similarities[index])
+            if best_message is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._entries.move_to_end(best_message)
+            entry = self._entries[best_message]
+            return {
+                "message": best_message,
+                "answer": entry["answer"],
+                "found_manga_ids": list(entry["found_manga_ids"]),
+                "similarity": best_similarity,
+            }
+
+    def store(self, message: str, vector: np.ndarray, answer: str, found_manga_ids: list[int],
+              generation: Optional[int] = None) -> None:
+        """
+        回答をキャッシュに保存し、上限を超えた分を古い順に削除します。
+
+        Args:
+            generation (Optional[int]): 回答を作り始めた時点の世代（`generation`）。
+                その後に無効化があった場合は、古い内容で検索した回答の可能性があるため保存しません。
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                self._stats["rejected_stale"] += 1
+                return
+            self._entries[message] = {
+                "vector": vector,
+                "answer": answer,
+                "found_manga_ids": list(found_manga_ids),
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end(message)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_manga(self, manga_ids: list[int]) -> None:
+        """指定された漫画を回答に含むエントリを削除します（漫画が更新された場合）。"""
+        targets = set(manga_ids)
+        with self._lock:
+            self._generation += 1
+            stale = [m for m, entry in self._entries.items() if targets & set(entry["found_manga_ids"])]
+            for message in stale:
+                del self._entries[message]
+            self._stats["invalidated"] += len(stale)
+
+    def clear(self) -> None:
+        """全てのエントリを削除します（漫画が追加・削除され、どの質問の回答も変わり得る場合）。"""
+        with self._lock:
+            self._generation += 1
+            self._stats["invalidated"] += len(self._entries)
+            self._entries.clear()
+
+    def _drop_expired(self) -> None:
+        deadline = time.time() - self.ttl_sec
+        expired = [m for m, entry in self._entries.items() if entry["created_at"] < deadline]
+        for message in expired:
+            del self._entries[message]
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・ヒット率・エントリ数・無効化した件数・古いため保存しなかった件数・埋め込みの失敗数を返します。"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": settings.SEMANTIC_CACHE_ENABLED,
+            "hit_rate": self._stats["hits"] / lookups if lookups else None,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "last_error": self._last_error,
+            **self._stats,
+        }
+
+# アプリ全体で共有するセマンティックキャッシュのインスタンス
+semantic_cache = SemanticCache(embedding)
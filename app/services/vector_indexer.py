@@ -0,0 +1,141 @@
+"""
+漫画の作成・更新・削除をベクトルDBへ非同期に反映する、ライトビハインド方式のインデクサです。
+CRUD処理は変更された漫画IDをキューに積むだけで、埋め込みはバックグラウンドのスレッドがまとめて行います。
+"""
+import threading
+import time
+from typing import Iterable, Optional
+from langchain_chroma import Chroma
+from sqlmodel import Session
+from app.core.config import settings
+from app.core.llm_gateway import use_lane, LANE_BATCH
+from app.models.manga import engine
+from app.models.chroma import vectorDB
+from app.services.manga import MangaService
+
+class VectorIndexer:
+    """
+    変更された漫画IDを溜めて、まとめてベクトルDBへ反映するインデクサ。
+
+    最後の登録から`debounce_sec`秒間新しい変更が無いか、最初の変更から`max_delay_sec`秒経った時点で、
+    最大`batch_size`件ずつ埋め込み・登録・削除を行います。同じIDへの連続した変更は1回にまとめられます。
+
+    Args:
+        vectorDB (Chroma): ベクトルDBクライアント
+        debounce_sec (float): 変更が落ち着くまで待つ秒数
+        max_delay_sec (float): 変更を溜めておく最大の秒数
+        batch_size (int): 1回に処理する件数の上限
+    """
+    # 反映に失敗した場合に再試行するまでの秒数
+    RETRY_DELAY_SEC = 5.0
+
+    def __init__(self, vectorDB: Chroma,
+                 debounce_sec: float = settings.VECTOR_INDEXER_DEBOUNCE_SEC,
+                 max_delay_sec: float = settings.VECTOR_INDEXER_MAX_DELAY_SEC,
+                 batch_size: int = settings.VECTOR_INDEXER_BATCH_SIZE):
+        self.vectorDB = vectorDB
+        self.debounce_sec = debounce_sec
+        self.max_delay_sec = max_delay_sec
+        self.batch_size = batch_size
+        self._pending: dict[int, float] = {}  # 漫画ID -> 最初にキューに積まれた時刻
+        self._last_enqueued_at = 0.0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._stats = {"embedded": 0, "deleted": 0, "batches": 0, "errors": 0}
+        self._last_flush_at: Optional[float] = None
+        self._last_lag_sec: Optional[float] = None
+        self._last_error: Optional[str] = None
+
+    def enqueue(self, manga_ids: Iterable[int]) -> None:
+        """ベクトルDBへの反映が必要な漫画IDをキューに積みます。"""
+        now = time.time()
+        with self._cond:
+            for manga_id in manga_ids:
+                self._pending.setdefault(manga_id, now)
+            self._last_enqueued_at = now
+            self._cond.notify()
+
+    def start(self) -> None:
+        """バックグラウンドのワーカースレッドを起動します。"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="vector-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """キューに残っている分を反映してから、ワーカースレッドを停止します。"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def status(self) -> dict:
+        """キューの長さ・反映の遅れ・処理件数などの状態を返します。"""
+        now = time.time()
+        with self._cond:
+            oldest = min(self._pending.values(), default=None)
+            return {
+                "running": bool(self._thread and self._thread.is_alive()),
+                "queue_depth": len(self._pending),
+                "lag_sec": now - oldest if oldest is not None else 0.0,
+                "last_batch_lag_sec": self._last_lag_sec,
+                "last_flush_at": self._last_flush_at,
+                "last_error": self._last_error,
+                **self._stats,
+            }
+
+    def _take_batch(self) -> Optional[dict[int, float]]:
+        """反映するタイミングになるまで待ち、キューから最大batch_size件を取り出します。停止時はNoneを返します。"""
+        with self._cond:
+            while True:
+                if self._pending:
+                    now = time.time()
+                    oldest = min(self._pending.values())
+                    quiet_for = now - self._last_enqueued_at
+                    if self._stopping or quiet_for >= self.debounce_sec or now - oldest >= self.max_delay_sec:
+                        ids = sorted(self._pending, key=self._pending.get)[:self.batch_size]
+                        return {m_id: self._pending.pop(m_id) for m_id in ids}
+                    self._cond.wait(min(self.debounce_sec - quiet_for, self.max_delay_sec - (now - oldest)))
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self) -> None:
+        # 埋め込みの呼び出しはbatchレーンで行い、チャットの呼び出しを優先させる
+        with use_lane(LANE_BATCH):
+            self._run_batches()
+
+    def _run_batches(self) -> None:
+        while (batch := self._take_batch()) is not None:
+            try:
+                with Session(engine) as session:
+                    result = MangaService(session, self.vectorDB).sync_vector_ids(list(batch))
+                now = time.time()
+                with self._cond:
+                    self._stats["embedded"] += result["embedded"]
+                    self._stats["deleted"] += result["deleted"]
+                    self._stats["batches"] += 1
+                    self._last_flush_at = now
+                    self._last_lag_sec = now - min(batch.values())
+            except Exception as e:
+                # エラーはstatus()のerrors・last_errorで確認できる
+                with self._cond:
+                    self._stats["errors"] += 1
+                    self._last_error = str(e)
+                    # 失敗した分はキューに戻し、少し待ってから再試行する
+                    for manga_id, enqueued_at in batch.items():
+                        self._pending.setdefault(manga_id, enqueued_at)
+                    if self._stopping:
+                        return
+                    self._cond.wait(self.RETRY_DELAY_SEC)
+
+# アプリ全体で共有するインデクサのインスタンス
+vector_indexer = VectorIndexer(vectorDB)
+
+def get_vector_indexer() -> VectorIndexer:
+    """FastAPIのDI(依存性注入)で、ベクトルインデクサを取得するための関数。"""
+    return vector_indexer
@@ -5,6 +5,7 @@
 import streamlit as st
 import requests
 import uuid
+import json
 
 # --- ページ設定とAPI情報 ---
 st.set_page_config(page_title="漫画ライブラリ", layout="wide")
@@ -17,6 +18,8 @@ if "edit_target" not in st.session_state:
     st.session_state["edit_target"] = None  # 現在編集中の漫画
 if "search_results" not in st.session_state:
     st.session_state["search_results"] = []  # 検索結果やAIによる推薦結果
+if "search_next" not in st.session_state:
+    st.session_state["search_next"] = None  # 検索結果の次のページを取得するためのAPIのパスとパラメータ
 if "messages" not in st.session_state:
     st.session_state.messages = []  # AIアシスタントとのチャット履歴
 if "thread_id" not in st.session_state:
@@ -51,6 +54,63 @@ def display_manga_cards(manga_list, col_n=4):
                         st.session_state["edit_target"] = manga
                         st.rerun()
 
+def search_manga(path, params, append=False):
+    """
+    検索APIを呼び出し、結果をセッション状態に保存します。次のページがある場合は、そのカーソルも保存します。
+
+    Args:
+        path (str): 検索APIのパス。
+        params (dict): 検索APIのパラメータ。
+        append (bool): Trueの場合は、現在の検索結果の後ろに追加します（「さらに表示」）。
+    """
+    res = requests.get(f"{API_URL}{path}", params=params)
+    if res.status_code != 200:
+        st.error(f"検索に失敗しました: {res.status_code}")
+        return
+    page = res.json()
+    if append:
+        st.session_state["search_results"] = st.session_state["search_results"] + page["items"]
+    else:
+        st.session_state["search_results"] = page["items"]
+    st.session_state["search_next"] = {"path": path, "params": {**params, "cursor": page["next_cursor"]}} if page["next_cursor"] else None
+    st.session_state["edit_target"] = None
+    st.rerun()
+
+# チャットの処理の進行状況として表示する、グラフのノードごとのメッセージ
+NODE_PROGRESS_LABELS = {
+    "expander": "検索キーワードを考えています...",
+    "keyword_search": "キーワードで検索しています...",
+    "vector_search": "意味の近い作品を探しています...",
+    "ranker": "候補を並べ替えています...",
+    "compactor": "これまでの会話を整理しています...",
+    "chatbot": "回答を書いています...",
+}
+
+def stream_chat_events(res, progress, result):
+    """
+    チャットのストリーミングAPI(SSE)のレスポンスを読み、回答のトークンを順に返すジェネレータ。
+    ノードの進行状況は`progress`に表示し、最終結果（回答・漫画IDリスト・漫画の詳細）やエラーは`result`に格納します。
+
+    Args:
+        res (requests.Response): `stream=True`で受け取ったレスポンス。
+        progress: 進行状況を表示するStreamlitのプレースホルダー。
+        result (dict): 最終結果を格納する辞書。
+    """
+    event = None
+    for line in res.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = json.loads(line[len("data: "):])
+            if event == "token":
+                yield data["text"]
+            elif event == "node" and data["status"] == "start":
+                progress.caption(NODE_PROGRESS_LABELS.get(data["node"], data["node"]))
+            elif event == "done":
+                result.update(data)
+            elif event == "error":
+                result["error"] = data["message"]
+
 # ==========================================
 # 1. サイドバー: AIアシスタント
 # ==========================================
@@ -69,43 +129,43 @@ with st.sidebar:
         # ユーザーのメッセージを表示・保存
         st.session_state.messages.append({"role": "user", "content": prompt})
         
-        # バックエンドAPIにリクエストを送信し、AIからの応答を取得
+        # バックエンドAPIにリクエストを送信し、AIからの応答をストリーミングで受け取る
         with st.chat_message("assistant"):
-            with st.spinner("AIが考えています..."):
-                res = requests.post(f"{API_URL}/chat/chat", 
-                    json={
-                        "thread_id": st.session_state.thread_id, 
-                        "message": prompt
-                    }
-                )
-                
+            progress = st.empty()
+            result = {}
+            with requests.post(f"{API_URL}/chat/chat/stream",
+                json={
+                    "thread_id": st.session_state.thread_id,
+                    "message": prompt
+                },
+                stream=True
+            ) as res:
                 if res.status_code == 200:
-                    # アシスタントの応答を表示・保存
-                    answer = res.json()["response"]
-                    st.markdown(answer)
-                    st.session_state.messages.append({"role": "assistant", "content": answer})
-
-                    # AIが漫画を推薦した場合、そのIDリストをバックエンドから取得
-                    id_res = requests.get(f"{API_URL}/chat/chat/{st.session_state.thread_id}/manga-ids")
-                    if id_res.status_code == 200:
-                        found_ids = id_res.json()["response"]
-                        if found_ids:
-                            # 推薦された漫画の詳細情報を一括で取得
-                            ids_query = ",".join(map(str, found_ids))
-                            res_batch = requests.get(f"{API_URL}/manga/manga/batch", params={"ids": ids_query})
-                            if res_batch.status_code == 200:
-                                # 検索結果を推薦された漫画で更新
-                                st.session_state["search_results"] = res_batch.json()
-                                st.session_state["edit_target"] = None
-                                st.toast(f"{len(found_ids)}件の漫画を見つけました！")
-                    
-                    st.rerun()
+                    # 回答のトークンを受け取り次第表示し、処理の進行状況も合わせて表示
+                    answer = st.write_stream(stream_chat_events(res, progress, result))
+                    progress.empty()
+                    if "error" in result:
+                        st.error(f"エラーが発生しました: {result['error']}")
+                    else:
+                        # アシスタントの応答を保存
+                        st.session_state.messages.append({"role": "assistant", "content": result.get("answer", answer)})
+
+                        # AIが漫画を推薦した場合、最後のイベントに含まれる漫画の詳細で検索結果を更新
+                        found_manga = result.get("manga", [])
+                        if found_manga:
+                            st.session_state["search_results"] = found_manga
+                            st.session_state["search_next"] = None
+                            st.session_state["edit_target"] = None
+                            st.toast(f"{len(found_manga)}件の漫画を見つけました！")
+
+                        st.rerun()
 
     # 会話をリセットするボタン
     if st.button("会話をリセット"):
         st.session_state.thread_id = str(uuid.uuid4())
         st.session_state.messages = []
         st.session_state["search_results"] = []
+        st.session_state["search_next"] = None
         st.rerun()
     st.text(f"スレッドID: {st.session_state.thread_id}")
 
@@ -120,19 +180,17 @@ with st.expander("簡易検索"):
     c1, c2 = st.columns([4, 1])
     keyword = c1.text_input("キーワード", placeholder="タイトル・著者・タグ...")
     limit_keyword_search = c2.slider("最大件数（簡易）", 1, 50, 10)
+    sort_keyword_search = c2.selectbox("並び順（簡易）", ["relevance", "score", "updated_at"],
+        format_func={"relevance": "関連度順", "score": "評価順", "updated_at": "更新順"}.get)
     if c2.button("検索実行（簡易）", width='stretch'):
         # バックエンドに検索リクエストを送信
-        res = requests.get(f"{API_URL}/manga/search_manga_by_keyword", params={"keyword": keyword, "limit": limit_keyword_search})
-        if res.status_code == 200:
-            st.session_state["search_results"] = res.json()
-            st.session_state["edit_target"] = None
-            st.rerun()
+        search_manga("/manga/search_manga_by_keyword", {"keyword": keyword, "limit": limit_keyword_search, "sort": sort_keyword_search})
 
 with st.expander("詳細検索"):
     c1, c2 = st.columns([4, 1])
     title = c1.text_input("タイトル", placeholder="タイトル(部分一致)") or None
-    author = c1.text_input("著者", placeholder="著者(部分一致)") or None
-    serialization = c1.text_input("連載誌", placeholder="連載誌(部分一致)") or None
+    author = c1.text_input("著者", placeholder="著者(完全一致, カンマ区切りでいずれか)") or None
+    serialization = c1.text_input("連載誌", placeholder="連載誌(完全一致, カンマ区切りでいずれか)") or None
     synopsis = c1.text_input("あらすじ", placeholder="あらすじ(部分一致)") or None
     status = c1.selectbox("ステータス", [None, "Finished", "Publishing", "On Hiatus","Discontinued","Not yet published"]) or None
     score = c1.number_input("スコア", min_value=0.0, max_value=10.0, value=None, step=0.1) or None
@@ -141,13 +199,17 @@ with st.expander("詳細検索"):
     my_score = c1.number_input("評価", min_value=0, max_value=5, value=None, step=1) or None
     my_score_filter_method = c1.selectbox("評価フィルター", ["min", "max", "equal"]) or None
     my_status = c1.selectbox("ユーザーステータス", [None, "読みたい", "読んでいる", "読み終えた"]) or None
-    ai_tag = c1.text_input("タグ", placeholder="タグ(カンマ区切り, 部分一致)") or None
+    ai_tags = c1.text_input("タグ", placeholder="タグ(カンマ区切り, 完全一致)") or None
+    tag_match = c1.radio("複数のタグの条件", ["all", "any"], horizontal=True,
+        format_func={"all": "全てを含む", "any": "いずれかを含む"}.get)
     
     limit_query_search = c2.slider("最大件数（詳細）", 1, 50, 10) or None
+    sort_query_search = c2.selectbox("並び順（詳細）", ["score", "updated_at"],
+        format_func={"score": "評価順", "updated_at": "更新順"}.get)
     if c2.button("検索実行（詳細）", width='stretch'):
         # バックエンドに検索リクエストを送信
-        res = requests.get(f"{API_URL}/manga/search_manga_by_query", 
-            params={
+        search_manga("/manga/search_manga_by_query",
+            {
                 "title": title,
                 "author": author,
                 "serialization": serialization,
@@ -159,17 +221,18 @@ with st.expander("詳細検索"):
                 "my_score": my_score,
                 "my_score_filter_method": my_score_filter_method,
                 "my_status": my_status,
-                "ai_tag": ai_tag,
-                "limit": limit_query_search
+                "ai_tags": ai_tags,
+                "tag_match": tag_match,
+                "limit": limit_query_search,
+                "sort": sort_query_search
             }
         )
-        if res.status_code == 200:
-            st.session_state["search_results"] = res.json()
-            st.session_state["edit_target"] = None
-            st.rerun()
 
 # 現在の検索結果に基づいて漫画カードを表示
 display_manga_cards(st.session_state["search_results"])
+# 次のページがある場合は、続きを取得するボタンを表示
+if st.session_state["search_next"] and st.button("さらに表示"):
+    search_manga(st.session_state["search_next"]["path"], st.session_state["search_next"]["params"], append=True)
 
 # --- 漫画編集フォーム ---
 # 編集対象の漫画が選択されている場合にフォームを表示